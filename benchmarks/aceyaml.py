@@ -0,0 +1,118 @@
+# Benchmark for reading and writing RPG Maker ACE YAML
+#
+# Builds rvpacker style Map files of growing size and times loading and dumping them with the old
+# round trip ruamel path, the libyaml path in modules/aceyaml.py and a load from its snapshot. Each
+# libyaml dump is read back with ruamel and compared to the ruamel load of the source to check
+# nothing was lost on the way.
+#
+#   python benchmarks/aceyaml.py [events ...]
+
+# Libraries
+import io, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+#Globals
+SIZES = [250, 500, 1000, 2000]
+EVENT = '''  {id}: !ruby/object:RPG::Event
+    id: {id}
+    name: EV{id:03d}
+    pages:
+    - !ruby/object:RPG::Event::Page
+      condition: !ruby/object:RPG::Event::Page::Condition
+        actor_valid: false
+        switch1_id: 1
+        variable_value: 0
+      graphic: !ruby/object:RPG::Event::Page::Graphic
+        character_name: People1
+        direction: 2
+        tile_id: 0
+      list:
+      - !ruby/object:RPG::EventCommand
+        c: 101
+        i: 0
+        p:
+        - Actor1
+        - 0
+        - 0
+        - 2
+      - !ruby/object:RPG::EventCommand
+        c: 401
+        i: 0
+        p:
+        - "\\\\C[2]村人\\\\C[0]「こんにちは、今日はいい天気ですね。」"
+      - !ruby/object:RPG::EventCommand
+        c: 401
+        i: 0
+        p:
+        - 散歩にでも行きましょうか。
+      - !ruby/object:RPG::EventCommand
+        c: 102
+        i: 0
+        p:
+        - - はい
+          - いいえ
+        - 2
+      - !ruby/object:RPG::EventCommand
+        c: 0
+        i: 0
+        p: []
+      move_route: !ruby/object:RPG::MoveRoute
+        list:
+        - !ruby/object:RPG::MoveCommand
+          code: 0
+          parameters: []
+        repeat: true
+        skippable: false
+    x: {x}
+    y: {y}
+'''
+
+def mapYAML(events):
+    header = '--- !ruby/object:RPG::Map\nbgm: !ruby/object:RPG::BGM\n  name: ""\n  pitch: 100\n  volume: 100\ndisplay_name: 村\nnote: ""\ndata: !binary |-\n  AAAAAAAA\nevents:\n'
+    return header + ''.join([EVENT.format(id=i, x=i % 50, y=i // 50) for i in range(1, events + 1)])
+
+def timeIt(fn):
+    start = time.perf_counter()
+    result = fn()
+    return [time.perf_counter() - start, result]
+
+def dumpRuamel(data):
+    outFile = io.StringIO()
+    aceyaml.getYAML().dump(data, outFile)
+    return outFile.getvalue()
+
+def dumpFast(data):
+    outFile = io.StringIO()
+    aceyaml.dump(data, outFile)
+    return outFile.getvalue()
+
+def main():
+    global aceyaml
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('files')
+    from modules import aceyaml
+    if not aceyaml.FAST:
+        print('PyYAML with libyaml is not installed, only the ruamel path can be timed')
+
+    print('Events'.ljust(8) + ''.join([name.rjust(14) for name in ['ruamel load', 'ruamel dump', 'fast load', 'fast dump', 'snapshot', 'same']]))
+    for size in sizes:
+        text = mapYAML(size)
+        with open('files/Map001.yaml', 'w', encoding='utf-8') as f:
+            f.write(text)
+
+        ruamelLoad, data = timeIt(lambda: aceyaml.getYAML().load(text))
+        ruamelDump, _ = timeIt(lambda: dumpRuamel(data))
+        row = str(size).ljust(8) + f'{ruamelLoad:.3f}s'.rjust(14) + f'{ruamelDump:.3f}s'.rjust(14)
+        if aceyaml.FAST:
+            fastLoad, fastData = timeIt(lambda: aceyaml.parse(io.StringIO(text)))
+            fastDump, fastText = timeIt(lambda: dumpFast(fastData))
+            aceyaml.load('Map001.yaml')     # Writes the snapshot
+            snapshot, _ = timeIt(lambda: aceyaml.load('Map001.yaml'))
+            same = dumpRuamel(aceyaml.getYAML().load(fastText)) == dumpRuamel(data)
+            row += f'{fastLoad:.3f}s'.rjust(14) + f'{fastDump:.3f}s'.rjust(14) + f'{snapshot:.3f}s'.rjust(14) + str(same).rjust(14)
+        print(row)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Micro-benchmark for modules/codec.py
+#
+# Times subVars + resubVars per 401 line against the old per-module version (six findall
+# passes and a str.replace per placeholder). Pass MV/MZ Map/CommonEvents/Troops json files to
+# use their 401 lines, otherwise a built-in sample of dialogue is used.
+#
+#   python benchmarks/codec.py [files/Map001.json ...]
+
+# Libraries
+import json, os, re, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules import codec
+
+#Globals
+REPEAT = 5
+SAMPLE = [
+    '\\n<アリス>こんにちは、\\C[2]勇者\\C[0]さま！',
+    'この\\I[87]ポーションを\\V[12]個あげるね。',
+    '\\N[1]「もう……\\C[27]だめ\\C[0]かも……」',
+    '\\FS[28]\\C[6]【村長】\\C[0]\\{よく来た！\\}',
+    '\\N[\\V[5]]は\\I[312]\\C[4]魔法の鍵\\C[0]を手に入れた！',
+    '……そう。',
+    '\\SE[1]扉が開いた。\\|\\.\\.',
+    '今日は\\V[3]月\\V[4]日です。\\C[3]忘れないで\\C[0]ね。',
+    'あの人のことは、\\N[2]に聞いてみるといいわ。',
+    '\\C[14]ＨＰ\\C[0]が\\V[21]回復した！',
+]
+
+# Old subVars/resubVars from rpgmakermvmz
+def legacySubVars(jaString):
+    jaString = jaString.replace('\u3000', ' ')
+    allList = []
+    for name, pattern in [['Nested', r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]'], ['Ascii', r'[\\]+[iIkKwWaA]+\[[0-9]+\]'],
+                          ['Color', r'[\\]+[cC]\[[0-9]+\]'], ['Noun', r'[\\]+[nN]\[.+?\]+'],
+                          ['Var', r'[\\]+[vV]\[[0-9]+\]'], ['FCode', r'[\\]+[\w]+\[.+?\]']]:
+        count = 0
+        varList = set(re.findall(pattern, jaString))
+        for var in varList:
+            jaString = jaString.replace(var, '{' + name + '_' + str(count) + '}')
+            count += 1
+        allList.append(varList)
+    return [jaString, allList]
+
+def legacyResubVars(translatedText, allList):
+    matchList = re.findall(r'\[\s?.+?\s?\]', translatedText)
+    for match in matchList:
+        translatedText = translatedText.replace(match, match.strip())
+    for name, varList in zip(['Nested', 'Ascii', 'Color', 'Noun', 'Var', 'FCode'], allList):
+        count = 0
+        for var in varList:
+            translatedText = translatedText.replace('{' + name + '_' + str(count) + '}', var)
+            count += 1
+    return translatedText
+
+def loadLines(paths):
+    lines = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            findLines(json.load(f), lines)
+    return lines
+
+def findLines(data, lines):
+    if isinstance(data, dict):
+        if data.get('code') in [401, 405] and len(data.get('parameters', [])) > 0 and isinstance(data['parameters'][0], str):
+            lines.append(data['parameters'][0])
+        for value in data.values():
+            findLines(value, lines)
+    elif isinstance(data, list):
+        for value in data:
+            findLines(value, lines)
+
+def codecSubVars(jaString):
+    return codec.subVars(jaString, 'mvmz')
+
+def roundTrip(lines, sub, resub):
+    for line in lines:
+        response = sub(line)
+        resub(response[0], response[1])
+
+def main():
+    lines = loadLines(sys.argv[1:]) if len(sys.argv) > 1 else SAMPLE * 1000
+    if len(lines) == 0:
+        print('No 401 lines found')
+        return
+
+    # Both must give back the original line
+    for line in lines:
+        response = codec.subVars(line, 'mvmz')
+        if codec.resubVars(response[0], response[1]) != line.replace('\u3000', ' '):
+            print('Round trip failed: ' + line)
+            return
+
+    legacy = min(timeit.repeat(lambda: roundTrip(lines, legacySubVars, legacyResubVars), number=1, repeat=REPEAT))
+    shared = min(timeit.repeat(lambda: roundTrip(lines, codecSubVars, codec.resubVars), number=1, repeat=REPEAT))
+    print(f'Lines: {len(lines)}')
+    print(f'Legacy: {legacy / len(lines) * 1e6:.2f} us/line')
+    print(f'Codec:  {shared / len(lines) * 1e6:.2f} us/line ({legacy / shared:.1f}x)')
+
+if __name__ == '__main__':
+    main()
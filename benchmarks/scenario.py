@@ -0,0 +1,101 @@
+# Benchmark for rebuilding translated Tyrano/Kansen/Sakuranbo scenarios
+#
+# Runs each engine's translateTyrano over synthetic .ks files of growing size with translateGPT
+# replaced by an echo, so only the line handling is timed. The time per line should stay flat as
+# the file grows. The old way of splicing translations in (data.insert per line and a '\d' filter
+# pass) is timed on the same line counts for comparison.
+#
+#   python benchmarks/scenario.py [lines ...]
+
+# Libraries
+import os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+#Globals
+SIZES = [25000, 50000, 100000, 200000]
+ENV = {'model': 'gpt-3.5-turbo', 'timeout': '120', 'language': 'English', 'threads': '1', 'width': '60',
+       'listWidth': '100', 'api': 'http://127.0.0.1/v1', 'key': 'x'}
+
+# Engine modules read .env values and prompt.txt on import
+def importEngines():
+    for key, value in ENV.items():
+        os.environ.setdefault(key, value)
+    os.chdir(tempfile.mkdtemp())
+    with open('prompt.txt', 'w', encoding='utf-8') as f:
+        f.write('Translate to English.')
+    from modules import kansen, sakuranbo, tyrano
+    return [['Tyrano', tyrano, tyranoLines], ['Kansen', kansen, kansenLines], ['Kansen (EOF)', kansen, kansenEndLines],
+            ['Sakuranbo', sakuranbo, sakuranboLines]]
+
+def echoGPT(text, history, fullPromptFlag):
+    return [text, [0, 0]]
+
+class Bar:
+    def update(self, n=1):
+        pass
+
+    def write(self, text):
+        pass
+
+def repeatBlock(block, lines):
+    return (block * (lines // len(block) + 1))[:lines]
+
+def tyranoLines(lines):
+    return repeatBlock(['[主人公]\n', 'こんにちは、今日はいい天気ですね。[r]\n', 'そうですね、散歩にでも行きましょうか。[p]\n',
+                        '\n', '*label\n', '[glink text="はい" target="*yes"]\n'], lines)
+
+def kansenLines(lines):
+    return repeatBlock(['[ns]航[nse]\n', 'こんにちは、今日はいい天気ですね。[r]\n', 'そうですね。[pcms]\n',
+                        '[wait time=100]\n'], lines)
+
+# Ends on a text line so the last batch is translated at EOF
+def kansenEndLines(lines):
+    return repeatBlock(['あ[pcms]\n', '[w]\n'], lines - 1) + ['あ[pcms]\n']
+
+def sakuranboLines(lines):
+    return repeatBlock(['[主人公]\n', 'こんにちは、今日はいい天気ですね。\n', 'そうですね、散歩にでも行きましょうか。\n',
+                        '@wait\n'], lines)
+
+def runEngine(module, data):
+    module.translateGPT = echoGPT
+    module.ESTIMATE = False
+    start = time.perf_counter()
+    if module.__name__ == 'modules.kansen':
+        insertedLines = {}
+        module.translateTyrano(data, insertedLines, Bar(), len(data), 'Scenario.ks')
+        module.joinLines(data, insertedLines)
+    else:
+        module.translateTyrano(data, Bar())
+    return time.perf_counter() - start
+
+# Old write path: every group is marked '\d', its translation is inserted in front of the next
+# line and the markers are filtered out at the end
+def legacySplice(lines):
+    data = ['こんにちは。[r]\n', 'そうですね。[p]\n', '[wait]\n'] * (lines // 3)
+    start = time.perf_counter()
+    i = 0
+    while i < len(data):
+        if data[i].endswith(']\n') and data[i] != '[wait]\n':
+            data[i] = '\\d\n'
+            data[i + 1] = '\\d\n'
+            i += 2
+            data.insert(i, 'Hello. That is so.[p][cm]\n')
+            i += 1
+        i += 1
+    [line for line in data if line != '\\d\n']
+    return time.perf_counter() - start
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    engines = importEngines()
+    print('Lines'.ljust(10) + ''.join([name.rjust(14) for name, module, generate in engines]) + 'Old splice'.rjust(14))
+    for size in sizes:
+        row = str(size).ljust(10)
+        for name, module, generate in engines:
+            row += f'{runEngine(module, generate(size)) / size * 1e6:.2f} us/line'.rjust(14)
+        row += f'{legacySplice(size) / size * 1e6:.2f} us/line'.rjust(14)
+        print(row)
+
+if __name__ == '__main__':
+    main()
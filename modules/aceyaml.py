@@ -0,0 +1,122 @@
+# Libraries
+import os, pickle
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap, CommentedSeq, TaggedScalar
+from ruamel.yaml.tag import Tag
+from modules import journal, manifest
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Reading and writing the rvpacker YAML of RPG Maker ACE. The round trip ruamel loader and dumper are
+# pure Python and end up taking most of the time on large Map and CommonEvents files, so when PyYAML
+# was built with libyaml its C loader and dumper are used instead. Both paths build the same ruamel
+# types (CommentedMap/CommentedSeq/TaggedScalar carrying the !ruby/object tags), so the module code
+# and the fallback dumper don't care which one loaded a file.
+#
+# A parsed file is also kept as a pickle in SNAPSHOTDIR, keyed by the hash of the file, so estimating
+# and then translating a file (or running it again after a failure) only parses it once.
+
+#Globals
+FAST = yaml is not None and hasattr(yaml, 'CSafeLoader')
+SNAPSHOT = True
+SNAPSHOTDIR = 'cache/yaml'
+WIDTH = 4096
+
+if FAST:
+    class Loader(yaml.CSafeLoader):
+        pass
+
+    class Dumper(yaml.CSafeDumper):
+        pass
+
+# Tags like !ruby/object:RPG::Map are kept on the ruamel type the round trip loader would have made
+def constructTagged(loader, suffix, node):
+    tag = Tag(suffix='!' + suffix)
+    if isinstance(node, yaml.MappingNode):
+        data = CommentedMap()
+        data.yaml_set_ctag(tag)
+        yield data
+        data.update(loader.construct_mapping(node))
+    elif isinstance(node, yaml.SequenceNode):
+        data = CommentedSeq()
+        data.yaml_set_ctag(tag)
+        yield data
+        data.extend(loader.construct_sequence(node))
+    else:
+        data = TaggedScalar()
+        data.value = loader.construct_scalar(node)
+        data.style = node.style
+        data.yaml_set_ctag(tag)
+        yield data
+
+def constructMap(loader, node):
+    data = CommentedMap()
+    yield data
+    data.update(loader.construct_mapping(node))
+
+def representMap(dumper, data):
+    return dumper.represent_mapping(data.tag.value or 'tag:yaml.org,2002:map', data)
+
+def representSeq(dumper, data):
+    return dumper.represent_sequence(data.tag.value or 'tag:yaml.org,2002:seq', data)
+
+def representScalar(dumper, data):
+    return dumper.represent_scalar(data.tag.value, data.value, style=data.style)
+
+# Strings are single quoted like the ruamel dump. Other scalars stay plain, since libyaml drops the
+# tag of a quoted int (Writing ! '1' instead of !!int '1').
+def representStr(dumper, data):
+    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style="'")
+
+if FAST:
+    Loader.add_multi_constructor('!', constructTagged)
+    Loader.add_constructor('tag:yaml.org,2002:map', constructMap)
+    Dumper.add_representer(CommentedMap, representMap)
+    Dumper.add_representer(CommentedSeq, representSeq)
+    Dumper.add_representer(TaggedScalar, representScalar)
+    Dumper.add_representer(str, representStr)
+
+def getYAML():
+    ruamel = YAML(pure=True)   # Need a yaml instance per thread.
+    ruamel.width = WIDTH
+    ruamel.default_style = "'"
+    return ruamel
+
+def parse(f):
+    if FAST:
+        return yaml.load(f, Loader=Loader)
+    return getYAML().load(f)
+
+def load(filename):
+    path = 'files/' + filename
+    if not SNAPSHOT:
+        with open(path, 'r', encoding='UTF-8') as f:
+            return parse(f)
+
+    # Snapshot of this exact file
+    fileHash = manifest.hashFile(path)
+    snapshotPath = os.path.join(SNAPSHOTDIR, filename + '.pickle')
+    if os.path.exists(snapshotPath):
+        try:
+            with open(snapshotPath, 'rb') as f:
+                if pickle.load(f) == fileHash:
+                    return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+
+    with open(path, 'r', encoding='UTF-8') as f:
+        data = parse(f)
+    os.makedirs(SNAPSHOTDIR, exist_ok=True)
+    with journal.openAtomic(snapshotPath, 'wb') as f:
+        pickle.dump(fileHash, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return data
+
+def dump(data, outFile):
+    if FAST:
+        yaml.dump(data, outFile, Dumper=Dumper, width=WIDTH, allow_unicode=True, sort_keys=False)
+    else:
+        getYAML().dump(data, outFile)
@@ -1,17 +1,14 @@
 # Libraries
-import json, os, re, textwrap, threading, time, traceback, tiktoken, openai
+import json, os, re, textwrap, threading, time, traceback
 from pathlib import Path
 from colorama import Fore
 from dotenv import load_dotenv
 from retry import retry
 from tqdm import tqdm
+from modules import codec, engine, journal, manifest, tlcache
 
 # Open AI
 load_dotenv()
-if os.getenv('api').replace(' ', '') != '':
-    openai.api_base = os.getenv('api')
-openai.organization = os.getenv('org')
-openai.api_key = os.getenv('key')
 
 #Globals
 MODEL = os.getenv('model')
@@ -77,7 +74,7 @@ def handleAnim(filename, estimate):
     
     else:
         try:
-            with open('translated/' + filename, 'w', encoding='UTF-8') as outFile:
+            with journal.openAtomic('translated/' + filename, 'w', encoding='UTF-8') as outFile:
                 start = time.time()
                 translatedData = openFiles(filename)
 
@@ -91,6 +88,10 @@ def handleAnim(filename, estimate):
         except Exception as e:
             return 'Fail'
 
+    # Skip this file next run unless its source changes
+    if not estimate and translatedData[2] is None and filename not in MISMATCH:
+        manifest.record(filename)
+
     return getResultString(['', totalTokens, None], end - start, 'TOTAL')
 
 def openFiles(filename):
@@ -142,7 +143,7 @@ def parseJSON(data, filename):
         pbar.desc=filename
         pbar.total=totalLines
         try:
-            result = translateJSON(batches, data, pbar)
+            result = translateJSON(batches, data, pbar, filename)
             totalTokens[0] += result[0]
             totalTokens[1] += result[1]
         except Exception as e:
@@ -150,7 +151,7 @@ def parseJSON(data, filename):
             return [data, totalTokens, e]
     return [data, totalTokens, None]
 
-def translateJSON(keys, data, pbar):
+def translateJSON(keys, data, pbar, filename):
     translatedBatch = []
     textHistory = []
     tokens = [0, 0]
@@ -192,7 +193,7 @@ def translateJSON(keys, data, pbar):
                 translatedBatch.append(data[originalBatch[i]])
 
         # Format and Set Text
-        if len(batch) == len(translatedBatch):
+        if len(batch) == len(translatedBatch) and None not in translatedBatch:
             for i in range(len(translatedBatch)):
 
                 # Remove added speaker
@@ -210,126 +211,14 @@ def translateJSON(keys, data, pbar):
             translatedBatch.clear()
         # Mismatch, Skip Batch
         else:
-            MISMATCH.append(batch)
+            if filename not in MISMATCH:
+                MISMATCH.append(filename)
             pbar.update(1)
             continue
         pbar.update(1)
 
     return tokens  
 
-def subVars(jaString):
-    jaString = jaString.replace('\u3000', ' ')
-
-    # Nested
-    count = 0
-    nestedList = re.findall(r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]', jaString)
-    nestedList = set(nestedList)
-    if len(nestedList) != 0:
-        for icon in nestedList:
-            jaString = jaString.replace(icon, '{Nested_' + str(count) + '}')
-            count += 1
-
-    # Icons
-    count = 0
-    iconList = re.findall(r'[\\]+[iIkKwWaA]+\[[0-9]+\]', jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, '{Ascii_' + str(count) + '}')
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r'[\\]+[cC]\[[0-9]+\]', jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, '{Color_' + str(count) + '}')
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r'[\\]+[nN]\[.+?\]+', jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, '{Noun_' + str(count) + '}')
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r'[\\]+[vV]\[[0-9]+\]', jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, '{Var_' + str(count) + '}')
-            count += 1
-
-    # Formatting
-    count = 0
-    formatList = re.findall(r'[\\]+[\w]+\[.+?\]', jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for var in formatList:
-            jaString = jaString.replace(var, '{FCode_' + str(count) + '}')
-            count += 1
-
-    # Put all lists in list and return
-    allList = [nestedList, iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r'\[\s?.+?\s?\]', translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Nested
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace('{Nested_' + str(count) + '}', var)
-            count += 1
-
-    # Icons
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace('{Ascii_' + str(count) + '}', var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace('{Color_' + str(count) + '}', var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace('{Noun_' + str(count) + '}', var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace('{Var_' + str(count) + '}', var)
-            count += 1
-    
-    # Formatting
-    count = 0
-    if len(allList[5]) != 0:
-        for var in allList[5]:
-            translatedText = translatedText.replace('{FCode_' + str(count) + '}', var)
-            count += 1
-
-    return translatedText
-
 def batchList(input_list, batch_size):
     if not isinstance(batch_size, int) or batch_size <= 0:
         raise ValueError("batch_size must be a positive integer")
@@ -349,27 +238,14 @@ def createContext(fullPromptFlag, subbedT):
     return characters, system, user
 
 def translateText(characters, system, user, history):
-    # Prompt
-    msg = [{"role": "system", "content": system}]
-
-    # Characters
-    msg.append({"role": "user", "content": characters})
-
-    # History
-    if isinstance(history, list):
-        msg.extend([{"role": "user", "content": h} for h in history])
-    else:
-        msg.append({"role": "user", "content": history})
-    
-    # Content to TL
-    msg.append({"role": "user", "content": user})
-    response = openai.ChatCompletion.create(
+    # Prompt, characters and history (The unchanging part first)
+    msg = engine.prompt.build(system, characters, history, user, 'user')
+    response = engine.complete(
         temperature=0,
         frequency_penalty=0,
         presence_penalty=0,
         model=MODEL,
         messages=msg,
-        request_timeout=TIMEOUT,
     )
     return response
 
@@ -383,7 +259,7 @@ def cleanTranslatedText(translatedText, varResponse):
     for target, replacement in placeholders.items():
         translatedText = translatedText.replace(target, replacement)
 
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
     return [line for line in translatedText.split('\n') if line]
 
 def extractTranslation(translatedTextList, is_list):
@@ -396,22 +272,15 @@ def extractTranslation(translatedTextList, is_list):
         return matchList[0][1] if matchList else translatedTextList
 
 def countTokens(characters, system, user, history):
-    inputTotalTokens = 0
-    outputTotalTokens = 0
-    enc = tiktoken.encoding_for_model(MODEL)
-    
+    if not isinstance(history, list):
+        history = [history]
+
     # Input
-    if isinstance(history, list):
-        for line in history:
-            inputTotalTokens += len(enc.encode(line))
-    else:
-        inputTotalTokens += len(enc.encode(history))
-    inputTotalTokens += len(enc.encode(system))
-    inputTotalTokens += len(enc.encode(characters))
-    inputTotalTokens += len(enc.encode(user))
+    counts = engine.tokens.countBatch(history + [system, characters, user])
+    inputTotalTokens = sum(counts)
 
     # Output
-    outputTotalTokens += round(len(enc.encode(user))/1.7)
+    outputTotalTokens = round(counts[-1]/1.7)
 
     return [inputTotalTokens, outputTotalTokens]
 
@@ -422,20 +291,37 @@ def combineList(tlist, text):
 
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(text, history, fullPromptFlag):
+    return translateGPTOnce(text, history, fullPromptFlag)
+
+# translateGPT without the retry. Lines sent again by recover come back through here, so a request
+# that keeps failing is only retried by the outermost call rather than at every level of the split.
+def translateGPTOnce(text, history, fullPromptFlag):
     totalTokens = [0, 0]
+    translated = False
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memoryHistory = history     # history changes as batches come back
+
+    # Translation Memory
     if isinstance(text, list):
-        tList = batchList(text, BATCHSIZE)
+        memoryList = tlcache.getBatch(__name__, text, memoryHistory, memoryPrompt)
+        sourceList = [text[i] for i in range(len(text)) if memoryList[i] is None]
+        if len(sourceList) == 0:
+            return [memoryList, totalTokens]
+        tList = batchList(sourceList, BATCHSIZE)
     else:
+        memory = tlcache.getTranslation(__name__, text, memoryHistory, memoryPrompt)
+        if memory is not None:
+            return [memory, totalTokens]
         tList = [text]
 
     for index, tItem in enumerate(tList):
         # Before sending to translation, if we have a list of items, add the formatting
         if isinstance(tItem, list):
             payload = '\n'.join([f'<Line{i}>{item}</Line{i}>' for i, item in enumerate(tItem)])
-            varResponse = subVars(payload)
+            varResponse = codec.subVars(payload, 'mvmz')
             subbedT = varResponse[0]
         else:
-            varResponse = subVars(tItem)
+            varResponse = codec.subVars(tItem, 'mvmz')
             subbedT = varResponse[0]
 
         # Things to Check before starting translation
@@ -448,6 +334,7 @@ def translateGPT(text, history, fullPromptFlag):
         # Calculate Estimate
         if ESTIMATE:
             estimate = countTokens(characters, system, user, history)
+            engine.estimate.record(len(tItem) if isinstance(tItem, list) else 1, estimate)
             totalTokens[0] += estimate[0]
             totalTokens[1] += estimate[1]
             continue
@@ -457,17 +344,39 @@ def translateGPT(text, history, fullPromptFlag):
         translatedText = response.choices[0].message.content
         totalTokens[0] += response.usage.prompt_tokens
         totalTokens[1] += response.usage.completion_tokens
+        translated = True
 
         # Formatting
         translatedTextList = cleanTranslatedText(translatedText, varResponse)
         if isinstance(tItem, list):
             extractedTranslations = extractTranslation(translatedTextList, True)
+
+            # Mismatch, keep the lines that came back under their own <LineN> and send the rest again
+            if len(extractedTranslations) != len(tItem) and len(tItem) > 1:
+                lines = engine.batch.indexLines(translatedTextList, len(tItem), r'<Line(\d+)>(.*)</Line\d+>')
+                response = engine.batch.recover(tItem, lines, lambda sourceList: translateGPTOnce(sourceList, history, fullPromptFlag))
+                totalTokens[0] += response[1][0]
+                totalTokens[1] += response[1][1]
+                extractedTranslations = response[0]
+
+            # A single line that didn't come back is left as a gap too
+            elif len(extractedTranslations) != len(tItem):
+                extractedTranslations = [None] * len(tItem)
             tList[index] = extractedTranslations
-            history = extractedTranslations[-10:]  # Update history if we have a list
+            history = [line for line in extractedTranslations if line is not None][-10:]  # Update history if we have a list
         else:
             # Ensure we're passing a single string to extractTranslation
             extractedTranslations = extractTranslation('\n'.join(translatedTextList), False)
             tList[index] = extractedTranslations
 
     finalList = combineList(tList, text)
+
+    # Save to Translation Memory
+    if isinstance(text, list):
+        if translated:
+            finalList = tlcache.fillBatch(__name__, memoryList, text, finalList, memoryHistory, memoryPrompt)
+        else:
+            finalList = [memoryList[i] if memoryList[i] is not None else text[i] for i in range(len(text))]
+    elif translated:
+        tlcache.setTranslation(__name__, text, memoryHistory, memoryPrompt, finalList)
     return [finalList, totalTokens]
\ No newline at end of file
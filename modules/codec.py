@@ -0,0 +1,128 @@
+# Libraries
+import re
+
+# Placeholder codec shared by every engine module. subVars swaps the control codes in a string
+# (\C[n], \V[n], \N[..], nested codes, icons, format codes) for placeholders the model won't touch,
+# and resubVars puts them back.
+#
+# Each style is the table one family of modules always used. All of a style's codes are compiled into
+# one alternation, tried in table order at each position, so a string is tokenized in a single pass.
+# Restoring looks each placeholder up in the map built by subVars, with one re.sub pass for any the
+# model padded with spaces.
+
+#Globals
+STYLES = {
+    # rpgmakermvmz, alice, anim, json, kansen
+    'mvmz': {
+        'placeholder': ['{', '_', '}'],
+        'codes': [
+            ['Nested', r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]'],
+            ['Ascii', r'[\\]+[iIkKwWaA]+\[[0-9]+\]'],
+            ['Color', r'[\\]+[cC]\[[0-9]+\]'],
+            ['Noun', r'[\\]+[nN]\[.+?\]+'],
+            ['Var', r'[\\]+[vV]\[[0-9]+\]'],
+            ['FCode', r'[\\]+[\w]+\[.+?\]'],
+        ],
+    },
+    # tyrano, sakuranbo, atelier
+    'tyrano': {
+        'placeholder': ['{', '_', '}'],
+        'codes': [
+            ['Nested', r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]'],
+            ['Ascii', r'[\\]+[iIkKwWaA]+\[[0-9]+\]'],
+            ['Color', r'[\\]+[cC]\[[0-9]+\]'],
+            ['N', r'[\\]+[nN]\[.+?\]+'],
+            ['Var', r'[\\]+[vV]\[[0-9]+\]'],
+            ['FCode', r'[\\]+[\w]+\[.+?\]'],
+        ],
+    },
+    # rpgmakerace
+    'ace': {
+        'placeholder': ['{', '_', '}'],
+        'codes': [
+            ['Nested', r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]'],
+            ['Ascii', r'[\\]+[iIkKwWaA]+\[[0-9]+\]'],
+            ['Color', r'[\\]+[cC]\[[0-9]+\]'],
+            ['N', r'[\\]+[nN]\[.+?\]+'],
+            ['Var', r'[\\]+[vV]\[[0-9]+\]'],
+            ['FCode', r'[\\]+CL'],
+        ],
+    },
+    # lune, lune2
+    'lune': {
+        'placeholder': ['[', '_', ']'],
+        'codes': [
+            ['Ascii', r'[\\]+[iIkKwW]+\[[0-9]+\]'],
+            ['Color', r'[\\]+[cC]\[[0-9]+\]'],
+            ['N', r'[\\]+[nN]\[.+?\]+'],
+            ['Var', r'[\\]+[vV]\[[0-9]+\]'],
+            ['FCode', r'[\\]+CL'],
+        ],
+    },
+    # csv, txt
+    'csv': {
+        'placeholder': ['<', '', '>'],
+        'codes': [
+            ['I', r'[\\]+[iI]\[[0-9]+\]'],
+            ['C', r'[\\]+[cC]\[[0-9]+\]'],
+            ['N', r'[\\]+[nN]\[[0-9]+\]'],
+            ['V', r'[\\]+[vV]\[[0-9]+\]'],
+            ['F', r'[\\]+[!.]'],
+        ],
+    },
+}
+
+# Compile every style once
+def compileStyles():
+    for style in STYLES.values():
+        start, separator, end = style['placeholder']
+        names = [code[0] for code in style['codes']]
+        style['names'] = names
+        style['encode'] = re.compile('|'.join(['(' + code[1] + ')' for code in style['codes']]))
+        style['decode'] = re.compile(re.escape(start) + r'\s?(' + '|'.join(names) + ')' + re.escape(separator) + r'([0-9]+)\s?' + re.escape(end))
+
+compileStyles()
+
+# Returns [jaString, allList]. allList holds the style and a map of placeholder to original code,
+# and only needs to be handed back to resubVars. The same code always gets the same placeholder.
+def subVars(jaString, styleName):
+    jaString = jaString.replace('\u3000', ' ')
+
+    # Every code starts with a backslash
+    if '\\' not in jaString:
+        return [jaString, {'style': styleName, 'vars': {}}]
+
+    style = STYLES[styleName]
+    start, separator, end = style['placeholder']
+    names = style['names']
+    varMap = {}
+    seen = {}
+    counts = [0] * len(names)
+
+    def encode(match):
+        text = match.group()
+        if text not in seen:
+            index = match.lastindex - 1
+            key = names[index] + separator + str(counts[index])
+            counts[index] += 1
+            seen[text] = key
+            varMap[key] = text
+        return start + seen[text] + end
+
+    jaString = style['encode'].sub(encode, jaString)
+    return [jaString, {'style': styleName, 'vars': varMap}]
+
+def resubVars(translatedText, allList):
+    varMap = allList['vars']
+    if len(varMap) == 0:
+        return translatedText
+
+    style = STYLES[allList['style']]
+    start, separator, end = style['placeholder']
+    for key in varMap:
+        translatedText = translatedText.replace(start + key + end, varMap[key])
+
+    # Placeholders the model padded with spaces
+    if style['decode'].search(translatedText) is None:
+        return translatedText
+    return style['decode'].sub(lambda match: varMap.get(match.group(1) + separator + match.group(2), match.group()), translatedText)
@@ -1,4 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor, as_completed
+import collections
 import os
 from pathlib import Path
 import re
@@ -7,22 +8,16 @@ import textwrap
 import threading
 import time
 import traceback
-import tiktoken
 import csv
 
 from colorama import Fore
 from dotenv import load_dotenv
-import openai
 from retry import retry
 from tqdm import tqdm
+from modules import codec, engine, journal, manifest, tlcache
 
 #Globals
 load_dotenv()
-if os.getenv('api').replace(' ', '') != '':
-    openai.api_base = os.getenv('api')
-
-openai.organization = os.getenv('org')
-openai.api_key = os.getenv('key')
 MODEL = os.getenv('model')
 TIMEOUT = int(os.getenv('timeout'))
 LANGUAGE=os.getenv('language').capitalize()
@@ -37,6 +32,41 @@ ESTIMATE = ''
 TOTALCOST = 0
 TOKENS = 0
 TOTALTOKENS = 0
+MISMATCH = []   # Lists files with batches that came back with the wrong number of lines
+
+# CSV formats. source is the column with the text and target the column the translation goes in
+# (The same one to translate in place). Rows are left alone when skip (One of SKIPS) is true for their
+# target cell. speakers translates the :name[Speaker,...] lines inside the cell instead of the whole
+# cell. Pick the format with csvFormat in .env and override its columns with csvColumns="source,target",
+# otherwise it is asked for once per run.
+FORMATS = {
+    'translator++': {'source': 0, 'target': 1, 'skip': 'translated', 'speakers': False},
+    'all': {'source': 1, 'target': 1, 'skip': 'none', 'speakers': True},
+}
+SKIPS = {
+    'translated': lambda text: text != '' and not re.search(r'[一-龠]+|[ぁ-ゔ]+|[ァ-ヴ]+|[\uFF00-\uFFEF]', text),
+    'none': lambda text: False,
+}
+FORMAT = os.getenv('csvFormat') or None
+COLUMNS = os.getenv('csvColumns') or None
+
+# Streaming (Translator++ format). Rows are read one at a time and the ones that still need a
+# translation go out in <LineN> batches of BATCHSIZE, THREADS batches at once. Rows are written back in
+# file order, so a row waits in the queue until every batch before it is done. Once more than
+# MAXQUEUE rows are waiting the writer blocks on the oldest batch instead of reading further.
+STREAM = True
+BATCHSIZE = 20
+MAXQUEUE = BATCHSIZE * THREADS * 4
+
+# Characters
+CHARACTERS = '```\
+        Game Characters:\
+        Character: 池ノ上 拓海 == Ikenoue Takumi - Gender: Male\
+        Character: 福永 こはる == Fukunaga Koharu - Gender: Female\
+        Character: 神泉 理央 == Kamiizumi Rio - Gender: Female\
+        Character: 吉祥寺 アリサ == Kisshouji Arisa - Gender: Female\
+        Character: 久我 友里子 == Kuga Yuriko - Gender: Female\
+        ```'
 
 #tqdm Globals
 BAR_FORMAT='{l_bar}{bar:10}{r_bar}{bar:-10b}'
@@ -47,7 +77,7 @@ def handleCSV(filename, estimate):
     global ESTIMATE, TOKENS, TOTALTOKENS, TOTALCOST
     ESTIMATE = estimate
     
-    with open('translated/' + filename, 'w+t', newline='', encoding='utf-8') as writeFile:
+    with journal.openAtomic('translated/' + filename, 'w+t', newline='', encoding='utf-8') as writeFile:
         start = time.time()
         translatedData = openFiles(filename, writeFile)
         
@@ -57,10 +87,17 @@ def handleCSV(filename, estimate):
         TOTALCOST += translatedData[1] * .001 * APICOST
         TOTALTOKENS += translatedData[1]
 
+    # Skip this file next run unless its source changes
+    if not estimate and translatedData[2] is None and filename not in MISMATCH:
+        manifest.record(filename)
+
+    # Print any mismatched batches
+    if len(MISMATCH) > 0:
+        return getResultString(['', TOTALTOKENS, None], end - start, 'TOTAL') + Fore.RED + f'\nMismatch Errors: {MISMATCH}' + Fore.RESET
     return getResultString(['', TOTALTOKENS, None], end - start, 'TOTAL')
 
 def openFiles(filename, writeFile):
-    with open('files/' + filename, 'r', encoding='utf-8') as readFile, writeFile:
+    with open('files/' + filename, 'r', encoding='utf-8') as readFile:
         translatedData = parseCSV(readFile, writeFile, filename)
 
     return translatedData
@@ -90,18 +127,12 @@ def parseCSV(readFile, writeFile, filename):
     textHistory = []
     global LOCK
 
-    format = ''
-    while format == '':
-        format = input('\n\nSelect the CSV Format:\n\n1. Translator++\n2. Translate All\n')
-        match format:
-            case '1':
-                format = '1'
-            case '2':
-                format = '2'
+    spec = getFormat()
 
     # Get total for progress bar
-    totalLines = len(readFile.readlines())
-    readFile.seek(0)
+    totalLines = countLines('files/' + filename)
+    if STREAM and not spec['speakers']:
+        return streamCSV(readFile, writeFile, filename, totalLines, spec)
 
     reader = csv.reader(readFile, delimiter=',',)
     writer = csv.writer(writeFile, delimiter=',', quotechar='\"')
@@ -112,226 +143,243 @@ def parseCSV(readFile, writeFile, filename):
 
         for row in reader:
             try:
-                totalTokens += translateCSV(row, pbar, writer, textHistory, format)
+                totalTokens += translateCSV(row, pbar, writer, textHistory, spec)
             except Exception as e:
                 tracebackLineNo = str(traceback.extract_tb(sys.exc_info()[2])[-1].lineno)
                 return [reader, totalTokens, e, tracebackLineNo]
     return [reader, totalTokens, None]
 
-def translateCSV(row, pbar, writer, textHistory, format):
+# Files are worked on in parallel, so the format is settled once under LOCK and shared by all of them
+def getFormat():
+    global FORMAT
+    with LOCK:
+        while FORMAT not in FORMATS:
+            match input('\n\nSelect the CSV Format:\n\n1. Translator++\n2. Translate All\n'):
+                case '1':
+                    FORMAT = 'translator++'
+                case '2':
+                    FORMAT = 'all'
+
+    spec = dict(FORMATS[FORMAT])
+    if COLUMNS is not None:
+        spec['source'], spec['target'] = [int(column) for column in COLUMNS.split(',')]
+    return spec
+
+# True if the row has text to translate and its target cell isn't skipped. Short rows are padded
+# out to the target column.
+def needsTranslation(row, spec):
+    if len(row) <= spec['source']:
+        return False
+    while len(row) <= spec['target']:
+        row.append('')
+    return not SKIPS[spec['skip']](row[spec['target']])
+
+# Counts lines without holding the file in memory
+def countLines(path):
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+def streamCSV(readFile, writeFile, filename, totalLines, spec):
+    reader = csv.reader(readFile, delimiter=',',)
+    writer = csv.writer(writeFile, delimiter=',', quotechar='\"')
+    rowQueue = collections.deque()  # [Row, Batch] in file order. Batch is None for rows that are ready.
+    history = collections.deque(maxlen=MAXHISTORY)
+    batches = []
+    batch = None
+
+    with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar, \
+        ThreadPoolExecutor(max_workers=THREADS) as executor:
+        pbar.desc=filename
+        try:
+            for row in reader:
+                # Skip already translated lines
+                if needsTranslation(row, spec):
+                    if batch is None or batch['future'] is not None:
+                        batch = {'rows': [], 'history': list(history), 'spec': spec, 'filename': filename, 'future': None}
+                        batches.append(batch)
+                    batch['rows'].append(row)
+                    rowQueue.append([row, batch])
+                    if len(batch['rows']) == BATCHSIZE:
+                        sendBatch(executor, batch)
+                else:
+                    rowQueue.append([row, None])
+                history.append(row[spec['source']] if len(row) > spec['source'] else '')
+                writeRows(rowQueue, writer, pbar, executor, False)
+            writeRows(rowQueue, writer, pbar, executor, True)
+        except Exception as e:
+            tracebackLineNo = str(traceback.extract_tb(sys.exc_info()[2])[-1].lineno)
+            return [reader, countBatchTokens(batches), e, tracebackLineNo]
+    return [reader, countBatchTokens(batches), None]
+
+# Tokens of every batch that finished
+def countBatchTokens(batches):
+    finished = [batch['future'] for batch in batches if batch['future'] is not None and batch['future'].done()]
+    return sum([future.result() for future in finished if future.exception() is None])
+
+def sendBatch(executor, batch):
+    batch['future'] = executor.submit(engine.metrics.bind(translateRows), batch['rows'], batch['history'], batch['spec'], batch['filename'])
+
+# Writes rows from the front of the queue for as long as they are ready. flush waits on (and sends)
+# everything, which is also what happens once the queue is longer than MAXQUEUE.
+def writeRows(rowQueue, writer, pbar, executor, flush):
+    while len(rowQueue) > 0:
+        row, batch = rowQueue[0]
+        if batch is not None:
+            wait = flush or len(rowQueue) > MAXQUEUE
+            if batch['future'] is None:
+                if not wait:
+                    return
+                sendBatch(executor, batch)
+            if not batch['future'].done() and not wait:
+                return
+            batch['future'].result()
+        rowQueue.popleft()
+        if not ESTIMATE:
+            writer.writerow(row)
+        pbar.update(1)
+
+# Translates the source column of the rows in one <LineN> batch. Returns the tokens used.
+def translateRows(rows, history, spec, filename):
+    source = spec['source']
+    target = spec['target']
+
+    # One line per row in the batch (Textwrap below redoes the line breaks anyway)
+    jaList = [re.sub(r'([\u3000-\uffef])\1{2,}', r'\1\1', row[source]).replace('\n', ' ') for row in rows]
+    response = translateBatchGPT(jaList, 'Previous text for context: ' + ' '.join(history))
+
+    # Rows that didn't come back keep their text and the file goes in MISMATCH
+    for row, translatedText in zip(rows, response[0]):
+        if translatedText is None:
+            with LOCK:
+                if filename not in MISMATCH:
+                    MISMATCH.append(filename)
+            continue
+
+        # Check if there is an actual difference first
+        if translatedText == row[source]:
+            translatedText = row[target]
+        row[target] = textwrap.fill(translatedText, width=WIDTH)
+    return response[1]
+
+def translateCSV(row, pbar, writer, textHistory, spec):
     translatedText = ''
     maxHistory = MAXHISTORY
     tokens = 0
+    text = ''
+    source = spec['source']
+    target = spec['target']
     global LOCK, ESTIMATE
 
     try:
-        match format:
-            # Japanese Text on column 1. English on Column 2
-            case '1':
-                # Skip already translated lines
-                if row[1] == '' or re.search(r'[一-龠]+|[ぁ-ゔ]+|[ァ-ヴ]+|[\uFF00-\uFFEF]', row[1]):
-                    jaString = row[0]
-
-                    # Remove repeating characters because it confuses ChatGPT
-                    jaString = re.sub(r'([\u3000-\uffef])\1{2,}', r'\1\1', jaString)
-
-                    # Translate
-                    response = translateGPT(jaString, 'Previous text for context: ' + ' '.join(textHistory), True)
-
-                    # Check if there is an actual difference first
-                    if response[0] != row[0]:
-                        translatedText = response[0]
-                    else:
-                        translatedText = row[1]
-                    tokens += response[1]
-
-                    # Textwrap
-                    translatedText = textwrap.fill(translatedText, width=WIDTH)
-
-                    # Set Data
-                    row[1] = translatedText
-
-                    # Keep textHistory list at length maxHistory
-                    with LOCK:
-                        if len(textHistory) > maxHistory:
-                            textHistory.pop(0)
-                        if not ESTIMATE:
-                            writer.writerow(row)
-                        pbar.update(1)
-
-                    # TextHistory is what we use to give GPT Context, so thats appended here.
-                    textHistory.append('\"' + translatedText + '\"')
-                
-            # Translate Everything
-            case '2':
-                for i in range(len(row)):
-                    # This will allow you to ignore certain columns
-                    if i not in [1]:
-                        continue
-                    jaString = row[i]
-                    matchList = re.findall(r':name\[(.+?),.+?\](.+?[」）\"。]+)', jaString)
-
-                    # Start Translation
-                    for match in matchList:
-                        speaker = match[0]
-                        text = match[1]
-
-                        # Translate Speaker
-                        response = translateGPT (speaker, 'Reply with the '+ LANGUAGE +' translation of the NPC name.', True)
-                        translatedSpeaker = response[0]
-                        tokens += response[1]
-
-                        # Translate Line
-                        jaText = re.sub(r'([\u3000-\uffef])\1{3,}', r'\1\1\1', text)
-                        response = translateGPT(translatedSpeaker + ': ' + jaText, 'Previous Translated Text: ' + '|'.join(textHistory), True)
-                        translatedText = response[0]
-                        tokens += response[1]
-
-                        # TextHistory is what we use to give GPT Context, so thats appended here.
-                        textHistory.append(translatedText)
-
-                        # Remove Speaker from translated text
-                        translatedText = re.sub(r'.+?: ', '', translatedText)
-
-                        # Set Data
-                        translatedSpeaker = translatedSpeaker.replace('\"', '')
-                        translatedText = translatedText.replace('\"', '')
-                        translatedText = translatedText.replace('「', '')
-                        translatedText = translatedText.replace('」', '')
-                        row[i] = row[i].replace('\n', ' ')
-
-                        # Textwrap
-                        translatedText = textwrap.fill(translatedText, width=WIDTH)
-
-                        translatedText = '「' + translatedText + '」'
-                        row[i] = re.sub(rf':name\[({re.escape(speaker)}),', f':name[{translatedSpeaker},', row[i])
-                        row[i] = row[i].replace(text, translatedText)
-
-                        # Keep History at fixed length.
-                        with LOCK:
-                            if len(textHistory) > maxHistory:
-                                textHistory.pop(0)
-
-                    with LOCK:
-                        if not ESTIMATE:
-                            writer.writerow(row)
-                pbar.update(1)
+        # Japanese Text on the source column. English on the target column (Skip already translated lines)
+        if not spec['speakers'] and needsTranslation(row, spec):
+            jaString = row[source]
+
+            # Remove repeating characters because it confuses ChatGPT
+            jaString = re.sub(r'([\u3000-\uffef])\1{2,}', r'\1\1', jaString)
+
+            # Translate
+            response = translateGPT(jaString, 'Previous text for context: ' + ' '.join(textHistory), True)
+
+            # Check if there is an actual difference first
+            if response[0] != row[source]:
+                translatedText = response[0]
+            else:
+                translatedText = row[target]
+            tokens += response[1]
+
+            # Textwrap
+            translatedText = textwrap.fill(translatedText, width=WIDTH)
+
+            # Set Data
+            row[target] = translatedText
+
+            # Keep textHistory list at length maxHistory
+            with LOCK:
+                if len(textHistory) > maxHistory:
+                    textHistory.pop(0)
+
+            # TextHistory is what we use to give GPT Context, so thats appended here.
+            textHistory.append('\"' + translatedText + '\"')
+
+        # Translate the speaker lines in the cell
+        elif needsTranslation(row, spec):
+            i = target
+            row[i] = row[source]
+            jaString = row[i]
+            matchList = re.findall(r':name\[(.+?),.+?\](.+?[」）\"。]+)', jaString)
+
+            # Start Translation
+            for match in matchList:
+                speaker = match[0]
+                text = match[1]
+
+                # Translate Speaker
+                response = translateGPT (speaker, 'Reply with the '+ LANGUAGE +' translation of the NPC name.', True)
+                translatedSpeaker = response[0]
+                tokens += response[1]
+
+                # Translate Line
+                jaText = re.sub(r'([\u3000-\uffef])\1{3,}', r'\1\1\1', text)
+                response = translateGPT(translatedSpeaker + ': ' + jaText, 'Previous Translated Text: ' + '|'.join(textHistory), True)
+                translatedText = response[0]
+                tokens += response[1]
+
+                # TextHistory is what we use to give GPT Context, so thats appended here.
+                textHistory.append(translatedText)
+
+                # Remove Speaker from translated text
+                translatedText = re.sub(r'.+?: ', '', translatedText)
+
+                # Set Data
+                translatedSpeaker = translatedSpeaker.replace('\"', '')
+                translatedText = translatedText.replace('\"', '')
+                translatedText = translatedText.replace('「', '')
+                translatedText = translatedText.replace('」', '')
+                row[i] = row[i].replace('\n', ' ')
+
+                # Textwrap
+                translatedText = textwrap.fill(translatedText, width=WIDTH)
+
+                translatedText = '「' + translatedText + '」'
+                row[i] = re.sub(rf':name\[({re.escape(speaker)}),', f':name[{translatedSpeaker},', row[i])
+                row[i] = row[i].replace(text, translatedText)
+
+                # Keep History at fixed length.
+                with LOCK:
+                    if len(textHistory) > maxHistory:
+                        textHistory.pop(0)
+
+        with LOCK:
+            if not ESTIMATE:
+                writer.writerow(row)
+        pbar.update(1)
 
     except Exception as e:
         traceback.print_exc()
         tracebackLineNo = str(traceback.extract_tb(sys.exc_info()[2])[-1].lineno)
         raise Exception(str(e) + '|Line:' + tracebackLineNo + '| Failed to translate: ' + text) 
-    
-    return tokens
-    
 
-def subVars(jaString):
-    jaString = jaString.replace('\u3000', ' ')
-
-    # Icons
-    count = 0
-    iconList = re.findall(r'[\\]+[iI]\[[0-9]+\]', jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, '<I' + str(count) + '>')
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r'[\\]+[cC]\[[0-9]+\]', jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, '<C' + str(count) + '>')
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r'[\\]+[nN]\[[0-9]+\]', jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, '<N' + str(count) + '>')
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r'[\\]+[vV]\[[0-9]+\]', jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, '<V' + str(count) + '>')
-            count += 1
-
-    # Formatting
-    count = 0
-    formatList = re.findall(r'[\\]+[!.]', jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for format in formatList:
-            jaString = jaString.replace(format, '<F' + str(count) + '>')
-            count += 1
-
-    # Put all lists in list and return
-    allList = [iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r'<\s?.+?\s?>', translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Icons
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace('<I' + str(count) + '>', var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace('<C' + str(count) + '>', var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace('<N' + str(count) + '>', var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace('<V' + str(count) + '>', var)
-            count += 1
-    
-    # Formatting
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace('<F' + str(count) + '>', var)
-            count += 1
+    return tokens
 
-    return translatedText
 
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(t, history, fullPromptFlag):
+    # Translation Memory
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memory = tlcache.getTranslation(__name__, t, history, memoryPrompt)
+    if memory is not None:
+        return [memory, 0]
+
     # If ESTIMATE is True just count this as an execution and return.
     if ESTIMATE:
-        enc = tiktoken.encoding_for_model(MODEL)
-        tokens = len(enc.encode(t)) * 2 + len(enc.encode(str(history))) + len(enc.encode(PROMPT))
+        counts = engine.tokens.countBatch([t, str(history), PROMPT])
+        tokens = counts[0] * 2 + counts[1] + counts[2]
+        engine.estimate.record(1, [counts[1] + counts[2], counts[0] * 2])
         return (t, tokens)
     
     # Sub Vars
-    varResponse = subVars(t)
+    varResponse = codec.subVars(t, 'csv')
     subbedT = varResponse[0]
 
     # If there isn't any Japanese in the text just skip
@@ -339,14 +387,7 @@ def translateGPT(t, history, fullPromptFlag):
         return(t, 0)
 
     # Characters
-    context = '```\
-        Game Characters:\
-        Character: 池ノ上 拓海 == Ikenoue Takumi - Gender: Male\
-        Character: 福永 こはる == Fukunaga Koharu - Gender: Female\
-        Character: 神泉 理央 == Kamiizumi Rio - Gender: Female\
-        Character: 吉祥寺 アリサ == Kisshouji Arisa - Gender: Female\
-        Character: 久我 友里子 == Kuga Yuriko - Gender: Female\
-        ```'
+    context = CHARACTERS
 
     # Prompt
     if fullPromptFlag:
@@ -357,23 +398,14 @@ def translateGPT(t, history, fullPromptFlag):
         user = 'Line to Translate = ' + subbedT
 
     # Create Message List
-    msg = []
-    msg.append({"role": "system", "content": system})
-    msg.append({"role": "user", "content": context})
-    if isinstance(history, list):
-        for line in history:
-            msg.append({"role": "user", "content": line})
-    else:
-        msg.append({"role": "user", "content": history})
-    msg.append({"role": "user", "content": user})
+    msg = engine.prompt.build(system, context, history, user, 'user')
 
-    response = openai.ChatCompletion.create(
+    response = engine.complete(
         temperature=0.1,
         frequency_penalty=0.2,
         presence_penalty=0.2,
         model=MODEL,
         messages=msg,
-        request_timeout=TIMEOUT,
     )
 
     # Save Translated Text
@@ -381,7 +413,7 @@ def translateGPT(t, history, fullPromptFlag):
     tokens = response.usage.total_tokens
 
     # Resub Vars
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
 
     # Remove Placeholder Text
     translatedText = translatedText.replace(LANGUAGE +' Translation: ', '')
@@ -401,4 +433,67 @@ def translateGPT(t, history, fullPromptFlag):
     if len(translatedText) > 15 * len(t) or "I'm sorry, but I'm unable to assist with that translation" in translatedText:
         raise Exception
     else:
+        tlcache.setTranslation(__name__, t, history, memoryPrompt, translatedText)
         return [translatedText, tokens]
+
+# <LineN> batch version of translateGPT for streamCSV. Returns [translatedList, tokens].
+@retry(exceptions=Exception, tries=5, delay=5)
+def translateBatchGPT(textList, history):
+    return translateBatchGPTOnce(textList, history)
+
+# translateBatchGPT without the retry, for the halves recover sends again
+def translateBatchGPTOnce(textList, history):
+    # Translation Memory, rows without Japanese are kept as they are
+    memoryList = tlcache.getBatch(__name__, textList, history, PROMPT)
+    for i in range(len(textList)):
+        if memoryList[i] is None and not re.search(r'[一-龠]+|[ぁ-ゔ]+|[ァ-ヴ]+|[\uFF00-\uFFEF]', codec.subVars(textList[i], 'csv')[0]):
+            memoryList[i] = textList[i]
+    sourceList = [textList[i] for i in range(len(textList)) if memoryList[i] is None]
+    if len(sourceList) == 0:
+        return [memoryList, 0]
+
+    # Sub Vars
+    payload = '\n'.join([f'<Line{i}>`{item}`</Line{i}>' for i, item in enumerate(sourceList)])
+    varResponse = codec.subVars(payload, 'csv')
+    subbedT = varResponse[0]
+
+    # If ESTIMATE is True just count this as an execution and return.
+    if ESTIMATE:
+        counts = engine.tokens.countBatch([subbedT, str(history), PROMPT])
+        engine.estimate.record(len(sourceList), [counts[1] + counts[2], counts[0] * 2])
+        return [textList, counts[0] * 2 + counts[1] + counts[2]]
+
+    # Create Message List
+    msg = engine.prompt.build(PROMPT, CHARACTERS, history, subbedT, 'user')
+
+    response = engine.complete(
+        temperature=0.1,
+        frequency_penalty=0.2,
+        presence_penalty=0.2,
+        model=MODEL,
+        messages=msg,
+    )
+    tokens = response.usage.total_tokens
+
+    # Resub Vars and pull out each line
+    translatedText = codec.resubVars(response.choices[0].message.content, varResponse[1])
+    translatedText = translatedText.replace('っ', '')
+    translatedTextList = [line for line in translatedText.split('\n') if line]
+    translatedList = [re.search(engine.batch.PATTERN, line).group(2) for line in translatedTextList if re.search(engine.batch.PATTERN, line)]
+
+    # Mismatch, keep the lines that came back under their own <LineN> and send the rest again
+    if len(translatedList) != len(sourceList) and len(sourceList) > 1:
+        def translateSubList(subList):
+            subResponse = translateBatchGPTOnce(subList, history)
+            return [subResponse[0], [subResponse[1], 0]]
+
+        lines = engine.batch.indexLines(translatedTextList, len(sourceList))
+        recovered = engine.batch.recover(sourceList, lines, translateSubList)
+        tokens += recovered[1][0]
+        translatedList = recovered[0]
+
+    # A single line that didn't come back is left as a gap too
+    elif len(translatedList) != len(sourceList):
+        translatedList = [None] * len(sourceList)
+
+    return [tlcache.fillBatch(__name__, memoryList, textList, translatedList, history, PROMPT), tokens]
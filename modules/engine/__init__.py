@@ -0,0 +1,2 @@
+from modules.engine import batch, estimate, metrics, prompt, tokens
+from modules.engine.dispatch import submit, complete
@@ -0,0 +1,46 @@
+# Libraries
+import re
+from modules.engine import metrics
+
+# Batches are sent as <LineN>`text`</LineN> lines. When the reply has the wrong number of lines
+# (merged, dropped or split lines) the batch used to be thrown away whole. Instead the lines that
+# came back under their own <LineN> are kept and only the rest are sent again, in halves, with each
+# half going back through translateGPT (and so through this again) until it is down to single lines.
+
+#Globals
+PATTERN = r'<Line(\d+)>[\\]*`?(.*?)[\\]*?`?</Line\d+>'
+
+# Lines of a mismatched reply by their <LineN> number. An index that is out of range or shows up
+# twice can't be trusted and is left as None.
+def indexLines(translatedTextList, size, pattern=PATTERN):
+    lines = [None] * size
+    counts = [0] * size
+    for text in translatedTextList:
+        match = re.search(pattern, text)
+        if match is not None and int(match.group(1)) < size:
+            lines[int(match.group(1))] = match.group(2)
+            counts[int(match.group(1))] += 1
+    lines = [lines[i] if counts[i] == 1 else None for i in range(size)]
+
+    # A line that went missing was usually merged into the one before it, so that one goes again too
+    return [None if i + 1 < size and lines[i + 1] is None and counts[i + 1] == 0 else lines[i] for i in range(size)]
+
+# Sends the missing lines again. translate takes a list of source lines and returns
+# [translatedList, [inputTokens, outputTokens]]. Returns [lines, tokens], lines still holding None for
+# anything that didn't come back even on its own.
+def recover(sourceList, lines, translate):
+    request = metrics.lastRequest()
+    tokens = [0, 0]
+    missing = [i for i in range(len(lines)) if lines[i] is None]
+    half = (len(missing) + 1) // 2
+    for chunk in [missing[:half], missing[half:]]:
+        if len(chunk) == 0:
+            continue
+        response = translate([sourceList[i] for i in chunk])
+        tokens[0] += response[1][0]
+        tokens[1] += response[1][1]
+        if len(response[0]) == len(chunk):
+            for i, line in zip(chunk, response[0]):
+                lines[i] = line
+    metrics.mismatch(request, len(lines), len(missing), lines.count(None))
+    return [lines, tokens]
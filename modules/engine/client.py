@@ -0,0 +1,26 @@
+# Libraries
+import os, httpx, openai
+from dotenv import load_dotenv
+
+# Open AI
+load_dotenv()
+API = str(os.getenv('api')).replace(' ', '')
+KEY = os.getenv('key')
+ORGANIZATION = os.getenv('organization', os.getenv('org'))
+TIMEOUT = int(os.getenv('timeout', '120'))
+
+# One pooled HTTP client for the whole run. Every request from every file goes through the same
+# connection pool, so keep-alive connections are reused instead of opening one per thread.
+def createClient(connections):
+    httpClient = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        timeout=TIMEOUT,
+    )
+    return openai.AsyncOpenAI(
+        api_key=KEY,
+        organization=ORGANIZATION,
+        base_url=API if API not in ['', 'None'] else None,
+        timeout=TIMEOUT,
+        max_retries=0,  # Retries are handled by translateGPT
+        http_client=httpClient,
+    )
@@ -0,0 +1,98 @@
+# Libraries
+import asyncio, os, threading, openai
+from modules.engine import metrics, ratelimit
+from modules.engine.client import createClient
+from modules.engine.tokens import estimateRequest
+from dotenv import load_dotenv
+
+# The engine runs a single asyncio event loop on a background thread. Modules keep their blocking
+# translateGPT, but instead of each thread holding its own HTTP call they drop a work item on one
+# shared queue and wait on a future. A dispatcher pulls items off the queue and runs them under a
+# semaphore, so the number of requests in flight is bounded by CONCURRENCY rather than by how many
+# threads happen to exist. Before a request goes out it also has to fit in the rate limit budget.
+
+#Globals
+load_dotenv()
+CONCURRENCY = int(os.getenv('engineConcurrency') or max(int(os.getenv('fileThreads', '1')) * int(os.getenv('threads', '1')), 1))
+LOCK = threading.Lock()
+LOOP = None
+QUEUE = None
+
+def getLoop():
+    global LOOP
+    with LOCK:
+        if LOOP is None:
+            ready = threading.Event()
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=runLoop, args=(loop, ready), name='engine', daemon=True)
+            thread.start()
+            ready.wait()
+            LOOP = loop
+    return LOOP
+
+def runLoop(loop, ready):
+    global QUEUE
+    asyncio.set_event_loop(loop)
+    QUEUE = asyncio.Queue()
+    loop.create_task(dispatcher())
+    loop.call_soon(ready.set)
+    loop.run_forever()
+
+async def dispatcher():
+    client = createClient(CONCURRENCY)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    while True:
+        params, estimate, trace, future = await QUEUE.get()
+        await semaphore.acquire()
+        asyncio.get_running_loop().create_task(runItem(client, semaphore, params, estimate, trace, future))
+
+async def runItem(client, semaphore, params, estimate, trace, future):
+    response = None
+    status = None
+    error = None
+    attempt = 0
+    try:
+        while not future.cancelled():
+            await ratelimit.acquire(estimate)
+            try:
+                rawResponse = await client.chat.completions.with_raw_response.create(**params)
+            except openai.RateLimitError as e:
+                # Requeue behind the shared pause instead of failing the caller
+                status = e.status_code
+                attempt += 1
+                if attempt >= ratelimit.MAXRETRIES:
+                    raise
+                ratelimit.backoff(e.response.headers if e.response is not None else None, attempt)
+                continue
+            status = rawResponse.status_code
+            response = rawResponse.parse()
+            usage = getattr(response, 'usage', None)
+            ratelimit.update(rawResponse.headers, estimate, usage.total_tokens if usage is not None else None)
+            if not future.cancelled():
+                future.set_result(response)
+            break
+    except Exception as e:
+        status = getattr(e, 'status_code', status)
+        error = e
+        if not future.cancelled():
+            future.set_exception(e)
+    finally:
+        metrics.end(trace, response, status, attempt, error)
+        semaphore.release()
+        QUEUE.task_done()
+
+async def enqueue(params, estimate, trace):
+    future = asyncio.get_running_loop().create_future()
+    await QUEUE.put((params, estimate, trace, future))
+    return await future
+
+# Queue a chat completion. Returns a concurrent.futures.Future
+def submit(**params):
+    # Count tokens on the calling thread so the event loop isn't stuck encoding
+    estimate = estimateRequest(params['messages'])
+    trace = metrics.begin(params)
+    return asyncio.run_coroutine_threadsafe(enqueue(params, estimate, trace), getLoop())
+
+# Queue a chat completion and wait for the response
+def complete(**params):
+    return submit(**params).result()
@@ -0,0 +1,55 @@
+# Libraries
+import threading
+from colorama import Fore
+
+# Cost estimation runs the same extraction and batching as a real translation but never sends a
+# request. Each batch that would have been sent is recorded here against the file being estimated,
+# so the run ends with a per file and per batch report. main.py estimates one file at a time and
+# sets FILE before each one.
+
+#Globals
+LOCK = threading.Lock()
+FILE = ''
+BATCHES = []    # [File, Lines, Input Tokens, Output Tokens]
+
+def record(lines, tokens):
+    with LOCK:
+        BATCHES.append([FILE, lines, tokens[0], tokens[1]])
+
+def getCost(tokens, inputCost, outputCost):
+    return tokens[0] * .001 * inputCost + tokens[1] * .001 * outputCost
+
+# Per file totals in the order the files were estimated
+def summarize():
+    files = {}
+    for filename, lines, inputTokens, outputTokens in BATCHES:
+        if filename not in files:
+            files[filename] = [0, 0, 0, 0]
+        files[filename][0] += 1
+        files[filename][1] += lines
+        files[filename][2] += inputTokens
+        files[filename][3] += outputTokens
+    return files
+
+def report(inputCost, outputCost):
+    files = summarize()
+    width = max([len(filename) for filename in files] + [4])
+    reportString = Fore.YELLOW + 'File'.ljust(width) + '  Requests     Lines     Input    Output      Cost\n'
+    total = [0, 0, 0, 0]
+    for filename, counts in files.items():
+        reportString += filename.ljust(width) + ''.join([str(count).rjust(10) for count in counts])
+        reportString += '${:,.4f}'.format(getCost(counts[2:], inputCost, outputCost)).rjust(10) + '\n'
+        total = [total[i] + counts[i] for i in range(4)]
+    reportString += 'TOTAL'.ljust(width) + ''.join([str(count).rjust(10) for count in total])
+    reportString += '${:,.4f}'.format(getCost(total[2:], inputCost, outputCost)).rjust(10) + Fore.RESET
+    return reportString
+
+# One row per batch
+def writeBatches(path, inputCost, outputCost):
+    with open(path, 'w', encoding='utf-8') as outFile:
+        outFile.write('file,batch,lines,input,output,cost\n')
+        batchNumbers = {}
+        for filename, lines, inputTokens, outputTokens in BATCHES:
+            batchNumbers[filename] = batchNumbers.get(filename, 0) + 1
+            cost = getCost([inputTokens, outputTokens], inputCost, outputCost)
+            outFile.write(f'{filename},{batchNumbers[filename]},{lines},{inputTokens},{outputTokens},{cost:.6f}\n')
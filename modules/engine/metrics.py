@@ -0,0 +1,153 @@
+# Libraries
+import itertools, json, os, re, threading, time
+from dotenv import load_dotenv
+from modules import journal
+
+# Per request metrics. Every request the engine sends is written as a JSON line to TRACEFILE with the
+# engine module, file and event code it was made for, the batch size, tokens, latency, retries and
+# HTTP status. Batches that came back with the wrong number of lines add a 'mismatch' line pointing at
+# their request. Totals per engine/file/code are kept in memory and written to PROMFILE in the
+# Prometheus text format (e.g. for node_exporter's textfile collector) after every file.
+#
+# The engine, file and code come from a thread local context. main sets the engine and file for each
+# file thread, modules set the code as they go, and bind carries the context over to worker threads.
+
+#Globals
+load_dotenv()
+TRACEFILE = os.getenv('traceFile', 'cache/trace.jsonl')
+PROMFILE = os.getenv('metricsFile', 'cache/metrics.prom')
+LOCK = threading.Lock()
+LOCAL = threading.local()
+IDS = itertools.count(1)
+TRACE = None
+TOTALS = {}     # (Engine, File, Code) -> Totals
+METRICS = [
+    ['requests', 'Requests sent'],
+    ['errors', 'Requests that failed'],
+    ['retries', 'Requests sent again after a rate limit'],
+    ['lines', 'Lines sent in <LineN> batches (1 for single strings)'],
+    ['prompt_tokens', 'Prompt tokens used'],
+    ['cached_tokens', 'Prompt tokens the provider served from its prompt cache'],
+    ['completion_tokens', 'Completion tokens used'],
+    ['seconds', 'Seconds from queueing a request to its response'],
+    ['mismatches', 'Batches that came back with the wrong number of lines'],
+    ['mismatch_lines_lost', 'Lines of mismatched batches that could not be recovered'],
+]
+
+def getContext():
+    if not hasattr(LOCAL, 'context'):
+        LOCAL.context = {'engine': None, 'file': None, 'code': None}
+    return LOCAL.context
+
+def setContext(**fields):
+    getContext().update(fields)
+
+# Wraps fn so it runs with the context of the thread that called bind (For executor.submit)
+def bind(fn):
+    context = dict(getContext())
+
+    def run(*args, **kwargs):
+        previous = getContext()
+        LOCAL.context = dict(context)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            LOCAL.context = previous
+    return run
+
+# Called by the engine on the requesting thread before the request is queued
+def begin(params):
+    content = str(params['messages'][-1]['content']) if len(params['messages']) > 0 else ''
+    trace = dict(getContext())
+    trace['id'] = next(IDS)
+    trace['lines'] = max(len(re.findall(r'<Line\d+>', content)), 1)
+    trace['start'] = time.time()
+    LOCAL.last = trace['id']
+    return trace
+
+# Called by the engine once the request is done, whether it worked or not
+def end(trace, response, status, retries, error=None):
+    usage = getattr(response, 'usage', None)
+    trace['seconds'] = round(time.time() - trace['start'], 3)
+    trace['status'] = status
+    trace['retries'] = retries
+    trace['prompt_tokens'] = usage.prompt_tokens if usage is not None else 0
+    trace['cached_tokens'] = getCachedTokens(usage)
+    trace['completion_tokens'] = usage.completion_tokens if usage is not None else 0
+    if error is not None:
+        trace['error'] = type(error).__name__
+    with LOCK:
+        totals = getTotals(trace)
+        totals['requests'] += 1
+        totals['errors'] += 1 if error is not None else 0
+        totals['retries'] += retries
+        totals['lines'] += trace['lines']
+        totals['prompt_tokens'] += trace['prompt_tokens']
+        totals['cached_tokens'] += trace['cached_tokens']
+        totals['completion_tokens'] += trace['completion_tokens']
+        totals['seconds'] += trace['seconds']
+    write(dict(trace, event='request'))
+
+# usage.prompt_tokens_details is a dict or an object depending on the openai version
+def getCachedTokens(usage):
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        return details.get('cached_tokens') or 0
+    return getattr(details, 'cached_tokens', None) or 0
+
+# Cached and uncached prompt tokens of the run, for the cost summary
+def report():
+    with LOCK:
+        promptTokens = sum([totals['prompt_tokens'] for totals in TOTALS.values()])
+        cachedTokens = sum([totals['cached_tokens'] for totals in TOTALS.values()])
+    share = cachedTokens / promptTokens * 100 if promptTokens > 0 else 0
+    return f'[Cached Input: {cachedTokens}][Uncached Input: {promptTokens - cachedTokens}][{share:.1f}% cached]'
+
+# Id of the last request sent from this thread
+def lastRequest():
+    return getattr(LOCAL, 'last', None)
+
+def mismatch(request, lines, missing, lost):
+    trace = dict(getContext(), event='mismatch', request=request, lines=lines, missing=missing, lost=lost)
+    with LOCK:
+        totals = getTotals(trace)
+        totals['mismatches'] += 1
+        totals['mismatch_lines_lost'] += lost
+    write(trace)
+
+# Caller holds LOCK
+def getTotals(trace):
+    key = (str(trace['engine'] or ''), str(trace['file'] or ''), str(trace['code'] or ''))
+    if key not in TOTALS:
+        TOTALS[key] = {metric[0]: 0 for metric in METRICS}
+    return TOTALS[key]
+
+def write(trace):
+    global TRACE
+    if not TRACEFILE:
+        return
+    trace.pop('start', None)
+    with LOCK:
+        if TRACE is None:
+            if os.path.dirname(TRACEFILE):
+                os.makedirs(os.path.dirname(TRACEFILE), exist_ok=True)
+            TRACE = open(TRACEFILE, 'a', encoding='utf-8')
+        TRACE.write(json.dumps(dict(trace, time=round(time.time(), 3)), ensure_ascii=False) + '\n')
+        TRACE.flush()
+
+def writeProm():
+    if not PROMFILE or len(TOTALS) == 0:
+        return
+    if os.path.dirname(PROMFILE):
+        os.makedirs(os.path.dirname(PROMFILE), exist_ok=True)
+    with LOCK:
+        totals = [[key, dict(value)] for key, value in TOTALS.items()]
+    with journal.openAtomic(PROMFILE, 'w', encoding='utf-8') as outFile:
+        for name, description in METRICS:
+            outFile.write(f'# HELP dazedmtl_{name}_total {description}\n# TYPE dazedmtl_{name}_total counter\n')
+            for (engine, filename, code), values in totals:
+                labels = ','.join([f'{label}="{escapeLabel(value)}"' for label, value in [['engine', engine], ['file', filename], ['code', code]]])
+                outFile.write(f'dazedmtl_{name}_total{{{labels}}} {round(values[name], 3)}\n')
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,29 @@
+# Libraries
+import threading
+
+# Chat messages for a translation request. Providers cache the longest prefix a request shares with
+# the ones before it, so the part that stays the same for the whole run (the prompt and the character
+# list) always goes first, as one system message built once per run, followed by the history and the
+# text to translate. The cached share of the prompt tokens is reported by metrics.
+
+#Globals
+LOCK = threading.Lock()
+PREFIXES = {}   # (System, Characters) -> Message
+
+def getPrefix(system, characters):
+    key = (system, characters)
+    with LOCK:
+        if key not in PREFIXES:
+            content = '\n\n'.join([part.strip('\n') for part in [system, characters] if part])
+            PREFIXES[key] = {"role": "system", "content": content}
+        return PREFIXES[key]
+
+# history is a string or a list of strings, sent as role messages
+def build(system, characters, history, user, role='assistant'):
+    msg = [getPrefix(system, characters)]
+    if isinstance(history, list):
+        msg.extend([{"role": role, "content": line} for line in history if line])
+    elif history:
+        msg.append({"role": role, "content": history})
+    msg.append({"role": "user", "content": user})
+    return msg
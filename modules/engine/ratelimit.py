@@ -0,0 +1,101 @@
+# Libraries
+import asyncio, os, random, re, time
+from dotenv import load_dotenv
+
+# Process-wide requests-per-minute and tokens-per-minute budgets. Every request waits here before
+# it is sent, so fileThreads * threads workers share one quota instead of each firing blindly and
+# sleeping a flat 5s on a 429. Both buckets refill continuously. The limits start from the rpm/tpm
+# env values (or unlimited) and are corrected from the x-ratelimit-* headers of every response.
+# Everything here runs on the engine's event loop thread so no lock is needed.
+
+#Globals
+load_dotenv()
+RPM = float(os.getenv('rpm') or 0)  # 0 means unknown until the first response headers arrive
+TPM = float(os.getenv('tpm') or 0)
+MAXRETRIES = 8
+BUCKETS = {
+    'requests': {'limit': RPM, 'level': RPM, 'updated': time.monotonic()},
+    'tokens': {'limit': TPM, 'level': TPM, 'updated': time.monotonic()},
+}
+PAUSE = [0.0]    # Monotonic time before which nothing is sent (Set after a 429)
+
+def refill(bucket):
+    now = time.monotonic()
+    if bucket['limit'] > 0:
+        bucket['level'] = min(bucket['limit'], bucket['level'] + (now - bucket['updated']) * bucket['limit'] / 60)
+    bucket['updated'] = now
+
+# Seconds until the bucket can cover amount. A request bigger than the whole bucket waits for a full one.
+def waitTime(bucket, amount):
+    if bucket['limit'] <= 0:
+        return 0
+    amount = min(amount, bucket['limit'])
+    if bucket['level'] >= amount:
+        return 0
+    return (amount - bucket['level']) * 60 / bucket['limit']
+
+async def acquire(tokens):
+    while True:
+        wait = PAUSE[0] - time.monotonic()
+        for bucket in BUCKETS.values():
+            refill(bucket)
+        wait = max(wait, waitTime(BUCKETS['requests'], 1), waitTime(BUCKETS['tokens'], tokens))
+        if wait <= 0:
+            if BUCKETS['requests']['limit'] > 0:
+                BUCKETS['requests']['level'] -= 1
+            if BUCKETS['tokens']['limit'] > 0:
+                BUCKETS['tokens']['level'] -= tokens
+            return
+        await asyncio.sleep(wait)
+
+# '1s', '6m0s', '20ms', '0.5s' -> seconds
+def parseDuration(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+def adapt(bucket, limit, remaining):
+    known = bucket['limit'] > 0
+    if limit is not None:
+        bucket['limit'] = float(limit)
+    if remaining is not None and bucket['limit'] > 0:
+        refill(bucket)
+        if known:
+            bucket['level'] = min(bucket['level'], float(remaining))
+        else:
+            bucket['level'] = float(remaining)
+
+# Sync our buckets with what the API says is left
+def update(headers, estimate, usedTokens):
+    adapt(BUCKETS['requests'], headers.get('x-ratelimit-limit-requests'), headers.get('x-ratelimit-remaining-requests'))
+    adapt(BUCKETS['tokens'], headers.get('x-ratelimit-limit-tokens'), headers.get('x-ratelimit-remaining-tokens'))
+
+    # Correct our guess with the real usage when the API doesn't tell us what's left
+    if headers.get('x-ratelimit-remaining-tokens') is None and usedTokens is not None and BUCKETS['tokens']['limit'] > 0:
+        BUCKETS['tokens']['level'] -= usedTokens - estimate
+
+# Hit a 429. Stop everyone until the API says the window resets (Or back off exponentially if it doesn't)
+def backoff(headers, attempt):
+    wait = None
+    if headers is not None:
+        if headers.get('retry-after-ms') is not None:
+            wait = parseDuration(headers.get('retry-after-ms')) / 1000
+        else:
+            wait = parseDuration(headers.get('retry-after'))
+        resets = [parseDuration(headers.get('x-ratelimit-reset-requests')), parseDuration(headers.get('x-ratelimit-reset-tokens'))]
+        resets = [r for r in resets if r is not None]
+        if wait is None and len(resets) > 0:
+            wait = max(resets)
+        for bucket in BUCKETS.values():
+            bucket['level'] = min(bucket['level'], 0)
+    if wait is None:
+        wait = min(60, 2 ** attempt)
+    wait += random.uniform(0, 0.25 * wait + 0.1)
+    PAUSE[0] = max(PAUSE[0], time.monotonic() + wait)
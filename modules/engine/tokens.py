@@ -0,0 +1,64 @@
+# Libraries
+import functools, os, threading, tiktoken
+from dotenv import load_dotenv
+
+#Globals
+load_dotenv()
+MODEL = os.getenv('model')
+LOCK = threading.Lock()
+ENCODER = None
+ENCODERERROR = None
+BATCHTHREADS = max(int(os.getenv('threads', '1')), 1) # Threads encode_batch may use
+
+# tiktoken.encoding_for_model builds the BPE tables on first use, so resolve it once per process.
+# A failed load (No network for the BPE download) is remembered too so it isn't retried on every call.
+def getEncoder():
+    global ENCODER, ENCODERERROR
+    if ENCODER is None and ENCODERERROR is None:
+        with LOCK:
+            if ENCODER is None and ENCODERERROR is None:
+                try:
+                    try:
+                        ENCODER = tiktoken.encoding_for_model(MODEL)
+                    except KeyError:
+                        ENCODER = tiktoken.get_encoding('cl100k_base')
+                except Exception as e:
+                    ENCODERERROR = e
+    if ENCODERERROR is not None:
+        raise ENCODERERROR
+    return ENCODER
+
+# The prompt and character list are the same for every request, so counts are memoized
+@functools.lru_cache(maxsize=4096)
+def countText(text):
+    return len(getEncoder().encode(text))
+
+# Counts many strings with one encode_batch call. Anything long enough to be a prompt goes
+# through the countText cache instead.
+def countBatch(textList):
+    counts = [0] * len(textList)
+    short = []
+    for i, text in enumerate(textList):
+        if len(text) > 500:
+            counts[i] = countText(text)
+        else:
+            short.append(i)
+    if len(short) > 0:
+        encoded = getEncoder().encode_batch([textList[i] for i in short], num_threads=BATCHTHREADS)
+        for i, tokens in zip(short, encoded):
+            counts[i] = len(tokens)
+    return counts
+
+# Only used for budgeting, so if the encoder can't be loaded fall back to a rough character count
+# instead of failing the request.
+def estimateText(text):
+    try:
+        return countText(text)
+    except Exception:
+        return len(text)
+
+# Tokens the request will use (Prompt + expected completion)
+def estimateRequest(messages):
+    promptTokens = estimateText(''.join([str(m['content']) for m in messages])) + 4 * len(messages)
+    userTokens = estimateText(str(messages[-1]['content'])) if len(messages) > 0 else 0
+    return promptTokens + round(userTokens * 1.5)
@@ -0,0 +1,63 @@
+# Libraries
+import os, re
+
+# Kinds of RPG Maker data files. A file is matched by its name first, and when the name matches no
+# kind (Renamed or copied files like 'Map001 - Copy.json') by the keys found in its data. The modules
+# map each kind to their parser in PARSERS, so a new kind is a line here and a line there.
+
+#Globals
+# Kind: [Pattern, Keys, Weight]
+#   Pattern - Regex the file name (without extension) has to match in full
+#   Keys - Keys only this kind has, on the file itself (Map, System) or on each of its entries.
+#          Given in MV/MZ camelCase, ACE files are checked with the snake_case version
+#   Weight - Relative cost of the kind's text, for scheduling (Event dialogue is 1)
+FILEKINDS = {
+    'Map': [r'Map\d+', ['events', 'displayName'], 1],
+    'MapInfos': [r'MapInfos', ['parentId', 'order'], 0.5],
+    'CommonEvents': [r'CommonEvents', ['trigger', 'switchId', 'list'], 1],
+    'Troops': [r'Troops', ['members', 'pages'], 1],
+    'Actors': [r'Actors', ['nickname', 'classId'], 1.5],
+    'Armors': [r'Armors', ['atypeId'], 1.5],
+    'Weapons': [r'Weapons', ['wtypeId'], 1.5],
+    'Classes': [r'Classes', ['learnings', 'expParams'], 1.5],
+    'Enemies': [r'Enemies', ['dropItems'], 1.5],
+    'Items': [r'Items', ['itypeId'], 1.5],
+    'Skills': [r'Skills', ['stypeId'], 1.5],
+    'States': [r'States', ['autoRemovalTiming'], 1.5],
+    'System': [r'System', ['gameTitle'], 2],
+    'Scenario': [r'Scenario', [], 1],
+}
+
+# Kind of the file, or None. data is only needed for files the name doesn't give away.
+def getKind(filename, data=None):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    for kind, [pattern, keys, weight] in FILEKINDS.items():
+        if re.fullmatch(pattern, name):
+            return kind
+
+    if data is not None:
+        for kind, [pattern, keys, weight] in FILEKINDS.items():
+            if len(keys) > 0 and sniff(data, keys):
+                return kind
+    return None
+
+def getWeight(kind):
+    return FILEKINDS[kind][2] if kind in FILEKINDS else 1
+
+def sniff(data, keys):
+    snakeKeys = [re.sub(r'([A-Z])', r'_\1', key).lower() for key in keys]
+    if hasKeys(data, keys) or hasKeys(data, snakeKeys):
+        return True
+
+    # Lists (MV/MZ and most ACE files) or dicts by ID (ACE MapInfos) of entries
+    if isinstance(data, list):
+        entries = [entry for entry in data if entry is not None]
+    elif isinstance(data, dict):
+        entries = [entry for entry in data.values() if entry is not None]
+    else:
+        return False
+    entries = entries[:10]
+    return len(entries) > 0 and (all([hasKeys(entry, keys) for entry in entries]) or all([hasKeys(entry, snakeKeys) for entry in entries]))
+
+def hasKeys(data, keys):
+    return isinstance(data, dict) and all([key in data for key in keys])
@@ -0,0 +1,100 @@
+# Libraries
+import contextlib, hashlib, json, os, threading
+
+# Write-ahead journal of translated units, one per file being translated. Every unit is appended to
+# cache/journal/<file>.jsonl as soon as its translation comes back and the journal is fsync'd every
+# JOURNALBATCH records. If the run dies, the next run replays it so those units aren't paid for again.
+# The journal is removed once the output file has been written. Units of an earlier version of the file
+# (see manifest.py) can be handed to start so the ones whose source didn't change are reused too.
+
+#Globals
+JOURNAL = True
+JOURNALDIR = 'cache/journal'
+JOURNALBATCH = 20   # Records written between fsyncs
+LOCK = threading.Lock()
+JOURNALS = {}
+
+def hashText(textList):
+    return hashlib.sha256('\x00'.join(textList).encode('utf-8')).hexdigest()
+
+# Opens the journal of filename, loading whatever a previous run left in it
+def start(filename, units=None):
+    if not JOURNAL:
+        return
+    os.makedirs(JOURNALDIR, exist_ok=True)
+    path = os.path.join(JOURNALDIR, filename + '.jsonl')
+
+    entries = dict(units or {})
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # The last line may be cut short by the crash
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                entries[record[0]] = record[1]
+
+    with LOCK:
+        JOURNALS[filename] = {'path': path, 'file': open(path, 'a', encoding='utf-8'), 'entries': entries, 'used': set(), 'pending': 0}
+    return len(entries)
+
+# Returns the journaled translations of sourceList or None
+def get(filename, sourceList):
+    with LOCK:
+        if filename not in JOURNALS:
+            return None
+        journal = JOURNALS[filename]
+        key = hashText(sourceList)
+        if key in journal['entries']:
+            journal['used'].add(key)
+        return journal['entries'].get(key)
+
+def put(filename, sourceList, translatedList):
+    key = hashText(sourceList)
+    with LOCK:
+        if filename not in JOURNALS:
+            return
+        journal = JOURNALS[filename]
+        journal['entries'][key] = translatedList
+        journal['used'].add(key)
+        journal['file'].write(json.dumps([key, translatedList], ensure_ascii=False) + '\n')
+        journal['pending'] += 1
+        if journal['pending'] >= JOURNALBATCH:
+            sync(journal)
+
+# Caller holds LOCK
+def sync(journal):
+    journal['file'].flush()
+    os.fsync(journal['file'].fileno())
+    journal['pending'] = 0
+
+# Closes the journal. It is only deleted once the output it covers is safely on disk.
+# Returns the units this run used (Unit hash -> Translation).
+def finish(filename, remove):
+    with LOCK:
+        if filename not in JOURNALS:
+            return None
+        journal = JOURNALS.pop(filename)
+        sync(journal)
+        journal['file'].close()
+    if remove:
+        os.remove(journal['path'])
+    return {key: journal['entries'][key] for key in journal['used']}
+
+# Writes to a temp file next to path and only replaces path once everything is on disk, so a crash
+# never leaves a half written file (or wipes the output of an earlier run).
+@contextlib.contextmanager
+def openAtomic(path, mode='w', **kwargs):
+    tempPath = path + '.tmp'
+    outFile = open(tempPath, mode, **kwargs)
+    try:
+        yield outFile
+        outFile.flush()
+        os.fsync(outFile.fileno())
+        outFile.close()
+        os.replace(tempPath, path)
+    except BaseException:
+        outFile.close()
+        os.remove(tempPath)
+        raise
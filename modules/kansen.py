@@ -1,17 +1,14 @@
 # Libraries
-import json, os, re, textwrap, threading, time, traceback, tiktoken, openai
+import json, os, re, textwrap, threading, time, traceback
 from pathlib import Path
 from colorama import Fore
 from dotenv import load_dotenv
 from retry import retry
 from tqdm import tqdm
+from modules import codec, engine, journal, manifest, tlcache
 
 # Open AI
 load_dotenv()
-if os.getenv('api').replace(' ', '') != '':
-    openai.api_base = os.getenv('api')
-openai.organization = os.getenv('org')
-openai.api_key = os.getenv('key')
 
 #Globals
 MODEL = os.getenv('model')
@@ -76,7 +73,7 @@ def handleKansen(filename, estimate):
     
     else:
         try:
-            with open('translated/' + filename, 'w', encoding='shift_jis', errors='ignore') as outFile:
+            with journal.openAtomic('translated/' + filename, 'w', encoding='shift_jis', errors='ignore') as outFile:
                 start = time.time()
                 translatedData = openFiles(filename)
 
@@ -91,6 +88,10 @@ def handleKansen(filename, estimate):
             traceback.print_exc()
             return 'Fail'
 
+    # Skip this file next run unless its source changes
+    if not estimate and translatedData[2] is None and filename not in MISMATCH:
+        manifest.record(filename)
+
     return getResultString(['', TOKENS, None], end - start, 'TOTAL')
 
 def getResultString(translatedData, translationTime, filename):
@@ -120,13 +121,6 @@ def getResultString(translatedData, translationTime, filename):
 def openFiles(filename):
     with open('files/' + filename, 'r', encoding='cp932') as readFile:
         translatedData = parseTyrano(readFile, filename)
-
-        # Delete lines marked for deletion
-        finalData = []
-        for line in translatedData[0]:
-            if line != '\\d\n':
-                finalData.append(line)
-        translatedData[0] = finalData
     
     return translatedData
 
@@ -137,31 +131,42 @@ def parseTyrano(readFile, filename):
     # Get total for progress bar
     data = readFile.readlines()
     totalLines = len(data)
+    insertedLines = {}
 
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
 
         try:
-            result = translateTyrano(data, pbar, totalLines)
+            result = translateTyrano(data, insertedLines, pbar, totalLines, filename)
             totalTokens[0] += result[0]
             totalTokens[1] += result[1]
         except Exception as e:
             traceback.print_exc()
-            return [data, totalTokens, e]
-    return [data, totalTokens, None]
-
-def translateTyrano(data, pbar, totalLines):
+            return [joinLines(data, insertedLines), totalTokens, e]
+    return [joinLines(data, insertedLines), totalTokens, None]
+
+# Translations are kept apart from data until the end (Index -> Lines that go before that line) since
+# inserting them as we go shifts every line after them. Emptied lines are dropped.
+def joinLines(data, insertedLines):
+    lines = []
+    for i in range(len(data)):
+        if i in insertedLines:
+            lines.extend(insertedLines[i])
+        if data[i] != '':
+            lines.append(data[i])
+    return lines
+
+def translateTyrano(data, insertedLines, pbar, totalLines, filename):
     textHistory = []
     batch = []
+    batchLines = []     # [First line, Last line] of each group in batch
     currentGroup = []
     maxHistory = MAXHISTORY
     tokens = [0,0]
     speaker = ''
-    insertBool = False
     global LOCK, ESTIMATE
     i = 0
-    batchStartIndex = 0
 
     while i < len(data):
         # Speaker
@@ -205,28 +210,23 @@ def translateTyrano(data, pbar, totalLines):
         # Lines
         matchList = re.findall(r'(.+?)\[[rpcms]+\]$', data[i])
         if len(matchList) > 0:
+            groupStart = i
             currentGroup.append(matchList[0])
-            if len(data) > i+1:
-                while '[r]' in data[i+1]:
-                    if insertBool is True:
-                        data[i] = '\d\n'
-                        pbar.update(1)
-                    i += 1
-                    matchList = re.findall(r'(.+?)\[r\]', data[i])
-                    if len(matchList) > 0:
-                        currentGroup.append(matchList[0])
-                while '[pcms]' in data[i+1]:
-                    if insertBool is True:
-                        data[i] = '\d\n'
-                        pbar.update(1)
-                    i += 1
-                    matchList = re.findall(r'(.+?)\[pcms\]', data[i])
-                    if len(matchList) > 0:
-                        currentGroup.append(matchList[0])
+            while len(data) > i+1 and '[r]' in data[i+1]:
+                i += 1
+                pbar.update(1)
+                matchList = re.findall(r'(.+?)\[r\]', data[i])
+                if len(matchList) > 0:
+                    currentGroup.append(matchList[0])
+            while len(data) > i+1 and '[pcms]' in data[i+1]:
+                i += 1
+                pbar.update(1)
+                matchList = re.findall(r'(.+?)\[pcms\]', data[i])
+                if len(matchList) > 0:
+                    currentGroup.append(matchList[0])
+
             # Join up 401 groups for better translation.
-            if len(currentGroup) > 0:
-                finalJAString = ' '.join(currentGroup)
-                oldjaString = finalJAString
+            finalJAString = ' '.join(currentGroup)
 
             # Remove any textwrap
             if FIXTEXTWRAP == True:
@@ -252,84 +252,17 @@ def translateTyrano(data, pbar, totalLines):
             if speaker != '':
                 finalJAString = f'{speaker}: {finalJAString}'
 
-            # [Passthrough 1] Pulling From File
-            if insertBool is False:
-                # Append to List and Clear Values
-                batch.append(finalJAString)
-                speaker = ''
-
-                # Translate Batch if Full
-                if len(batch) == BATCHSIZE:
-                    # Translate
-                    response = translateGPT(batch, textHistory, True)
-                    tokens[0] += response[1][0]
-                    tokens[1] += response[1][1]
-                    translatedBatch = response[0]
-                    textHistory = translatedBatch[-10:]
-
-                    # Set Values
-                    if len(batch) == len(translatedBatch):
-                        i = batchStartIndex
-                        insertBool = True
-
-                    # Mismatch
-                    else:
-                        pbar.write(f'Mismatch: {batchStartIndex} - {i}')
-                        MISMATCH.append(batch)
-                        batchStartIndex = i
-                        batch.clear()
-
-                i += 1
-                if insertBool is True:
-                    pbar.update(1)
-                currentGroup = []
-
-            # [Passthrough 2] Setting Data
-            else:
-                # Get Text
-                translatedText = translatedBatch[0]
-                translatedText = translatedText.replace('\\"', '\"')
-                translatedText = translatedText.replace('[', '(')
-                translatedText = translatedText.replace(']', ')')
-
-                # Remove added speaker
-                translatedText = re.sub(r'^.+?:\s', '', translatedText)
-
-                # Textwrap
-                translatedText = textwrap.fill(translatedText, width=WIDTH)
-                textList = translatedText.split('\n')
-                    
-                # Set Text
-                data[i] = '\d\n'
-                for line in textList:
-                    # Wordwrap Text
-                    if '[r]' not in line:
-                        line = textwrap.fill(line, width=WIDTH)
-                        line = line.replace('\n', '[r]')
-                    
-                    # Set
-                    data.insert(i, line.strip() + '[r]\n')
-                    i+=1
-                data[i-1] = data[i-1].replace('[r]', '[pcms]')
-                translatedBatch.pop(0)
-                speaker = ''
-                currentGroup = []
-
-                # If Batch is empty. Move on.
-                if len(translatedBatch) == 0:
-                    insertBool = False
-                    batchStartIndex = i
-                    batch.clear()
+            # Append to List and Clear Values
+            batch.append(finalJAString)
+            batchLines.append([groupStart, i])
+            speaker = ''
+            currentGroup = []
 
-        # Nothing relevant. Skip Line.
-        else:
-            i += 1
-            if insertBool is True:
-                pbar.update(1)
+        i += 1
+        pbar.update(1)
 
-        # Translate Batch if not empty and EOF
-        if len(batch) != 0 and i >= len(data):
-            # Translate
+        # Translate Batch if Full or EOF
+        if len(batch) == BATCHSIZE or (len(batch) != 0 and i >= len(data)):
             response = translateGPT(batch, textHistory, True)
             tokens[0] += response[1][0]
             tokens[1] += response[1][1]
@@ -337,20 +270,48 @@ def translateTyrano(data, pbar, totalLines):
             textHistory = translatedBatch[-10:]
 
             # Set Values
-            if len(batch) == len(translatedBatch):
-                i = batchStartIndex
-                insertBool = True
+            if len(batch) == len(translatedBatch) and None not in translatedBatch:
+                for translatedText, [first, last] in zip(translatedBatch, batchLines):
+                    setGroup(data, insertedLines, first, last, translatedText)
 
             # Mismatch
             else:
-                pbar.write(f'Mismatch: {batchStartIndex} - {i}')
-                MISMATCH.append(batch)
-                batchStartIndex = i
-                batch.clear()
-
-            currentGroup = []
+                pbar.write(f'Mismatch: {batchLines[0][0]} - {batchLines[-1][1]}')
+                if filename not in MISMATCH:
+                    MISMATCH.append(filename)
+            batch = []
+            batchLines = []
     return tokens
 
+# Writes the translation of the group on lines first to last in front of its last line and empties them
+def setGroup(data, insertedLines, first, last, translatedText):
+    # Get Text
+    translatedText = translatedText.replace('\\"', '\"')
+    translatedText = translatedText.replace('[', '(')
+    translatedText = translatedText.replace(']', ')')
+
+    # Remove added speaker
+    translatedText = re.sub(r'^.+?:\s', '', translatedText)
+
+    # Textwrap
+    translatedText = textwrap.fill(translatedText, width=WIDTH)
+    textList = translatedText.split('\n')
+        
+    # Set Text
+    for j in range(first, last + 1):
+        data[j] = ''
+    translatedLines = []
+    for line in textList:
+        # Wordwrap Text
+        if '[r]' not in line:
+            line = textwrap.fill(line, width=WIDTH)
+            line = line.replace('\n', '[r]')
+        
+        # Set
+        translatedLines.append(line.strip() + '[r]\n')
+    translatedLines[-1] = translatedLines[-1].replace('[r]', '[pcms]')
+    insertedLines.setdefault(last, []).extend(translatedLines)
+
 # Save some money and enter the character before translation
 def getSpeaker(speaker):
     match speaker:
@@ -391,119 +352,6 @@ def getSpeaker(speaker):
         case _:
             return translateGPT(speaker, 'Reply with only the '+ LANGUAGE +' translation of the NPC name.', False)
         
-def subVars(jaString):
-    jaString = jaString.replace('\u3000', ' ')
-
-    # Nested
-    count = 0
-    nestedList = re.findall(r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]', jaString)
-    nestedList = set(nestedList)
-    if len(nestedList) != 0:
-        for icon in nestedList:
-            jaString = jaString.replace(icon, '{Nested_' + str(count) + '}')
-            count += 1
-
-    # Icons
-    count = 0
-    iconList = re.findall(r'[\\]+[iIkKwWaA]+\[[0-9]+\]', jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, '{Ascii_' + str(count) + '}')
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r'[\\]+[cC]\[[0-9]+\]', jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, '{Color_' + str(count) + '}')
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r'[\\]+[nN]\[.+?\]+', jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, '{Noun_' + str(count) + '}')
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r'[\\]+[vV]\[[0-9]+\]', jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, '{Var_' + str(count) + '}')
-            count += 1
-
-    # Formatting
-    count = 0
-    formatList = re.findall(r'[\\]+[\w]+\[.+?\]', jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for var in formatList:
-            jaString = jaString.replace(var, '{FCode_' + str(count) + '}')
-            count += 1
-
-    # Put all lists in list and return
-    allList = [nestedList, iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r'\[\s?.+?\s?\]', translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Nested
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace('{Nested_' + str(count) + '}', var)
-            count += 1
-
-    # Icons
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace('{Ascii_' + str(count) + '}', var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace('{Color_' + str(count) + '}', var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace('{Noun_' + str(count) + '}', var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace('{Var_' + str(count) + '}', var)
-            count += 1
-    
-    # Formatting
-    count = 0
-    if len(allList[5]) != 0:
-        for var in allList[5]:
-            translatedText = translatedText.replace('{FCode_' + str(count) + '}', var)
-            count += 1
-
-    return translatedText
-
 def batchList(input_list, batch_size):
     if not isinstance(batch_size, int) or batch_size <= 0:
         raise ValueError("batch_size must be a positive integer")
@@ -532,21 +380,9 @@ def createContext(fullPromptFlag, subbedT):
     return characters, system, user
 
 def translateText(characters, system, user, history):
-    # Prompt
-    msg = [{"role": "system", "content": system + characters}]
-
-    # Characters
-    msg.append({"role": "system", "content": characters})
-
-    # History
-    if isinstance(history, list):
-        msg.extend([{"role": "assistant", "content": h} for h in history])
-    else:
-        msg.append({"role": "assistant", "content": history})
-    
-    # Content to TL
-    msg.append({"role": "user", "content": f'{user}'})
-    response = openai.chat.completions.create(
+    # Prompt, characters and history (The unchanging part first)
+    msg = engine.prompt.build(system, characters, history, user)
+    response = engine.complete(
         temperature=0.1,
         frequency_penalty=0.1,
         model=MODEL,
@@ -569,7 +405,7 @@ def cleanTranslatedText(translatedText, varResponse):
     for target, replacement in placeholders.items():
         translatedText = translatedText.replace(target, replacement)
 
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
     if '\n' in translatedText:
         return [line for line in translatedText.split('\n') if line]
     else:
@@ -585,22 +421,15 @@ def extractTranslation(translatedTextList, is_list):
         return matchList[0][1] if matchList else translatedTextList
 
 def countTokens(characters, system, user, history):
-    inputTotalTokens = 0
-    outputTotalTokens = 0
-    enc = tiktoken.encoding_for_model(MODEL)
-    
+    if not isinstance(history, list):
+        history = [history]
+
     # Input
-    if isinstance(history, list):
-        for line in history:
-            inputTotalTokens += len(enc.encode(line))
-    else:
-        inputTotalTokens += len(enc.encode(history))
-    inputTotalTokens += len(enc.encode(system))
-    inputTotalTokens += len(enc.encode(characters))
-    inputTotalTokens += len(enc.encode(user))
+    counts = engine.tokens.countBatch(history + [system, characters, user])
+    inputTotalTokens = sum(counts)
 
     # Output
-    outputTotalTokens += round(len(enc.encode(user))/1.5)
+    outputTotalTokens = round(counts[-1]/1.5)
 
     return [inputTotalTokens, outputTotalTokens]
 
@@ -611,10 +440,27 @@ def combineList(tlist, text):
 
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(text, history, fullPromptFlag):
+    return translateGPTOnce(text, history, fullPromptFlag)
+
+# translateGPT without the retry. Lines sent again by recover come back through here, so a request
+# that keeps failing is only retried by the outermost call rather than at every level of the split.
+def translateGPTOnce(text, history, fullPromptFlag):
     totalTokens = [0, 0]
+    translated = False
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memoryHistory = history     # history changes as batches come back
+
+    # Translation Memory
     if isinstance(text, list):
-        tList = batchList(text, BATCHSIZE)
+        memoryList = tlcache.getBatch(__name__, text, memoryHistory, memoryPrompt)
+        sourceList = [text[i] for i in range(len(text)) if memoryList[i] is None]
+        if len(sourceList) == 0:
+            return [memoryList, totalTokens]
+        tList = batchList(sourceList, BATCHSIZE)
     else:
+        memory = tlcache.getTranslation(__name__, text, memoryHistory, memoryPrompt)
+        if memory is not None:
+            return [memory, totalTokens]
         tList = [text]
 
     for index, tItem in enumerate(tList):
@@ -622,10 +468,10 @@ def translateGPT(text, history, fullPromptFlag):
         if isinstance(tItem, list):
             payload = '\n'.join([f'<Line{i}>`{item}`</Line{i}>' for i, item in enumerate(tItem)])
             payload = payload.replace('``', '`Placeholder Text`')
-            varResponse = subVars(payload)
+            varResponse = codec.subVars(payload, 'mvmz')
             subbedT = varResponse[0]
         else:
-            varResponse = subVars(tItem)
+            varResponse = codec.subVars(tItem, 'mvmz')
             subbedT = varResponse[0]
 
         # Things to Check before starting translation
@@ -638,6 +484,7 @@ def translateGPT(text, history, fullPromptFlag):
         # Calculate Estimate
         if ESTIMATE:
             estimate = countTokens(characters, system, user, history)
+            engine.estimate.record(len(tItem) if isinstance(tItem, list) else 1, estimate)
             totalTokens[0] += estimate[0]
             totalTokens[1] += estimate[1]
             continue
@@ -647,19 +494,41 @@ def translateGPT(text, history, fullPromptFlag):
         translatedText = response.choices[0].message.content
         totalTokens[0] += response.usage.prompt_tokens
         totalTokens[1] += response.usage.completion_tokens
+        translated = True
 
         # Formatting
         translatedTextList = cleanTranslatedText(translatedText, varResponse)
         if isinstance(tItem, list):
             extractedTranslations = extractTranslation(translatedTextList, True)
+
+            # Mismatch, keep the lines that came back under their own <LineN> and send the rest again
+            if len(extractedTranslations) != len(tItem) and len(tItem) > 1:
+                lines = engine.batch.indexLines(translatedTextList, len(tItem))
+                response = engine.batch.recover(tItem, lines, lambda sourceList: translateGPTOnce(sourceList, history, fullPromptFlag))
+                totalTokens[0] += response[1][0]
+                totalTokens[1] += response[1][1]
+                extractedTranslations = response[0]
+
+            # A single line that didn't come back is left as a gap too
+            elif len(extractedTranslations) != len(tItem):
+                extractedTranslations = [None] * len(tItem)
             tList[index] = extractedTranslations
             if len(tItem) != len(translatedTextList):
                 mismatch = True     # Just here so breakpoint can be set
-            history = extractedTranslations[-10:]  # Update history if we have a list
+            history = [line for line in extractedTranslations if line is not None][-10:]  # Update history if we have a list
         else:
             # Ensure we're passing a single string to extractTranslation
             extractedTranslations = extractTranslation('\n'.join(translatedTextList), False)
             tList[index] = extractedTranslations
 
     finalList = combineList(tList, text)
+
+    # Save to Translation Memory
+    if isinstance(text, list):
+        if translated:
+            finalList = tlcache.fillBatch(__name__, memoryList, text, finalList, memoryHistory, memoryPrompt)
+        else:
+            finalList = [memoryList[i] if memoryList[i] is not None else text[i] for i in range(len(text))]
+    elif translated:
+        tlcache.setTranslation(__name__, text, memoryHistory, memoryPrompt, finalList)
     return [finalList, totalTokens]
@@ -1,56 +1,67 @@
-import sys, os, traceback
+import argparse, importlib, sys, os, time, traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from colorama import Fore
+from dotenv import load_dotenv
 from tqdm import tqdm
+from modules import engine, manifest, schedule
 
-# This needs to be before the module imports as some of them currently try to read and use some of these values
-# upon import, in which case if they are unset the script will crash before we can output these messages.
-envMissing = False
-for env in ['api','key','organization','model','language','timeout','fileThreads','threads','width','listWidth']:
-    if os.getenv(env) is None or str(os.getenv(env))[:1] == '<':
-        tqdm.write(Fore.RED + f'Environment variable {env} is not set!')
-        envMissing = True
-if envMissing:
-    tqdm.write(Fore.RED + f'Some of the required environment values may not be set correctly. You can set \
-these values using an .env file, for an example see .env.example')
+ESTIMATEFILE = 'estimate.csv'   # Per batch cost report written by estimate mode
 
-from modules.rpgmakermvmz import handleMVMZ
-from modules.rpgmakerace import handleACE
-from modules.csv import handleCSV
-from modules.alice import handleAlice
-from modules.tyrano import handleTyrano
-from modules.json import handleJSON
-from modules.kansen import handleKansen
-from modules.lune2 import handleLuneTxt
-from modules.atelier import handleAtelier
-from modules.anim import handleAnim
-
-# For GPT4 rate limit will be hit if you have more than 1 thread.
-# 1 Thread for each file. Controls how many files are worked on at once.
-THREADS = int(os.getenv('fileThreads'))
-
-# [Display name, file extension, handle function]
+# [Display name, file extension, module, handle function, CLI name, file encoding]
+# Engine modules read prompt.txt and set up their clients on import, so only the chosen one is imported.
 MODULES = [
-    ["RPGMaker MV/MZ", "json", handleMVMZ],
-    ["RPGMaker ACE", "yaml", handleACE],
-    ["CSV (From Translator++)", "csv", handleCSV],
-    ["Alice", "txt", handleAlice],
-    ["Tyrano", "ks", handleTyrano],
-    ["JSON", "json", handleJSON],
-    ["Kansen", "ks", handleKansen],
-    ["Lune", "txt", handleLuneTxt],
-    ["Atelier", "txt", handleAtelier],
-    ["Anim", "json", handleAnim],
+    ["RPGMaker MV/MZ", "json", "modules.rpgmakermvmz", "handleMVMZ", "mvmz", "utf-8-sig"],
+    ["RPGMaker ACE", "yaml", "modules.rpgmakerace", "handleACE", "ace", "utf-8"],
+    ["CSV (From Translator++)", "csv", "modules.csv", "handleCSV", "csv", "utf-8"],
+    ["Alice", "txt", "modules.alice", "handleAlice", "alice", "utf-8"],
+    ["Tyrano", "ks", "modules.tyrano", "handleTyrano", "tyrano", "utf-8"],
+    ["JSON", "json", "modules.json", "handleJSON", "json", "utf-8-sig"],
+    ["Kansen", "ks", "modules.kansen", "handleKansen", "kansen", "cp932"],
+    ["Lune", "txt", "modules.lune2", "handleLuneTxt", "lune", "shiftjis"],
+    ["Atelier", "txt", "modules.atelier", "handleAtelier", "atelier", "utf-8"],
+    ["Anim", "json", "modules.anim", "handleAnim", "anim", "utf-8-sig"],
 ]
 
-# Info Message
-tqdm.write(Fore.LIGHTYELLOW_EX + "WARNING: Once the translation starts do not close it unless you want to lose your \
+def getHandler(version):
+    return getattr(importlib.import_module(MODULES[version][2]), MODULES[version][3])
+
+def checkEnv():
+    # This needs to be before the module import as some of them currently try to read and use some of these values
+    # upon import, in which case if they are unset the script will crash before we can output these messages.
+    envMissing = False
+    for env in ['api','key','organization','model','language','timeout','fileThreads','threads','width','listWidth']:
+        if os.getenv(env) is None or str(os.getenv(env))[:1] == '<':
+            tqdm.write(Fore.RED + f'Environment variable {env} is not set!')
+            envMissing = True
+    if envMissing:
+        tqdm.write(Fore.RED + f'Some of the required environment values may not be set correctly. You can set \
+these values using an .env file, for an example see .env.example')
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Translate game files with an LLM. Anything not given is asked for.')
+    parser.add_argument('-e', '--engine', choices=[module[4] for module in MODULES], help='Game engine of the files')
+    parser.add_argument('-m', '--mode', choices=['translate', 'estimate'], help='Translate or only estimate the cost')
+    parser.add_argument('-f', '--force', action='store_true', help='Translate files even if they are unchanged since the last run')
+    parser.add_argument('-d', '--dir', help='Folder with .env, prompt.txt, /files and /translated (Default: current folder)')
+    parser.add_argument('files', nargs='*', help='Files in /files to work on (Default: every file of the engine)')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    if args.dir:
+        os.chdir(args.dir)
+    load_dotenv()
+    checkEnv()
+
+    # Info Message
+    tqdm.write(Fore.LIGHTYELLOW_EX + "WARNING: Once the translation starts do not close it unless you want to lose your \
 translated data. If a file fails or gets stuck, translated lines will remain translated so you don't have \
 to worry about being charged twice. You can simply copy the file generated in /translations back over to \
 /files and start the script again. It will skip over any translated text." + Fore.RESET, end='\n\n')
 
-def main():
     estimate = ''
+    if args.mode is not None:
+        estimate = args.mode == 'estimate'
     while estimate == '':
         estimate = input('Select Translation or Cost Estimation:\n\n 1. Translate\n 2. Estimate\n')
         match estimate:
@@ -60,9 +71,11 @@ def main():
                 estimate = True
             case _:
                 estimate = ''
-    
+
     version = ''
-    while True:
+    if args.engine is not None:
+        version = [module[4] for module in MODULES].index(args.engine)
+    while version == '':
         tqdm.write("Select game engine:\n")
         for position, module in enumerate(MODULES):
             tqdm.write(f'{str(position + 1).rjust(2)}. {module[0]} (.{module[1]})')
@@ -70,34 +83,86 @@ def main():
         try:
             version = int(version) - 1
         except:
+            version = ''
             continue
-        if version in range(len(MODULES)):
-            break    
+        if version not in range(len(MODULES)):
+            version = ''
+
+    # For GPT4 rate limit will be hit if you have more than 1 thread.
+    # 1 Thread for each file. Controls how many files are worked on at once.
+    threads = int(os.getenv('fileThreads'))
+    handler = getHandler(version)
 
     totalCost = Fore.RED + 'Translation module didn\'t return the total cost. Make sure the \
 files to translate are in the /files folder and that you picked the right game engine.'
 
+    # Files
+    if len(args.files) > 0:
+        filenames = [os.path.basename(filename) for filename in args.files]
+    else:
+        filenames = [filename for filename in os.listdir("files") if filename.endswith(MODULES[version][1])]
+
+    # Biggest files first so none of them ends up starting last
+    filenames, costs = schedule.order(filenames, MODULES[version][5])
+
     # Open File (Threads)
-    with ThreadPoolExecutor(max_workers=THREADS) as executor:
-        futures = [executor.submit(MODULES[version][2], filename, estimate) \
-                    for filename in os.listdir("files") if filename.endswith(MODULES[version][1])]
-                    
+    # Estimates don't wait on the API, so files are estimated one at a time to credit each batch to its file
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=1 if estimate else threads) as executor:
+        futures = [executor.submit(openFile, handler, filename, estimate, args.force) for filename in filenames]
+
+        skipped = 0
         for future in as_completed(futures):
             try:
-                totalCost = future.result()
+                result = future.result()
+                if result is None:
+                    skipped += 1
+                else:
+                    totalCost = result
             except Exception as e:
                 tracebackLineNo = str(traceback.extract_tb(sys.exc_info()[2])[-1].lineno)
                 tqdm.write(Fore.RED + str(e) + '|' + tracebackLineNo + Fore.RESET)
+    makespan = time.time() - start
 
-    if totalCost != 'Fail':
-        if estimate is False:
+    if skipped > 0:
+        tqdm.write(Fore.GREEN + f'Skipped {skipped} files unchanged since the last run (Use --force to translate them again)' + Fore.RESET)
+
+    if totalCost != 'Fail' and skipped < len(filenames):
+        if estimate is False and len(args.files) == 0:
             # This is to encourage people to grab what's in /translated instead
             deleteFolderFiles('files')
 
         tqdm.write(str(totalCost))
+        if estimate is False:
+            tqdm.write(Fore.YELLOW + engine.metrics.report() + Fore.RESET)
+            scheduleString = schedule.report(filenames, costs, threads, makespan)
+            if scheduleString is not None:
+                tqdm.write(Fore.BLUE + scheduleString + Fore.RESET)
+
+    # Cost Report
+    if estimate is True and len(engine.estimate.BATCHES) > 0:
+        module = sys.modules[handler.__module__]
+        inputCost = getattr(module, 'INPUTAPICOST', getattr(module, 'APICOST', 0))
+        outputCost = getattr(module, 'OUTPUTAPICOST', getattr(module, 'APICOST', 0))
+        tqdm.write(engine.estimate.report(inputCost, outputCost))
+        engine.estimate.writeBatches(ESTIMATEFILE, inputCost, outputCost)
+        tqdm.write(f'Batches written to {ESTIMATEFILE}')
+
+def openFile(handler, filename, estimate, force):
+    if not force and manifest.isCurrent(filename):
+        return None
+    if estimate:
+        engine.estimate.FILE = filename
+    engine.metrics.setContext(engine=handler.__module__.split('.')[-1], file=filename, code=None)
+    start = time.time()
+    try:
+        return handler(filename, estimate)
+    finally:
+        schedule.record(filename, time.time() - start)
+        engine.metrics.writeProm()
 
 def deleteFolderFiles(folderPath):
     for filename in os.listdir(folderPath):
         file_path = os.path.join(folderPath, filename)
         if file_path.endswith(('.json', '.yaml', '.ks')):
-            os.remove(file_path)   
+            os.remove(file_path)
@@ -0,0 +1,51 @@
+# Libraries
+import hashlib, json, os
+from modules import journal
+
+# Manifest of finished files, one cache/manifest/<file>.json per file in /translated. It holds the hash
+# of the source the translation was made from, so the next run can skip files that haven't changed
+# (e.g. after a game patch only the patched files are translated again). Engines that journal their
+# units also store them here (Unit hash -> Translation) so a changed file only pays for the units
+# whose source text changed.
+
+#Globals
+MANIFEST = True
+MANIFESTDIR = 'cache/manifest'
+
+def hashFile(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load(filename):
+    path = os.path.join(MANIFESTDIR, filename + '.json')
+    if not MANIFEST or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+# True if /translated already holds the translation of this exact /files/<filename>
+def isCurrent(filename):
+    entry = load(filename)
+    if entry is None or not os.path.exists('translated/' + filename):
+        return False
+    return entry['hash'] == hashFile('files/' + filename)
+
+# Translated units of the last version of filename
+def getUnits(filename):
+    entry = load(filename)
+    return entry['units'] if entry is not None else {}
+
+# Call once the translation of filename is written and complete
+def record(filename, units=None):
+    if not MANIFEST:
+        return
+    entry = {'hash': hashFile('files/' + filename), 'units': units or {}}
+    os.makedirs(MANIFESTDIR, exist_ok=True)
+    with journal.openAtomic(os.path.join(MANIFESTDIR, filename + '.json'), 'w', encoding='utf-8') as outFile:
+        json.dump(entry, outFile, ensure_ascii=False)
@@ -0,0 +1,55 @@
+# Libraries
+import re, textwrap
+
+# Note tags shared by the RPG Maker modules. Plugins keep text in the note box of database entries
+# and events as tags like <SG説明:...>. NOTETAGS lists the tags that get translated, which entries they
+# are looked for in and how the translation is written back. translateNotes sends each tag found in
+# an entry once (modules that collect their strings first batch them with the rest of the file) and
+# writes the translation over the tag's text.
+
+#Globals
+# Name: [Pattern, Kinds, About, Spaces, Wrap]
+#   Pattern - Group 1 is the text that gets translated
+#   Kinds - Entries the tag is looked for in (The database file, or 'Events' for map events)
+#   About - What the text is, for the prompt
+#   Spaces - False for tags that break on spaces (e.g. event IDs). Spaces become _
+#   Wrap - Wrap the translation at the module's note width
+NOTETAGS = {
+    'SG説明': [r'<SG説明:(.*?)>', ['Items'], 'note', True, True],
+    'SGカテゴリ': [r'<SGカテゴリ:(.*?)>', ['Items'], 'note', True, True],
+    'ExtendDesc': [r'<ExtendDesc:(.*?)>', ['Items'], 'note', True, True],
+    'hint': [r'<hint:(.*?)>', ['Armors', 'Weapons'], 'note', True, True],
+    'Info Text Bottom': [r'<Info Text Bottom>\n([\s\S]*?)\n</Info Text Bottom>', ['Armors', 'Weapons'], 'note', True, True],
+    '特徴1': [r'<特徴1:([^>]*)>', ['Actors'], 'note', True, True],
+    'variable_update_skill': [r'111:(.+?)\n', ['Enemies'], 'note', True, True],
+    'desc2': [r'<desc2:([^>]*)>', ['Enemies'], 'note', True, True],
+    'desc3': [r'<desc3:([^>]*)>', ['Enemies'], 'note', True, True],
+    'help': [r'<help:([^>]*)>', ['Skills', 'States'], 'note', True, True],
+    'namePop': [r'<namePop:(.*?) [\d]+>', ['Events'], 'location name', False, False],
+}
+
+# translate(text, about) returns [translatedText, [inputTokens, outputTokens]]
+def translateNotes(entry, kind, translate, width):
+    totalTokens = [0, 0]
+    if not entry.get('note'):
+        return totalTokens
+
+    for pattern, kinds, about, spaces, wrap in NOTETAGS.values():
+        if kind not in kinds:
+            continue
+
+        # Back to front so the earlier matches keep their place
+        for match in reversed(list(re.finditer(pattern, entry['note'], re.DOTALL))):
+            # Remove any textwrap
+            response = translate(match.group(1).replace('\n', ' '), about)
+            totalTokens[0] += response[1][0]
+            totalTokens[1] += response[1][1]
+
+            translatedText = response[0]
+            if wrap:
+                translatedText = textwrap.fill(translatedText, width=width)
+            translatedText = translatedText.replace('\"', '')
+            if not spaces:
+                translatedText = translatedText.replace(' ', '_')
+            entry['note'] = entry['note'][:match.start(1)] + translatedText + entry['note'][match.end(1):]
+    return totalTokens
@@ -0,0 +1,49 @@
+# Libraries
+from concurrent.futures import FIRST_COMPLETED, wait
+from modules import engine
+
+# Event pages (Map events, CommonEvents, Troops) shared by the RPG Maker modules. All the pages of a
+# file go through the one executor of the file, so the workers stay busy across events and troops
+# instead of waiting for the slowest page of each before starting the next. Pages are handed over
+# from a window of QUEUESIZE per worker rather than all at once, which keeps a file with thousands
+# of pages from queueing them all up front and lets an error stop the pages that haven't started.
+
+#Globals
+QUEUESIZE = 2   # Pages waiting per worker
+
+# search(page) returns [inputTokens, outputTokens]. Returns [totalTokens, error], error being the
+# first exception a page threw (None if they all worked).
+def searchPages(executor, pages, search, workers):
+    totalTokens = [0, 0]
+    error = None
+    pending = set()
+    for page in pages:
+        if page is None:
+            continue
+
+        # Wait for a free spot
+        while len(pending) >= workers * QUEUESIZE and error is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            error = collect(done, totalTokens) or error
+        if error is not None:
+            break
+        pending.add(executor.submit(engine.metrics.bind(search), page))
+
+    # Let the rest finish, pages that didn't start yet are dropped after an error
+    if error is not None:
+        for future in pending:
+            future.cancel()
+    done, _ = wait(pending)
+    lastError = collect([future for future in done if not future.cancelled()], totalTokens)
+    return [totalTokens, error or lastError]
+
+def collect(done, totalTokens):
+    error = None
+    for future in done:
+        try:
+            totalTokensFuture = future.result()
+            totalTokens[0] += totalTokensFuture[0]
+            totalTokens[1] += totalTokensFuture[1]
+        except Exception as e:
+            error = error or e
+    return error
@@ -1,4 +1,4 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
 from pathlib import Path
@@ -8,22 +8,15 @@ import textwrap
 import threading
 import time
 import traceback
-import tiktoken
-from ruamel.yaml import YAML
 
 from colorama import Fore
 from dotenv import load_dotenv
-import openai
 from retry import retry
 from tqdm import tqdm
+from modules import aceyaml, codec, engine, filekinds, journal, manifest, notes, pages, tlcache
 
 #Globals
 load_dotenv()
-if os.getenv('api').replace(' ', '') != '':
-    openai.api_base = os.getenv('api')
-
-openai.organization = os.getenv('org')
-openai.api_key = os.getenv('key')
 MODEL = os.getenv('model')
 TIMEOUT = int(os.getenv('timeout'))
 LANGUAGE=os.getenv('language').capitalize()
@@ -40,6 +33,22 @@ MAXHISTORY = 10
 ESTIMATE = ''
 totalTokens = [0, 0]
 NAMESLIST = []
+MISMATCH = []   # Lists files with dialogue that didn't come back from its <LineN> batch
+
+# Dialogue is sent in <LineN> batches of BATCHSIZE lines.
+# If you are getting a lot of MISMATCH errors, lower the batch size.
+BATCHSIZE = 10
+
+# Characters
+CHARACTERS = 'Game Characters:\
+    Character: 莉音 == Rio - Gender: Female\
+    Character: 結衣 == Yui - Gender: Female\
+    Character: 美雪 == Miyuki - Gender: Female\
+    Character: あかり == Akari - Gender: Female\
+    Character: カガミ == Kagami - Gender: Female\
+    Character: ミズキ == Mizuki - Gender: Female\
+    Character: スズカ == Suzuka - Gender: Female\
+    Character: シズク == Shizuku - Gender: Female'
 
 #tqdm Globals
 BAR_FORMAT='{l_bar}{bar:10}{r_bar}{bar:-10b}'
@@ -87,16 +96,13 @@ def handleACE(filename, estimate):
     
     else:
         try:
-            with open('translated/' + filename, 'w', encoding='UTF-8') as outFile:
+            with journal.openAtomic('translated/' + filename, 'w', encoding='UTF-8') as outFile:
                 start = time.time()
                 translatedData = openFiles(filename)
 
                 # Print Result
                 end = time.time()
-                yaml=YAML(pure=True)
-                yaml.width = 4096
-                yaml.default_style = "'"
-                yaml.dump(translatedData[0], outFile)
+                aceyaml.dump(translatedData[0], outFile)
                 tqdm.write(getResultString(translatedData, end - start, filename))
                 with LOCK:
                     totalTokens[0] += translatedData[1][0]
@@ -104,74 +110,43 @@ def handleACE(filename, estimate):
         except Exception as e:
             return 'Fail'
 
-    return getResultString(['', totalTokens, None], end - start, 'TOTAL')
-
-def openFiles(filename):
-    yaml=YAML(pure=True)   # Need a yaml instance per thread.
-    yaml.width = 4096
-    yaml.default_style = "'"
-
-    with open('files/' + filename, 'r', encoding='UTF-8') as f:
-        data = yaml.load(f)
-
-        # Map Files
-        if 'Map' in filename and filename != 'MapInfos.json':
-            translatedData = parseMap(data, filename)
-
-        # CommonEvents Files
-        elif 'CommonEvents' in filename:
-            translatedData = parseCommonEvents(data, filename)
-
-        # Actor File
-        elif 'Actors' in filename:
-            translatedData = parseNames(data, filename, 'Actors')
-
-        # Armor File
-        elif 'Armors' in filename:
-            translatedData = parseNames(data, filename, 'Armors')
-
-        # Weapons File
-        elif 'Weapons' in filename:
-            translatedData = parseNames(data, filename, 'Weapons')
-        
-        # Classes File
-        elif 'Classes' in filename:
-            translatedData = parseNames(data, filename, 'Classes')
-
-        # Enemies File
-        elif 'Enemies' in filename:
-            translatedData = parseNames(data, filename, 'Enemies')
-
-        # Items File
-        elif 'Items' in filename:
-            translatedData = parseThings(data, filename)
-
-        # MapInfo File
-        elif 'MapInfos' in filename:
-            translatedData = parseNames(data, filename, 'MapInfos')
-
-        # Skills File
-        elif 'Skills' in filename:
-            translatedData = parseSS(data, filename)
+    # Skip this file next run unless its source changes
+    if not estimate and translatedData[2] is None and filename not in MISMATCH:
+        manifest.record(filename)
 
-        # Troops File
-        elif 'Troops' in filename:
-            translatedData = parseTroops(data, filename)
+    totalString = getResultString(['', totalTokens, None], end - start, 'TOTAL')
 
-        # States File
-        elif 'States' in filename:
-            translatedData = parseSS(data, filename)
-
-        # System File
-        elif 'System' in filename:
-            translatedData = parseSystem(data, filename)
+    # Print any errors on maps
+    if len(MISMATCH) > 0:
+        return totalString + Fore.RED + f'\nMismatch Errors: {MISMATCH}' + Fore.RESET
+    else:
+        return totalString
+
+# File kind -> Parser (See filekinds.FILEKINDS)
+PARSERS = {
+    'Map': lambda data, filename: parseMap(data, filename),
+    'CommonEvents': lambda data, filename: parseCommonEvents(data, filename),
+    'Actors': lambda data, filename: parseNames(data, filename, 'Actors'),
+    'Armors': lambda data, filename: parseNames(data, filename, 'Armors'),
+    'Weapons': lambda data, filename: parseNames(data, filename, 'Weapons'),
+    'Classes': lambda data, filename: parseNames(data, filename, 'Classes'),
+    'Enemies': lambda data, filename: parseNames(data, filename, 'Enemies'),
+    'Items': lambda data, filename: parseThings(data, filename),
+    'MapInfos': lambda data, filename: parseNames(data, filename, 'MapInfos'),
+    'Skills': lambda data, filename: parseSS(data, filename, 'Skills'),
+    'Troops': lambda data, filename: parseTroops(data, filename),
+    'States': lambda data, filename: parseSS(data, filename, 'States'),
+    'System': lambda data, filename: parseSystem(data, filename),
+    'Scenario': lambda data, filename: parseScenario(data, filename),
+}
 
-        # Scenario File
-        elif 'Scenario' in filename:
-            translatedData = parseScenario(data, filename)
+def openFiles(filename):
+    data = aceyaml.load(filename)
 
-        else:
-            raise NameError(filename + ' Not Supported')
+    kind = filekinds.getKind(filename, data)
+    if kind not in PARSERS:
+        raise NameError(filename + ' Not Supported')
+    translatedData = PARSERS[kind](data, filename)
     
     return translatedData
 
@@ -205,7 +180,7 @@ def parseMap(data, filename):
     global LOCK
 
     # Translate displayName for Map files
-    if 'Map' in filename:
+    if data.get('display_name'):
         response = translateGPT(data['display_name'], 'Reply with only the '+ LANGUAGE +' translation of the RPG location name', False)
         totalTokens[0] += response[1][0]
         totalTokens[1] += response[1][1]
@@ -220,44 +195,23 @@ def parseMap(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
+        # This translates text above items on the map.
+        # if 'LB:' in event['note']:
+            # totalTokens += translateNote(event, r'(?<=LB:)[^u0000-u0080]+')
+
+        # One queue for the pages of every event
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            for key in events:
-                if key is not None:
-                    # This translates text above items on the map.
-                    # if 'LB:' in event['note']:
-                        # totalTokens += translateNote(event, r'(?<=LB:)[^u0000-u0080]+')
-
-                    futures = [executor.submit(searchCodes, page, pbar) for page in events[key]['pages'] if page is not None]
-                    for future in as_completed(futures):
-                        try:
-                            totalTokensFuture = future.result()
-                            totalTokens[0] += totalTokensFuture[0]
-                            totalTokens[1] += totalTokensFuture[1]
-                        except Exception as e:
-                            return [data, totalTokens, e]
+            pageList = (page for key in events if key is not None for page in events[key]['pages'])
+            response = pages.searchPages(executor, pageList, lambda page: searchCodes(page, pbar, filename), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
     return [data, totalTokens, None]
 
-def translateNote(event, regex):
-    # Regex that only matches text inside LB.
-    jaString = event['note']
-
-    match = re.findall(regex, jaString, re.DOTALL)
-    if match:
-        oldJAString = match[0]
-        # Remove any textwrap
-        jaString = re.sub(r'\n', ' ', oldJAString)
-
-        # Translate
-        response = translateGPT(jaString, 'Reply with the '+ LANGUAGE +' translation of the note.', True)
-        translatedText = response[0]
-
-        # Textwrap
-        translatedText = textwrap.fill(translatedText, width=NOTEWIDTH)
-
-        translatedText = translatedText.replace('\"', '')
-        event['note'] = event['note'].replace(oldJAString, translatedText)
-        return response[1]
-    return [0,0]
+# Note tags of entry (See notes.NOTETAGS)
+def translateNotes(entry, kind):
+    return notes.translateNotes(entry, kind, lambda text, about: translateGPT(text, 'Reply with the '+ LANGUAGE +' translation of the '+ about +'.', True), NOTEWIDTH)
 
 def parseCommonEvents(data, filename):
     totalTokens = [0, 0]
@@ -273,14 +227,11 @@ def parseCommonEvents(data, filename):
         pbar.desc=filename
         pbar.total=totalLines
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = [executor.submit(searchCodes, page, pbar) for page in data if page is not None]
-            for future in as_completed(futures):
-                try:
-                    totalTokensFuture = future.result()
-                    totalTokens[0] += totalTokensFuture[0]
-                    totalTokens[1] += totalTokensFuture[1]
-                except Exception as e:
-                    return [data, totalTokens, e]
+            response = pages.searchPages(executor, data, lambda page: searchCodes(page, pbar, filename), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
     return [data, totalTokens, None]
 
 def parseTroops(data, filename):
@@ -297,17 +248,14 @@ def parseTroops(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
-        for troop in data:
-            if troop is not None:
-                with ThreadPoolExecutor(max_workers=THREADS) as executor:
-                    futures = [executor.submit(searchCodes, page, pbar) for page in troop['pages'] if page is not None]
-                    for future in as_completed(futures):
-                        try:
-                            totalTokensFuture = future.result()
-                            totalTokens[0] += totalTokensFuture[0]
-                            totalTokens[1] += totalTokensFuture[1]
-                        except Exception as e:
-                            return [data, totalTokens, e]
+        # One queue for the pages of every troop
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            pageList = (page for troop in data if troop is not None for page in troop['pages'])
+            response = pages.searchPages(executor, pageList, lambda page: searchCodes(page, pbar, filename), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
     return [data, totalTokens, None]
     
 def parseNames(data, filename, context):
@@ -347,7 +295,7 @@ def parseThings(data, filename):
                         return [data, totalTokens, e]
     return [data, totalTokens, None]
 
-def parseSS(data, filename):
+def parseSS(data, filename, context):
     totalTokens = [0, 0]
     totalLines = 0
     totalLines += len(data)
@@ -358,7 +306,7 @@ def parseSS(data, filename):
             for ss in data:
                 if ss is not None:
                     try:
-                        result = searchSS(ss, pbar)       
+                        result = searchSS(ss, pbar, context)       
                         totalTokens[0] += result[0]
                         totalTokens[1] += result[1]
                     except Exception as e:
@@ -402,14 +350,11 @@ def parseScenario(data, filename):
         pbar.desc=filename
         pbar.total=totalLines
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = [executor.submit(searchCodes, page[1], pbar) for page in data.items() if page[1] is not None]
-            for future in as_completed(futures):
-                try:
-                    totalTokensFuture = future.result()
-                    totalTokens[0] += totalTokensFuture[0]
-                    totalTokens[1] += totalTokensFuture[1]
-                except Exception as e:
-                    return [data, totalTokens, e]
+            response = pages.searchPages(executor, data.values(), lambda page: searchCodes(page, pbar, filename), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
     return [data, totalTokens, None]
 
 def searchThings(name, pbar):
@@ -428,12 +373,9 @@ def searchThings(name, pbar):
     descriptionResponse = translateGPT(name['description'], 'Reply with only the '+ LANGUAGE +' translation of the description.', False) if 'description' in name else ''
 
     # Note
-    if '<SG説明:' in name['note']:
-        totalTokens[0] += translateNote(name, r'<SG説明:(.*?)>')[0]
-        totalTokens[1] += translateNote(name, r'<SG説明:(.*?)>')[1]
-    if '<SGカテゴリ':
-        totalTokens[0] += translateNote(name, r'<SGカテゴリ:(.*?)>')[0]
-        totalTokens[1] += translateNote(name, r'<SGカテゴリ:(.*?)>')[1]
+    notesTokens = translateNotes(name, 'Items')
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
 
     # Count totalTokens
     totalTokens[0] += nameResponse[1][0] if nameResponse != '' else 0
@@ -484,22 +426,11 @@ def searchNames(name, pbar, context):
             responseList.append(translateGPT(name['description'], '', True))
         else:
             responseList.append(['', 0])
-        if 'hint' in name['note']:
-            totalTokens[0] += translateNote(name, r'<hint:(.*?)>')[0]
-            totalTokens[1] += translateNote(name, r'<hint:(.*?)>')[1]
 
-    if 'Enemies' in context:
-        if 'variable_update_skill' in name['note']:
-            totalTokens[0] += translateNote(name, r'111:(.+?)\n')[0]
-            totalTokens[1] += translateNote(name, r'111:(.+?)\n')[1]
-
-        if 'desc2' in name['note']:
-            totalTokens[0] += translateNote(name, r'<desc2:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<desc2:([^>]*)>')[1]
-
-        if 'desc3' in name['note']:
-            totalTokens[0] += translateNote(name, r'<desc3:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<desc3:([^>]*)>')[1]
+    # Note
+    notesTokens = translateNotes(name, context)
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
 
     # Extract all our translations in a list from response
     for i in range(len(responseList)):
@@ -514,22 +445,16 @@ def searchNames(name, pbar, context):
         name['profile'] = translatedText.replace('\"', '')
         translatedText = textwrap.fill(responseList[2], LISTWIDTH)
         name['nickname'] = translatedText.replace('\"', '')
-        if '<特徴1:' in name['note']:
-            totalTokens[0] += translateNote(name, r'<特徴1:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<特徴1:([^>]*)>')[1]
 
     if 'Armors' in context or 'Weapons' in context:
         translatedText = textwrap.fill(responseList[1], LISTWIDTH)
         if 'description' in name:
             name['description'] = translatedText.replace('\"', '')
-            if '<SG説明:' in name['note']:
-                totalTokens[0] += translateNote(name, r'<Info Text Bottom>\n([\s\S]*?)\n</Info Text Bottom>')[0]
-                totalTokens[1] += translateNote(name, r'<Info Text Bottom>\n([\s\S]*?)\n</Info Text Bottom>')[1]
     pbar.update(1)
 
     return totalTokens
 
-def searchCodes(page, pbar):
+def searchCodes(page, pbar, filename):
     translatedText = ''
     currentGroup = []
     textHistory = []
@@ -541,6 +466,8 @@ def searchCodes(page, pbar):
     match = []
     syncIndex = 0
     CLFlag = False
+    dialogue = []   # [j, Text, Speaker, CLFlag, Nametag, Sound Effect]
+    dialogueHistory = []    # textHistory when the first group in dialogue was found
     global LOCK
     global NAMESLIST
 
@@ -556,6 +483,7 @@ def searchCodes(page, pbar):
                 pbar.update(1)
                 if len(codeList) <= i:
                     break
+            engine.metrics.setContext(code=codeList[i]['c'])
 
             ### All the codes are here which translate specific functions in the MAP files.
             ### IF these crash or fail your game will do the same. Use the flags to skip codes.
@@ -778,53 +706,21 @@ def searchCodes(page, pbar):
                         finalJAString = finalJAString.replace('\\CL', '')
                         CLFlag = True
 
-                    # Translate
-                    if speaker == '' and finalJAString != '':
-                        response = translateGPT(finalJAString, textHistory, True)
-                        totalTokens[0] += response[1][0]
-                        totalTokens[1] += response[1][1]
-                        translatedText = response[0]
-
-                        # Change added speaker
-                        translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '\g<1>: ', translatedText)
-
-                        # Sub Vars
-                        varResponse = subVars(translatedText)
-                        subbedT = varResponse[0]
-                        textHistory.append('\"' + varResponse[0] + '\"')
-                    elif finalJAString != '':
-                        response = translateGPT(speaker + ': ' + finalJAString, textHistory, True)
-                        totalTokens[0] += response[1][0]
-                        totalTokens[1] += response[1][1]
-                        translatedText = response[0]
-                        
-                        # Remove added speaker
-                        translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '', translatedText)
-
-                        # Sub Vars
-                        varResponse = subVars(translatedText)
-                        subbedT = varResponse[0]
-                        textHistory.append('\"' + speaker + ': ' + varResponse[0] + '\"')   
-                        speaker = ''             
-                    else:
-                        translatedText = finalJAString    
-
-                    # Textwrap
-                    if FIXTEXTWRAP == True:
-                        translatedText = textwrap.fill(translatedText, width=WIDTH)
-                        if BRFLAG == True:
-                            translatedText = translatedText.replace('\n', '<br>')   
-
-                    # Add Beginning Text
-                    if CLFlag:
-                        translatedText = '\\CL' + translatedText
-                        CLFlag = False
-                    translatedText = nametag + translatedText
+                    # Translate later with the page's dialogue up to the next choice in <LineN> batches (See
+                    # translateDialogue). The Japanese is set for now and stays if its line doesn't come back.
+                    if finalJAString != '':
+                        if speaker != '':
+                            sourceText = speaker + ': ' + finalJAString
+                        else:
+                            sourceText = finalJAString
+                        if len(dialogue) == 0:
+                            dialogueHistory = list(textHistory)
+                        dialogue.append([j, sourceText, speaker, CLFlag, nametag, soundEffectString])
+                    translatedText = formatDialogue(finalJAString, CLFlag, nametag, soundEffectString)
+                    CLFlag = False
                     nametag = ''
-                    translatedText = soundEffectString + translatedText
 
                     # Set Data
-                    translatedText = translatedText.replace('\"', '')
                     codeList[i]['p'] = []
                     codeList[i]['c'] = -1
                     codeList[j]['p'] = [translatedText]
@@ -1372,6 +1268,13 @@ def searchCodes(page, pbar):
 
             ### Event Code: 102 Show Choice
             if codeList[i]['c'] == 102 and CODE102 == True:
+                # Translate the dialogue so far first, the choices use the last line for context
+                if len(dialogue) > 0:
+                    response = translateDialogue(codeList, dialogue, filename, dialogueHistory, textHistory)
+                    totalTokens[0] += response[0]
+                    totalTokens[1] += response[1]
+                    dialogue = []
+
                 for choice in range(len(codeList[i]['p'][0])):
                     jaString = codeList[i]['p'][0][choice]
                     jaString = jaString.replace(' 。', '.')
@@ -1483,6 +1386,12 @@ def searchCodes(page, pbar):
     except Exception as e:
         traceback.print_exc()
         raise Exception(str(e) + 'Failed to translate: ' + oldjaString)  
+
+    # Translate the 401 groups of the page
+    if len(dialogue) > 0:
+        response = translateDialogue(codeList, dialogue, filename, dialogueHistory, textHistory)
+        totalTokens[0] += response[0]
+        totalTokens[1] += response[1]
                 
     # Append leftover groups in 401
     if len(currentGroup) > 0:
@@ -1513,7 +1422,52 @@ def searchCodes(page, pbar):
 
     return totalTokens
 
-def searchSS(state, pbar):
+# Sends the 401 groups of a page in <LineN> batches, starting from history, and sets the translations.
+# The translated lines go on the end of textHistory. Groups that didn't come back keep their Japanese
+# and the file goes in MISMATCH.
+def translateDialogue(codeList, dialogue, filename, history, textHistory):
+    code = engine.metrics.getContext()['code']
+    engine.metrics.setContext(code=401)
+    response = translateList([unit[1] for unit in dialogue], history[-MAXHISTORY:])
+    engine.metrics.setContext(code=code)
+    if ESTIMATE:
+        return response[1]
+
+    for [j, sourceText, speaker, CLFlag, nametag, soundEffectString], translatedText in zip(dialogue, response[0]):
+        if translatedText is None:
+            with LOCK:
+                if filename not in MISMATCH:
+                    MISMATCH.append(filename)
+            continue
+
+        if speaker == '':
+            # Change added speaker
+            translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '\g<1>: ', translatedText)
+        else:
+            # Remove added speaker
+            translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '', translatedText)
+        codeList[j]['p'] = [formatDialogue(translatedText, CLFlag, nametag, soundEffectString)]
+
+        # Keep textHistory list at length MAXHISTORY
+        textHistory.append('\"' + (speaker + ': ' if speaker != '' else '') + translatedText + '\"')
+        if len(textHistory) > MAXHISTORY:
+            textHistory.pop(0)
+    return response[1]
+
+def formatDialogue(translatedText, CLFlag, nametag, soundEffectString):
+    # Textwrap
+    if FIXTEXTWRAP == True:
+        translatedText = textwrap.fill(translatedText, width=WIDTH)
+        if BRFLAG == True:
+            translatedText = translatedText.replace('\n', '<br>')   
+
+    # Add Beginning Text
+    if CLFlag:
+        translatedText = '\\CL' + translatedText
+    translatedText = soundEffectString + nametag + translatedText
+    return translatedText.replace('\"', '')
+
+def searchSS(state, pbar, context):
     '''Searches skills and states json files'''
     totalTokens = [0, 0]
 
@@ -1553,10 +1507,10 @@ def searchSS(state, pbar):
         else:
             message4Response = translateGPT(state['message4'], 'reply with only the gender neutral '+ LANGUAGE +' translation', True)
 
-    # if 'note' in state:
-    if 'help' in state['note']:
-        totalTokens[0] += translateNote(state, r'<help:([^>]*)>')[0]
-        totalTokens[1] += translateNote(state, r'<help:([^>]*)>')[1]
+    # Note
+    notesTokens = translateNotes(state, context)
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
     
     # Count totalTokens
     totalTokens[0] += nameResponse[1][0] if nameResponse != '' else 0
@@ -1677,130 +1631,96 @@ def searchSystem(data, pbar):
     
     return totalTokens
 
-def subVars(jaString):
-    jaString = jaString.replace('\u3000', ' ')
-
-    # Nested
-    count = 0
-    nestedList = re.findall(r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]', jaString)
-    nestedList = set(nestedList)
-    if len(nestedList) != 0:
-        for icon in nestedList:
-            jaString = jaString.replace(icon, '{Nested_' + str(count) + '}')
-            count += 1
-
-    # Icons
-    count = 0
-    iconList = re.findall(r'[\\]+[iIkKwWaA]+\[[0-9]+\]', jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, '{Ascii_' + str(count) + '}')
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r'[\\]+[cC]\[[0-9]+\]', jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, '{Color_' + str(count) + '}')
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r'[\\]+[nN]\[.+?\]+', jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, '{N_' + str(count) + '}')
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r'[\\]+[vV]\[[0-9]+\]', jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, '{Var_' + str(count) + '}')
-            count += 1
-
-    # Formatting
-    count = 0
-    if '笑えるよね.' in jaString:
-        print('t')
-    formatList = re.findall(r'[\\]+CL', jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for var in formatList:
-            jaString = jaString.replace(var, '{FCode_' + str(count) + '}')
-            count += 1
-
-    # Put all lists in list and return
-    allList = [nestedList, iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r'\[\s?.+?\s?\]', translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Nested
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace('{Nested_' + str(count) + '}', var)
-            count += 1
-
-    # Icons
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace('{Ascii_' + str(count) + '}', var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace('{Color_' + str(count) + '}', var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace('{N_' + str(count) + '}', var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace('{Var_' + str(count) + '}', var)
-            count += 1
-    
-    # Formatting
-    count = 0
-    if len(allList[5]) != 0:
-        for var in allList[5]:
-            translatedText = translatedText.replace('{FCode_' + str(count) + '}', var)
-            count += 1
-
-    # Remove Color Variables Spaces
-    # if '\\c' in translatedText:
-    #     translatedText = re.sub(r'\s*(\\+c\[[1-9]+\])\s*', r' \1', translatedText)
-    #     translatedText = re.sub(r'\s*(\\+c\[0+\])', r'\1', translatedText)
-    return translatedText
+# Translates textList in <LineN> batches of BATCHSIZE, each batch getting the last lines of the one
+# before it as history. Returns [translatedList, totalTokens], translatedList holding None for lines
+# that didn't come back even when sent on their own.
+def translateList(textList, history):
+    totalTokens = [0, 0]
+
+    # Translation Memory, lines without Japanese are kept as they are
+    memoryList = tlcache.getBatch(__name__, textList, history, PROMPT)
+    for i in range(len(textList)):
+        if memoryList[i] is None and not re.search(r'[一-龠]+|[ぁ-ゔ]+|[ァ-ヴ]+|[\uFF00-\uFFEF]', codec.subVars(textList[i], 'ace')[0]):
+            memoryList[i] = textList[i]
+    sourceList = [textList[i] for i in range(len(textList)) if memoryList[i] is None]
+
+    translatedList = []
+    batchHistory = history
+    for index in range(0, len(sourceList), BATCHSIZE):
+        response = translateBatch(sourceList[index:index + BATCHSIZE], batchHistory)
+        totalTokens[0] += response[1][0]
+        totalTokens[1] += response[1][1]
+        translatedList.extend(response[0])
+        batchHistory = ['\"' + line + '\"' for line in response[0] if line is not None][-MAXHISTORY:]
+
+    if ESTIMATE:
+        return [textList, totalTokens]
+    return [tlcache.fillBatch(__name__, memoryList, textList, translatedList, history, PROMPT), totalTokens]
+
+@retry(exceptions=Exception, tries=5, delay=5)
+def translateBatch(textList, history):
+    return translateBatchOnce(textList, history)
+
+# translateBatch without the retry, for the halves recover sends again
+def translateBatchOnce(textList, history):
+    payload = '\n'.join([f'<Line{i}>`{text}`</Line{i}>' for i, text in enumerate(textList)])
+    varResponse = codec.subVars(payload, 'ace')
+    subbedT = varResponse[0]
+
+    # If ESTIMATE is True just count this as an execution and return.
+    if ESTIMATE:
+        counts = engine.tokens.countBatch([''.join(history), PROMPT, subbedT])
+        totalTokens = [counts[0] + counts[1] + counts[2], counts[2] * 2]   # Estimating 2x the size of the original text
+        engine.estimate.record(len(textList), totalTokens)
+        return [list(textList), totalTokens]
+
+    # Create Message List
+    msg = engine.prompt.build(PROMPT, CHARACTERS, history, subbedT, 'user')
+
+    response = engine.complete(
+        temperature=0,
+        frequency_penalty=0.2,
+        presence_penalty=0.2,
+        model=MODEL,
+        messages=msg,
+    )
+
+    # Save Translated Text
+    translatedText = response.choices[0].message.content
+    totalTokens = [response.usage.prompt_tokens, response.usage.completion_tokens]
+    if len(translatedText) > 15 * len(payload) or "I'm sorry, but I'm unable to assist with that translation" in translatedText:
+        raise Exception
+
+    # Resub Vars
+    translatedText = codec.resubVars(translatedText, varResponse[1])
+    translatedText = translatedText.replace('っ', '')
+
+    # Mismatch, keep the lines that came back under their own <LineN> and send the rest again. A
+    # single line that still doesn't come back goes through translateGPT on its own.
+    lines = engine.batch.indexLines(translatedText.split('\n'), len(textList))
+    if None in lines and len(textList) > 1:
+        response = engine.batch.recover(textList, lines, lambda sourceList: translateBatchOnce(sourceList, history))
+        totalTokens[0] += response[1][0]
+        totalTokens[1] += response[1][1]
+        lines = response[0]
+    elif None in lines:
+        engine.metrics.mismatch(engine.metrics.lastRequest(), 1, 1, 0)
+        response = translateGPT(textList[0], history, True)
+        totalTokens[0] += response[1][0]
+        totalTokens[1] += response[1][1]
+        lines = [response[0]]
+    return [lines, totalTokens]
 
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(t, history, fullPromptFlag):
+    # Translation Memory
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memory = tlcache.getTranslation(__name__, t, history, memoryPrompt)
+    if memory is not None:
+        return [memory, [0, 0]]
+
     # If ESTIMATE is True just count this as an execution and return.
     if ESTIMATE:
-        enc = tiktoken.encoding_for_model(MODEL)
         historyRaw = ''
         if isinstance(history, list):
             for line in history:
@@ -1808,30 +1728,19 @@ def translateGPT(t, history, fullPromptFlag):
         else:
             historyRaw = history
 
-        inputTotalTokens = len(enc.encode(historyRaw)) + len(enc.encode(PROMPT))
-        outputTotalTokens = len(enc.encode(t)) * 2   # Estimating 2x the size of the original text
-        totalTokens = [inputTotalTokens, outputTotalTokens]
+        counts = engine.tokens.countBatch([historyRaw, PROMPT, t])
+        totalTokens = [counts[0] + counts[1], counts[2] * 2]   # Estimating 2x the size of the original text
+        engine.estimate.record(1, totalTokens)
         return (t, totalTokens)
     
     # Sub Vars
-    varResponse = subVars(t)
+    varResponse = codec.subVars(t, 'ace')
     subbedT = varResponse[0]
 
     # If there isn't any Japanese in the text just skip
     if not re.search(r'[一-龠]+|[ぁ-ゔ]+|[ァ-ヴ]+|[\uFF00-\uFFEF]', subbedT):
         return(t, [0,0])
 
-    # Characters
-    context = 'Game Characters:\
-        Character: 莉音 == Rio - Gender: Female\
-        Character: 結衣 == Yui - Gender: Female\
-        Character: 美雪 == Miyuki - Gender: Female\
-        Character: あかり == Akari - Gender: Female\
-        Character: カガミ == Kagami - Gender: Female\
-        Character: ミズキ == Mizuki - Gender: Female\
-        Character: スズカ == Suzuka - Gender: Female\
-        Character: シズク == Shizuku - Gender: Female'
-
     # Prompt
     if fullPromptFlag:
         system = PROMPT
@@ -1841,23 +1750,14 @@ def translateGPT(t, history, fullPromptFlag):
         user = 'Line to Translate = ' + subbedT
 
     # Create Message List
-    msg = []
-    msg.append({"role": "system", "content": system})
-    msg.append({"role": "user", "content": context})
-    if isinstance(history, list):
-        for line in history:
-            msg.append({"role": "user", "content": line})
-    else:
-        msg.append({"role": "user", "content": history})
-    msg.append({"role": "user", "content": user})
+    msg = engine.prompt.build(system, CHARACTERS, history, user, 'user')
 
-    response = openai.ChatCompletion.create(
+    response = engine.complete(
         temperature=0,
         frequency_penalty=0.2,
         presence_penalty=0.2,
         model=MODEL,
         messages=msg,
-        request_timeout=TIMEOUT,
     )
 
     # Save Translated Text
@@ -1865,7 +1765,7 @@ def translateGPT(t, history, fullPromptFlag):
     totalTokens = [response.usage.prompt_tokens, response.usage.completion_tokens]
 
     # Resub Vars
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
 
     # Remove Placeholder Text
     translatedText = translatedText.replace(LANGUAGE +' Translation: ', '')
@@ -1884,4 +1784,5 @@ def translateGPT(t, history, fullPromptFlag):
     if len(translatedText) > 15 * len(t) or "I'm sorry, but I'm unable to assist with that translation" in translatedText:
         raise Exception
     else:
+        tlcache.setTranslation(__name__, t, history, memoryPrompt, translatedText)
         return [translatedText, totalTokens]
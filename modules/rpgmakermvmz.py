@@ -1,18 +1,16 @@
 # Libraries
-import json, os, re, textwrap, threading, time, traceback, tiktoken, openai
+import copy, json, os, re, textwrap, threading, time, traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from colorama import Fore
 from dotenv import load_dotenv
 from retry import retry
 from tqdm import tqdm
+from modules import codec, engine, filekinds, journal, manifest, notes, pages, tlcache
+from modules.engine.tokens import estimateText
 
 # Open AI
 load_dotenv()
-if os.getenv('api').replace(' ', '') != '':
-    openai.api_base = os.getenv('api')
-openai.organization = os.getenv('org')
-openai.api_key = os.getenv('key')
 
 #Globals
 MODEL = os.getenv('model')
@@ -34,6 +32,11 @@ FIXTEXTWRAP = True  # Overwrites textwrap
 IGNORETLTEXT = False    # Ignores all translated text.
 MISMATCH = []   # Lists files that throw a mismatch error (Length of GPT list response is wrong)
 BRACKETNAMES = False
+PACKPAGES = True    # Send the dialogue of several small pages in one request
+PACKTOKENS = 2000   # Max tokens of dialogue in one packed request
+DEDUPE = True   # Translate each distinct database string once, in batches, before writing them back
+PREFETCH = {}   # (Prompt, Full Prompt Flag, Text) -> Translation
+LOCAL = threading.local()
 
 # Pricing - Depends on the model https://openai.com/pricing
 # Batch Size - GPT 3.5 Struggles past 15 lines per request. GPT4 struggles past 50 lines per request
@@ -82,6 +85,12 @@ def handleMVMZ(filename, estimate):
     global ESTIMATE, TOKENS
     ESTIMATE = estimate
 
+    # Replay anything a previous run (or the last version of this file) finished
+    if not estimate:
+        resumed = journal.start(filename, manifest.getUnits(filename))
+        if resumed:
+            tqdm.write(f'{filename}: {resumed} pages already translated')
+
     # Translate
     start = time.time()
     translatedData = openFiles(filename)
@@ -89,11 +98,18 @@ def handleMVMZ(filename, estimate):
     # Translate
     if not estimate:
         try:
-            with open('translated/' + filename, 'w', encoding='utf-8') as outFile:
-                json.dump(translatedData[0], outFile, ensure_ascii=False)
+            with journal.openAtomic('translated/' + filename, 'w', encoding='utf-8') as outFile:
+                writeJSON(translatedData[0], outFile)
         except Exception:
             traceback.print_exc()
+            journal.finish(filename, False)
             return 'Fail'
+
+        # Keep the journal if anything failed so the next run can pick up from it
+        complete = translatedData[2] is None and filename not in MISMATCH
+        units = journal.finish(filename, complete)
+        if complete:
+            manifest.record(filename, units)
     
     # Print File
     end = time.time()
@@ -111,68 +127,53 @@ def handleMVMZ(filename, estimate):
     else:
         return totalString
 
+# Same bytes as json.dump(data, outFile, ensure_ascii=False), written an event (or page) at a time.
+# json.dump runs the pure Python encoder over the whole tree, json.dumps on each piece uses the C one.
+def writeJSON(data, outFile, depth=0):
+    if depth < 2 and isinstance(data, list):
+        outFile.write('[')
+        for i, item in enumerate(data):
+            if i > 0:
+                outFile.write(', ')
+            writeJSON(item, outFile, depth + 1)
+        outFile.write(']')
+    elif depth < 2 and isinstance(data, dict) and all([isinstance(key, str) for key in data]):
+        outFile.write('{')
+        for i, key in enumerate(data):
+            if i > 0:
+                outFile.write(', ')
+            outFile.write(json.dumps(key, ensure_ascii=False) + ': ')
+            writeJSON(data[key], outFile, depth + 1)
+        outFile.write('}')
+    else:
+        outFile.write(json.dumps(data, ensure_ascii=False))
+
+# File kind -> Parser (See filekinds.FILEKINDS)
+PARSERS = {
+    'Map': lambda data, filename: parseMap(data, filename),
+    'CommonEvents': lambda data, filename: parseCommonEvents(data, filename),
+    'Actors': lambda data, filename: parseNames(data, filename, 'Actors'),
+    'Armors': lambda data, filename: parseNames(data, filename, 'Armors'),
+    'Weapons': lambda data, filename: parseNames(data, filename, 'Weapons'),
+    'Classes': lambda data, filename: parseNames(data, filename, 'Classes'),
+    'Enemies': lambda data, filename: parseNames(data, filename, 'Enemies'),
+    'Items': lambda data, filename: parseThings(data, filename),
+    'MapInfos': lambda data, filename: parseNames(data, filename, 'MapInfos'),
+    'Skills': lambda data, filename: parseSS(data, filename, 'Skills'),
+    'Troops': lambda data, filename: parseTroops(data, filename),
+    'States': lambda data, filename: parseSS(data, filename, 'States'),
+    'System': lambda data, filename: parseSystem(data, filename),
+    'Scenario': lambda data, filename: parseScenario(data, filename),
+}
+
 def openFiles(filename):
     with open('files/' + filename, 'r', encoding='utf-8-sig') as f:
         data = json.load(f)
 
-        # Map Files
-        if 'Map' in filename and filename != 'MapInfos.json':
-            translatedData = parseMap(data, filename)
-
-        # CommonEvents Files
-        elif 'CommonEvents' in filename:
-            translatedData = parseCommonEvents(data, filename)
-
-        # Actor File
-        elif 'Actors' in filename:
-            translatedData = parseNames(data, filename, 'Actors')
-
-        # Armor File
-        elif 'Armors' in filename:
-            translatedData = parseNames(data, filename, 'Armors')
-
-        # Weapons File
-        elif 'Weapons' in filename:
-            translatedData = parseNames(data, filename, 'Weapons')
-        
-        # Classes File
-        elif 'Classes' in filename:
-            translatedData = parseNames(data, filename, 'Classes')
-
-        # Enemies File
-        elif 'Enemies' in filename:
-            translatedData = parseNames(data, filename, 'Enemies')
-
-        # Items File
-        elif 'Items' in filename:
-            translatedData = parseThings(data, filename)
-
-        # MapInfo File
-        elif 'MapInfos' in filename:
-            translatedData = parseNames(data, filename, 'MapInfos')
-
-        # Skills File
-        elif 'Skills' in filename:
-            translatedData = parseSS(data, filename)
-
-        # Troops File
-        elif 'Troops' in filename:
-            translatedData = parseTroops(data, filename)
-
-        # States File
-        elif 'States' in filename:
-            translatedData = parseSS(data, filename)
-
-        # System File
-        elif 'System' in filename:
-            translatedData = parseSystem(data, filename)
-
-        # Scenario File
-        elif 'Scenario' in filename:
-            translatedData = parseScenario(data, filename)
-
-        else:
+        kind = filekinds.getKind(filename, data)
+        if kind not in PARSERS:
             raise NameError(filename + ' Not Supported')
+        translatedData = PARSERS[kind](data, filename)
     
     return translatedData
 
@@ -206,7 +207,7 @@ def parseMap(data, filename):
     global LOCK
 
     # Translate displayName for Map files
-    if 'Map' in filename:
+    if data.get('displayName'):
         response = translateGPT(data['displayName'], 'Reply with only the '+ LANGUAGE +' translation of the RPG location name', False)
         totalTokens[0] += response[1][0]
         totalTokens[1] += response[1][1]
@@ -222,65 +223,38 @@ def parseMap(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
+        prefetchTokens = prefetchStrings(lambda note, pbar: translateNotes(note, 'Events'), [{'note': event['note']} for event in events if event is not None])
+        totalTokens[0] += prefetchTokens[0]
+        totalTokens[1] += prefetchTokens[1]
+        for event in events:
+            if event is not None:
+                # Note tags such as <namePop:> (Translating event IDs may break the game)
+                notesTokens = translateNotes(event, 'Events')
+                totalTokens[0] += notesTokens[0]
+                totalTokens[1] += notesTokens[1]
+
+        # One queue for the pages of every event
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            for event in events:
-                if event is not None:
-                    # This translates ID of events. (May break the game)
-                    if '<namePop:' in event['note']:
-                        totalTokens[0] += translateNoteOmitSpace(event, r'<namePop:(.*?) [\d]+>')[0]
-                        totalTokens[1] += translateNoteOmitSpace(event, r'<namePop:(.*?) [\d]+>')[1]
-
-                    futures = [executor.submit(searchCodes, page, pbar, [], filename) for page in event['pages'] if page is not None]
-                    for future in as_completed(futures):
-                        try:
-                            totalTokensFuture = future.result()
-                            totalTokens[0] += totalTokensFuture[0]
-                            totalTokens[1] += totalTokensFuture[1]
-                        except Exception as e:
-                            return [data, totalTokens, e]
+            packer = newPacker(executor, filename) if PACKPAGES else None
+            pageList = (page for event in events if event is not None for page in event['pages'])
+            response = pages.searchPages(executor, pageList, lambda page: searchCodes(page, pbar, filename, packer), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
+
+            # Translate the dialogue of every page in packs
+            try:
+                totalTokensPacks = translatePacks(packer)
+                totalTokens[0] += totalTokensPacks[0]
+                totalTokens[1] += totalTokensPacks[1]
+            except Exception as e:
+                return [data, totalTokens, e]
     return [data, totalTokens, None]
 
-def translateNote(event, regex):
-    # Regex String
-    jaString = event['note']
-    match = re.findall(regex, jaString, re.DOTALL)
-    if match:
-        oldJAString = match[0]
-        # Remove any textwrap
-        jaString = re.sub(r'\n', ' ', oldJAString)
-
-        # Translate
-        response = translateGPT(jaString, 'Reply with the '+ LANGUAGE +' translation.', False)
-        translatedText = response[0]
-
-        # Textwrap
-        translatedText = textwrap.fill(translatedText, width=NOTEWIDTH)
-
-        translatedText = translatedText.replace('\"', '')
-        event['note'] = event['note'].replace(oldJAString, translatedText)
-        return response[1]
-    return [0,0]
-
-# For notes that can't have spaces.
-def translateNoteOmitSpace(event, regex):
-    # Regex that only matches text inside LB.
-    jaString = event['note']
-
-    match = re.findall(regex, jaString, re.DOTALL)
-    if match:
-        oldJAString = match[0]
-        # Remove any textwrap
-        jaString = re.sub(r'\n', ' ', oldJAString)
-
-        # Translate
-        response = translateGPT(jaString, 'Reply with the '+ LANGUAGE +' translation of the location name.', True)
-        translatedText = response[0]
-
-        translatedText = translatedText.replace('\"', '')
-        translatedText = translatedText.replace(' ', '_')
-        event['note'] = event['note'].replace(oldJAString, translatedText)
-        return response[1]
-    return [0,0]
+# Note tags of entry (See notes.NOTETAGS)
+def translateNotes(entry, kind):
+    return notes.translateNotes(entry, kind, lambda text, about: translateGPT(text, 'Reply with the '+ LANGUAGE +' translation of the '+ about +'.', False), NOTEWIDTH)
 
 def parseCommonEvents(data, filename):
     totalTokens = [0, 0]
@@ -296,15 +270,22 @@ def parseCommonEvents(data, filename):
         pbar.desc=filename
         pbar.total=totalLines
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = [executor.submit(searchCodes, page, pbar, [], filename) for page in data if page is not None]
-            for future in as_completed(futures):
-                try:
-                    totalTokensFuture = future.result()
-                    totalTokens[0] += totalTokensFuture[0]
-                    totalTokens[1] += totalTokensFuture[1]
-                except Exception as e:
-                    traceback.print_exc()
-                    return [data, totalTokens, e]
+            packer = newPacker(executor, filename) if PACKPAGES else None
+            response = pages.searchPages(executor, data, lambda page: searchCodes(page, pbar, filename, packer), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                traceback.print_exception(type(response[1]), response[1], response[1].__traceback__)
+                return [data, totalTokens, response[1]]
+
+            # Translate the dialogue of every page in packs
+            try:
+                totalTokensPacks = translatePacks(packer)
+                totalTokens[0] += totalTokensPacks[0]
+                totalTokens[1] += totalTokensPacks[1]
+            except Exception as e:
+                traceback.print_exc()
+                return [data, totalTokens, e]
     return [data, totalTokens, None]
 
 def parseTroops(data, filename):
@@ -321,18 +302,25 @@ def parseTroops(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
-        for troop in data:
-            if troop is not None:
-                with ThreadPoolExecutor(max_workers=THREADS) as executor:
-                    futures = [executor.submit(searchCodes, page, pbar, [], filename) for page in troop['pages'] if page is not None]
-                    for future in as_completed(futures):
-                        try:
-                            totalTokensFuture = future.result()
-                            totalTokens[0] += totalTokensFuture[0]
-                            totalTokens[1] += totalTokensFuture[1]
-                        except Exception as e:
-                            traceback.print_exc()
-                            return [data, totalTokens, e]
+        # One queue for the pages of every troop
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            packer = newPacker(executor, filename) if PACKPAGES else None
+            pageList = (page for troop in data if troop is not None for page in troop['pages'])
+            response = pages.searchPages(executor, pageList, lambda page: searchCodes(page, pbar, filename, packer), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                traceback.print_exception(type(response[1]), response[1], response[1].__traceback__)
+                return [data, totalTokens, response[1]]
+
+            # Translate the dialogue of every page in packs
+            try:
+                totalTokensPacks = translatePacks(packer)
+                totalTokens[0] += totalTokensPacks[0]
+                totalTokens[1] += totalTokensPacks[1]
+            except Exception as e:
+                traceback.print_exc()
+                return [data, totalTokens, e]
     return [data, totalTokens, None]
     
 def parseNames(data, filename, context):
@@ -343,6 +331,9 @@ def parseNames(data, filename, context):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
             pbar.desc=filename
             pbar.total=totalLines
+            prefetchTokens = prefetchStrings(lambda name, pbar: searchNames(name, pbar, context), data)
+            totalTokens[0] += prefetchTokens[0]
+            totalTokens[1] += prefetchTokens[1]
             for name in data:
                 if name is not None:
                     try:
@@ -362,6 +353,9 @@ def parseThings(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
             pbar.desc=filename
             pbar.total=totalLines
+            prefetchTokens = prefetchStrings(lambda name, pbar: searchThings(name, pbar), data)
+            totalTokens[0] += prefetchTokens[0]
+            totalTokens[1] += prefetchTokens[1]
             for name in data:
                 if name is not None:
                     try:
@@ -373,7 +367,7 @@ def parseThings(data, filename):
                         return [data, totalTokens, e]
     return [data, totalTokens, None]
 
-def parseSS(data, filename):
+def parseSS(data, filename, context):
     totalTokens = [0, 0]
     totalLines = 0
     totalLines += len(data)
@@ -381,10 +375,13 @@ def parseSS(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
             pbar.desc=filename
             pbar.total=totalLines
+            prefetchTokens = prefetchStrings(lambda ss, pbar: searchSS(ss, pbar, context), data)
+            totalTokens[0] += prefetchTokens[0]
+            totalTokens[1] += prefetchTokens[1]
             for ss in data:
                 if ss is not None:
                     try:
-                        result = searchSS(ss, pbar)       
+                        result = searchSS(ss, pbar, context)       
                         totalTokens[0] += result[0]
                         totalTokens[1] += result[1]
                     except Exception as e:
@@ -410,6 +407,9 @@ def parseSystem(data, filename):
     with tqdm(bar_format=BAR_FORMAT, position=POSITION, total=totalLines, leave=LEAVE) as pbar:
         pbar.desc=filename
         pbar.total=totalLines
+        prefetchTokens = prefetchStrings(searchSystem, [data])
+        totalTokens[0] += prefetchTokens[0]
+        totalTokens[1] += prefetchTokens[1]
         try:
             result = searchSystem(data, pbar)       
             totalTokens[0] += result[0]
@@ -419,6 +419,54 @@ def parseSystem(data, filename):
             return [data, totalTokens, e]
     return [data, totalTokens, None]
 
+# Database files repeat a lot of strings (the same message1 on many states, one description on a
+# whole set of items) that used to be sent one request each. A first pass runs search over a copy of
+# each item with translateGPT only collecting what it would send. Every distinct string is then
+# translated once, in <LineN> batches per prompt sent THREADS at a time, and the real pass picks
+# them up from PREFETCH.
+# Anything the first pass didn't see the same way is still translated on its own.
+def prefetchStrings(search, items):
+    totalTokens = [0, 0]
+    if not DEDUPE:
+        return totalTokens
+
+    # Collect
+    LOCAL.collect = {}
+    try:
+        with tqdm(disable=True) as pbar:
+            for item in items:
+                if item is not None:
+                    try:
+                        search(copy.deepcopy(item), pbar)
+                    except Exception:
+                        pass    # The real pass reports it
+        collected = LOCAL.collect
+    finally:
+        LOCAL.collect = None
+
+    # Translate, every batch of every prompt at once
+    batches = []
+    for (history, fullPromptFlag), textList in collected.items():
+        textList = [text for text in textList if (history, fullPromptFlag, text) not in PREFETCH]
+        batches.extend([[history, fullPromptFlag, textList[i:i + BATCHSIZE]] for i in range(0, len(textList), BATCHSIZE)])
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        futures = [executor.submit(engine.metrics.bind(prefetchBatch), history, fullPromptFlag, textList) for history, fullPromptFlag, textList in batches]
+        for future in as_completed(futures):
+            totalTokensFuture = future.result()
+            totalTokens[0] += totalTokensFuture[0]
+            totalTokens[1] += totalTokensFuture[1]
+    return totalTokens
+
+def prefetchBatch(history, fullPromptFlag, textList):
+    # One line per string (Descriptions are wrapped again once translated)
+    response = translateGPT([text.replace('\n', ' ') for text in textList], history, fullPromptFlag)
+    # Strings that didn't come back are left to the normal pass
+    with LOCK:
+        for text, translation in zip(textList, response[0]):
+            if translation is not None:
+                PREFETCH[(history, fullPromptFlag, text)] = translation
+    return response[1]
+
 def parseScenario(data, filename):
     totalTokens = [0, 0]
     totalLines = 0
@@ -432,16 +480,93 @@ def parseScenario(data, filename):
         pbar.desc=filename
         pbar.total=totalLines
         with ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = [executor.submit(searchCodes, page[1], pbar, [], filename) for page in data.items() if page[1] is not None]
-            for future in as_completed(futures):
-                try:
-                    totalTokensFuture = future.result()
-                    totalTokens[0] += totalTokensFuture[0]
-                    totalTokens[1] += totalTokensFuture[1]
-                except Exception as e:
-                    return [data, totalTokens, e]
+            packer = newPacker(executor, filename) if PACKPAGES else None
+            response = pages.searchPages(executor, data.values(), lambda page: searchCodes(page, pbar, filename, packer), THREADS)
+            totalTokens[0] += response[0][0]
+            totalTokens[1] += response[0][1]
+            if response[1] is not None:
+                return [data, totalTokens, response[1]]
+
+            # Translate the dialogue of every page in packs
+            try:
+                totalTokensPacks = translatePacks(packer)
+                totalTokens[0] += totalTokensPacks[0]
+                totalTokens[1] += totalTokensPacks[1]
+            except Exception as e:
+                return [data, totalTokens, e]
     return [data, totalTokens, None]
 
+# Most pages are only a few lines long, so translating each one on its own pays for the whole
+# prompt.txt every time. With packing, searchCodes hands each page's dialogue to the packer instead.
+# A pack is sent as soon as it is full, so it translates while the next pages are still being extracted.
+def newPacker(executor, filename):
+    return {'executor': executor, 'filename': filename, 'pages': [], 'lines': 0, 'tokens': 0, 'futures': []}
+
+# Adds a page to the packer. The current pack is sent first if the page would take it over
+# BATCHSIZE lines or PACKTOKENS tokens. A page bigger than that gets a pack to itself and
+# translateGPT splits it like before.
+def packPage(packer, item):
+    tokens = sum([estimateText(line) for line in item[2]])
+    with LOCK:
+        if len(packer['pages']) > 0 and (packer['lines'] + len(item[2]) > BATCHSIZE or packer['tokens'] + tokens > PACKTOKENS):
+            sendPack(packer)
+        packer['pages'].append(item)
+        packer['lines'] += len(item[2])
+        packer['tokens'] += tokens
+
+# Caller holds LOCK
+def sendPack(packer):
+    packer['futures'].append(packer['executor'].submit(engine.metrics.bind(translatePack), packer['pages'], packer['filename']))
+    packer['pages'] = []
+    packer['lines'] = 0
+    packer['tokens'] = 0
+
+# Sends what is left in the packer and waits for every pack
+def translatePacks(packer):
+    totalTokens = [0, 0]
+    if packer is None:
+        return totalTokens
+
+    with LOCK:
+        if len(packer['pages']) > 0:
+            sendPack(packer)
+    for future in as_completed(packer['futures']):
+        totalTokensFuture = future.result()
+        totalTokens[0] += totalTokensFuture[0]
+        totalTokens[1] += totalTokensFuture[1]
+    return totalTokens
+
+def translatePack(pack, filename):
+    totalTokens = [0, 0]
+    docList = [line for item in pack for line in item[2]]
+    textHistory = [line for item in pack for line in item[3]]
+
+    engine.metrics.setContext(code=401)
+    response = translateGPT(docList, textHistory, True)
+    fillList = response[0]
+    totalTokens[0] += response[1][0]
+    totalTokens[1] += response[1][1]
+
+    # Scatter back to each page
+    if len(fillList) == len(docList) and None not in fillList:
+        start = 0
+        for page, units, pageDocList, _ in pack:
+            journal.put(filename, pageDocList, fillList[start:start + len(pageDocList)])
+            applyCodes(page, units, fillList[start:start + len(pageDocList)])
+            start += len(pageDocList)
+
+    # Mismatch, send the pages one at a time so one bad page doesn't take the rest with it
+    elif len(pack) > 1:
+        for item in pack:
+            totalTokensPage = translatePack([item], filename)
+            totalTokens[0] += totalTokensPage[0]
+            totalTokens[1] += totalTokensPage[1]
+    else:
+        with LOCK:
+            if filename not in MISMATCH:
+                MISMATCH.append(filename)
+    return totalTokens
+
 def searchThings(name, pbar):
     totalTokens = [0, 0]
 
@@ -458,15 +583,9 @@ def searchThings(name, pbar):
     descriptionResponse = translateGPT(name['description'], 'Reply with only the '+ LANGUAGE +' translation of the description.', False) if 'description' in name else ''
 
     # Note
-    if '<SG説明:' in name['note']:
-        totalTokens[0] += translateNote(name, r'<SG説明:(.*?)>')[0]
-        totalTokens[1] += translateNote(name, r'<SG説明:(.*?)>')[1]
-    if '<SGカテゴリ:' in name['note']:
-        totalTokens[0] += translateNote(name, r'<SGカテゴリ:(.*?)>')[0]
-        totalTokens[1] += translateNote(name, r'<SGカテゴリ:(.*?)>')[1]
-    if '<ExtendDesc:' in name['note']:
-        totalTokens[0] += translateNote(name, r'<ExtendDesc:(.*?)>')[0]
-        totalTokens[1] += translateNote(name, r'<ExtendDesc:(.*?)>')[1]
+    notesTokens = translateNotes(name, 'Items')
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
 
     # Count totalTokens
     totalTokens[0] += nameResponse[1][0] if nameResponse != '' else 0
@@ -517,22 +636,11 @@ def searchNames(name, pbar, context):
             responseList.append(translateGPT(name['description'], '', False))
         else:
             responseList.append(['', 0])
-        if 'hint' in name['note']:
-            totalTokens[0] += translateNote(name, r'<hint:(.*?)>')[0]
-            totalTokens[1] += translateNote(name, r'<hint:(.*?)>')[1]
 
-    if 'Enemies' in context:
-        if 'variable_update_skill' in name['note']:
-            totalTokens[0] += translateNote(name, r'111:(.+?)\n')[0]
-            totalTokens[1] += translateNote(name, r'111:(.+?)\n')[1]
-
-        if 'desc2' in name['note']:
-            totalTokens[0] += translateNote(name, r'<desc2:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<desc2:([^>]*)>')[1]
-
-        if 'desc3' in name['note']:
-            totalTokens[0] += translateNote(name, r'<desc3:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<desc3:([^>]*)>')[1]
+    # Note
+    notesTokens = translateNotes(name, context)
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
 
     # Extract all our translations in a list from response
     for i in range(len(responseList)):
@@ -547,33 +655,65 @@ def searchNames(name, pbar, context):
         name['profile'] = translatedText.replace('\"', '')
         translatedText = textwrap.fill(responseList[2], LISTWIDTH)
         name['nickname'] = translatedText.replace('\"', '')
-        if '<特徴1:' in name['note']:
-            totalTokens[0] += translateNote(name, r'<特徴1:([^>]*)>')[0]
-            totalTokens[1] += translateNote(name, r'<特徴1:([^>]*)>')[1]
 
     if 'Armors' in context or 'Weapons' in context:
         translatedText = textwrap.fill(responseList[1], LISTWIDTH)
         if 'description' in name:
             name['description'] = translatedText.replace('\"', '')
-            if '<SG説明:' in name['note']:
-                totalTokens[0] += translateNote(name, r'<Info Text Bottom>\n([\s\S]*?)\n</Info Text Bottom>')[0]
-                totalTokens[1] += translateNote(name, r'<Info Text Bottom>\n([\s\S]*?)\n</Info Text Bottom>')[1]
     pbar.update(1)
 
     return totalTokens
 
-def searchCodes(page, pbar, fillList, filename):
+# Pages go through three steps. extractCodes walks the page once, translating the one off strings
+# in place and collecting the dialogue as units. The dialogue is translated in one batch (or packed
+# with other pages), then applyCodes writes it back and drops the joined codes in a single pass.
+def searchCodes(page, pbar, filename, packer=None):
+    global MISMATCH
+
+    # Extract
+    units, docList, textHistory, totalTokens = extractCodes(page, pbar)
+    if docList == []:
+        applyCodes(page, units, [])
+        return totalTokens
+
+    # Finished by an earlier run
+    fillList = journal.get(filename, docList)
+    if fillList is not None:
+        applyCodes(page, units, fillList)
+        return totalTokens
+
+    # Translate
+    if packer is not None:
+        packPage(packer, [page, units, docList, textHistory])
+        return totalTokens
+    engine.metrics.setContext(code=401)
+    response = translateGPT(docList, textHistory, True)
+    fillList = response[0]
+    totalTokens[0] += response[1][0]
+    totalTokens[1] += response[1][1]
+
+    # Apply
+    if len(fillList) != len(docList) or None in fillList:
+        with LOCK:
+            if filename not in MISMATCH:
+                MISMATCH.append(filename)
+    else:
+        journal.put(filename, docList, fillList)
+        applyCodes(page, units, fillList)
+    return totalTokens
+
+# Returns [units, docList, textHistory, totalTokens]. Each unit has an address of
+# [first index, last index, code, parameter slot] in the page. Dialogue units line up with docList.
+def extractCodes(page, pbar):
+    units = []
     docList = []
     currentGroup = []
     textHistory = []
-    match = []
     totalTokens = [0, 0]
     translatedText = ''
+    oldjaString = ''
     speaker = ''
-    speakerID = None
-    nametag = ''
     syncIndex = 0
-    CLFlag = False
     maxHistory = MAXHISTORY
     global LOCK
     global NAMESLIST
@@ -590,14 +730,13 @@ def searchCodes(page, pbar, fillList, filename):
 
         # Iterate through page
         for i in range(len(codeList)):
-            with LOCK:  
-                # syncIndex will keep i in sync when it gets modified
-                if syncIndex > i:
-                    i = syncIndex
-                if fillList == []:
-                    pbar.update(1)
-                if len(codeList) <= i:
-                    break
+            with LOCK:
+                pbar.update(1)
+
+            # Skip codes that were joined into an earlier group
+            if syncIndex > i:
+                continue
+            engine.metrics.setContext(code=codeList[i]['code'])
 
             ## Event Code: 401 Show Text
             if codeList[i]['code'] in [401, 405] and (CODE401 or CODE405):
@@ -609,7 +748,7 @@ def searchCodes(page, pbar, fillList, filename):
                 if len(codeList[i]['parameters']) > 0:
                     jaString = codeList[i]['parameters'][0]
                 else:
-                    codeList[i]['code'] = -1
+                    units.append({'type': 'drop', 'address': [i, i, code, 0]})
                     continue
 
                 # If there isn't any Japanese in the text just skip
@@ -627,9 +766,7 @@ def searchCodes(page, pbar, fillList, filename):
 
                 # Join Up 401's into single string
                 if len(codeList) > i+1:
-                    while codeList[i+1]['code'] in [401, 405, -1]:
-                        codeList[i]['parameters'] = []
-                        codeList[i]['code'] = -1
+                    while codeList[i+1]['code'] in [401, 405]:
                         i += 1
 
                         # Only add if not empty
@@ -642,12 +779,17 @@ def searchCodes(page, pbar, fillList, filename):
                             break
 
                 # Format String
+                syncIndex = i + 1
                 if len(currentGroup) > 0:
                     finalJAString = ''.join(currentGroup).replace('？', '?')
                     oldjaString = finalJAString
+                    currentGroup = []
+                    nametag = ''
+                    fullSpeaker = ''
 
                     # Check if Empty
                     if finalJAString == '':
+                        units.append({'type': 'drop', 'address': [j + 1, i, code, 0]})
                         continue
                        
                     # Check for speakers in String
@@ -677,12 +819,6 @@ def searchCodes(page, pbar, fillList, filename):
                         # Set Nametag and Remove from Final String
                         finalJAString = finalJAString.replace(nametag, '')
                         nametag = nametag.replace(speaker, tledSpeaker)
-
-                        # Set dialogue
-                        if nCase == 0:
-                            codeList[i]['parameters'] = [finalJAString + nametag]
-                        elif nCase == 1:
-                            codeList[i]['parameters'] = [nametag + finalJAString]
                             
                     ### Brackets
                     matchList = re.findall\
@@ -698,7 +834,6 @@ def searchCodes(page, pbar, fillList, filename):
                             match1 = matchList[0][3]
 
                         # Translate Speaker
-                        speakerID = j
                         response = getSpeaker(match1)
                         speaker = response[0]
                         totalTokens[0] += response[1][0]
@@ -708,19 +843,6 @@ def searchCodes(page, pbar, fillList, filename):
                         fullSpeaker = match0.replace(match1, speaker)
                         finalJAString = finalJAString.replace(match0, '')
 
-                        # Set next item as dialogue
-                        if codeList[j + 1]['code'] == 401 or codeList[j + 1]['code'] == -1:
-                            # Set name var to top of list
-                            codeList[j]['parameters'] = [fullSpeaker]
-                            codeList[j]['code'] = code
-                            j += 1
-                            codeList[j]['parameters'] = [finalJAString]
-                            codeList[j]['code'] = code
-                        else:
-                            # Set nametag in string
-                            codeList[j]['parameters'] = [fullSpeaker + finalJAString]
-                            codeList[j]['code'] = code
-
                     # Special Effects
                     soundEffectString = ''
                     matchList = re.findall(r'(.+\\SE\[.+?\])', finalJAString)    
@@ -764,77 +886,32 @@ def searchCodes(page, pbar, fillList, filename):
                             finalJAString = finalJAString.replace(match, '')
 
                     # Center Lines
+                    CLFlag = False
                     if '\\CL' in finalJAString:
                         finalJAString = finalJAString.replace('\\CL', '')
                         CLFlag = True
 
-                    # 1st Passthrough (Grabbing Data)
-                    if len(fillList) == 0:
-                        if speaker == '' and finalJAString != '':
-                            docList.append(finalJAString)
-                            textHistory.append(finalJAString)
-                        elif finalJAString != '':
-                            docList.append(f'{speaker}: {finalJAString}')
-                            textHistory.append(finalJAString)
-                        else:
-                            docList.append(speaker)
-                            textHistory.append(speaker)
-                        speaker = ''
-                        match = []
-                        currentGroup = []
-                        syncIndex = i + 1                          
-
-                    # 2nd Passthrough (Setting Data) 
+                    # Unit
+                    units.append({
+                        'type': 'dialogue',
+                        'address': [j, i, code, 0],
+                        'speaker': speaker != '',
+                        'fullSpeaker': fullSpeaker,
+                        'nametag': nametag,
+                        'nCase': nCase,
+                        'soundEffect': soundEffectString,
+                        'CL': CLFlag,
+                    })
+                    if speaker == '' and finalJAString != '':
+                        docList.append(finalJAString)
+                        textHistory.append(finalJAString)
+                    elif finalJAString != '':
+                        docList.append(f'{speaker}: {finalJAString}')
+                        textHistory.append(finalJAString)
                     else:
-                        # Grab Translated String
-                        translatedText = fillList[0]
-                        
-                        # Remove added speaker
-                        if speaker != '':
-                            matchSpeakerList = re.findall(r'(^.+?)\s?[|:]\s?', translatedText)
-                            if len(matchSpeakerList) > 0:
-                                fullSpeaker = matchSpeakerList[0]
-                            translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '', translatedText)
-
-                        # Textwrap
-                        if FIXTEXTWRAP is True:
-                            translatedText = textwrap.fill(translatedText, width=WIDTH)
-                            if BRFLAG is True:
-                                translatedText = translatedText.replace('\n', '<br>')   
-
-                        ### Add Var Strings
-                        # CL Flag
-                        if CLFlag:
-                            translatedText = '\\CL' + translatedText
-                            CLFlag = False
-
-                        # Nametag
-                        if nCase == 0:
-                            translatedText = translatedText + nametag
-                        else:
-                            translatedText = nametag + translatedText
-                        nametag = ''
-
-                        # //SE[#]
-                        translatedText = soundEffectString + translatedText
-
-                        # Set Data
-                        if speakerID != None:
-                            codeList[speakerID]['parameters'] = [fullSpeaker]
-                        codeList[i]['parameters'] = []
-                        codeList[i]['code'] = -1
-                        codeList[j]['parameters'] = [translatedText]
-                        codeList[j]['code'] = code
-                        speaker = ''
-                        match = []
-                        currentGroup = []
-                        syncIndex = i + 1
-                        fillList.pop(0)
-                        
-                        # If this is the last item in list, set to empty string
-                        if len(fillList) == 0:
-                            fillList = ''
-                                
+                        docList.append(speaker)
+                        textHistory.append(speaker)
+                    speaker = ''
 
             ## Event Code: 122 [Set Variables]
             if codeList[i]['code'] == 122 and CODE122 is True:
@@ -1204,6 +1281,8 @@ def searchCodes(page, pbar, fillList, filename):
                                     dtext = dtextList[0][1]
                                 currentGroup.append(dtext)
 
+                        syncIndex = i + 1
+
                         # Join up 356 groups for better translation.
                         if len(currentGroup) > 0:
                             finalJAString = ' '.join(currentGroup)
@@ -1278,6 +1357,8 @@ def searchCodes(page, pbar, fillList, filename):
                                 dtext = infoList[0]
                                 currentGroup.append(info)
 
+                        syncIndex = i + 1
+
                         # Join up 356 groups for better translation.
                         if len(currentGroup) > 0:
                             finalJAString = ' '.join(currentGroup)
@@ -1341,6 +1422,8 @@ def searchCodes(page, pbar, fillList, filename):
                                 dtext = infoList[0]
                                 currentGroup.append(info)
 
+                        syncIndex = i + 1
+
                         # Join up 356 groups for better translation.
                         if len(currentGroup) > 0:
                             finalJAString = ' '.join(currentGroup)
@@ -1404,6 +1487,8 @@ def searchCodes(page, pbar, fillList, filename):
                                 dtext = infoList[0]
                                 currentGroup.append(info)
 
+                        syncIndex = i + 1
+
                         # Join up 356 groups for better translation.
                         if len(currentGroup) > 0:
                             finalJAString = ' '.join(currentGroup)
@@ -1548,38 +1633,82 @@ def searchCodes(page, pbar, fillList, filename):
                 # Set Data
                 codeList[i]['parameters'][1] = translatedText
 
-        # End of the line
-        if docList != [] and fillList != '':
-            response = translateGPT(docList, textHistory, True)
-            fillList = response[0]
-            totalTokens[0] += response[1][0]
-            totalTokens[1] += response[1][1]
-            if len(fillList) != len(docList):
-                global MISMATCH
-                with LOCK:
-                    if filename not in MISMATCH:
-                        MISMATCH.append(filename)
-            else:
-                docList = []
-                searchCodes(page, pbar, fillList, filename)
-
-        # Delete all -1 codes
-        codeListFinal = []
-        for i in range(len(codeList)):
-            if codeList[i]['code'] != -1:
-                codeListFinal.append(codeList[i])
-        page['list'] = codeListFinal
-
     except IndexError as e:
         traceback.print_exc()
         raise Exception(str(e) + 'Failed to translate: ' + oldjaString) from None
     except Exception as e:
         traceback.print_exc()
-        raise Exception(str(e) + 'Failed to translate: ' + oldjaString) from None   
+        raise Exception(str(e) + 'Failed to translate: ' + oldjaString) from None
 
-    return totalTokens
+    return [units, docList, textHistory, totalTokens]
+
+# Writes the translated dialogue back and drops the rest of each joined group in one pass
+def applyCodes(page, units, fillList):
+    writes = {}
+    drops = set()
+    k = 0
+    for unit in units:
+        start, end, code, slot = unit['address']
+        if unit['type'] == 'drop':
+            drops.update(range(start, end + 1))
+            continue
+
+        translatedText = formatDialogue(unit, fillList[k])
+        k += 1
+
+        # Name on its own line above the dialogue
+        if unit['fullSpeaker'] != '' and end > start:
+            writes[start] = [slot, unit['fullSpeaker']]
+            writes[start + 1] = [slot, translatedText]
+            drops.update(range(start + 2, end + 1))
+        else:
+            writes[start] = [slot, unit['fullSpeaker'] + translatedText]
+            drops.update(range(start + 1, end + 1))
+
+    # Normal Format
+    if 'list' in page:
+        codeList = page['list']
+
+    # Special Format (Scenario)
+    else:
+        codeList = page
+
+    codeListFinal = []
+    for i in range(len(codeList)):
+        if i in drops:
+            continue
+        if i in writes:
+            slot, text = writes[i]
+            codeList[i]['parameters'][slot:slot + 1] = [text]
+        codeListFinal.append(codeList[i])
+    codeList[:] = codeListFinal
+
+def formatDialogue(unit, translatedText):
+    # Remove added speaker
+    if unit['speaker']:
+        translatedText = re.sub(r'(^.+?)\s?[|:]\s?', '', translatedText)
+
+    # Textwrap
+    if FIXTEXTWRAP is True:
+        translatedText = textwrap.fill(translatedText, width=WIDTH)
+        if BRFLAG is True:
+            translatedText = translatedText.replace('\n', '<br>')
+
+    ### Add Var Strings
+    # CL Flag
+    if unit['CL']:
+        translatedText = '\\CL' + translatedText
+
+    # Nametag
+    if unit['nCase'] == 0:
+        translatedText = translatedText + unit['nametag']
+    else:
+        translatedText = unit['nametag'] + translatedText
 
-def searchSS(state, pbar):
+    # //SE[#]
+    return unit['soundEffect'] + translatedText
+
+def searchSS(state, pbar, context):
     totalTokens = [0, 0]
 
     # Name
@@ -1622,10 +1751,10 @@ Translate \'Taroを倒した！\' as \'Taro was defeated!\'', False)
         else:
             message4Response = translateGPT(state['message4'], 'reply with only the gender neutral '+ LANGUAGE +' translation', False)
 
-    # if 'note' in state:
-    if 'help' in state['note']:
-        totalTokens[0] += translateNote(state, r'<help:([^>]*)>')[0]
-        totalTokens[1] += translateNote(state, r'<help:([^>]*)>')[1]
+    # Note
+    notesTokens = translateNotes(state, context)
+    totalTokens[0] += notesTokens[0]
+    totalTokens[1] += notesTokens[1]
     
     # Count totalTokens
     totalTokens[0] += nameResponse[1][0] if nameResponse != '' else 0
@@ -1754,126 +1883,13 @@ def getSpeaker(speaker):
         case _:
             return translateGPT(speaker, 'Reply with only the '+ LANGUAGE +' translation of the NPC name.', False)
 
-def subVars(jaString):
-    jaString = jaString.replace('\u3000', ' ')
-
-    # Nested
-    count = 0
-    nestedList = re.findall(r'[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]', jaString)
-    nestedList = set(nestedList)
-    if len(nestedList) != 0:
-        for icon in nestedList:
-            jaString = jaString.replace(icon, '{Nested_' + str(count) + '}')
-            count += 1
-
-    # Icons
-    count = 0
-    iconList = re.findall(r'[\\]+[iIkKwWaA]+\[[0-9]+\]', jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, '{Ascii_' + str(count) + '}')
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r'[\\]+[cC]\[[0-9]+\]', jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, '{Color_' + str(count) + '}')
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r'[\\]+[nN]\[.+?\]+', jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, '{Noun_' + str(count) + '}')
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r'[\\]+[vV]\[[0-9]+\]', jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, '{Var_' + str(count) + '}')
-            count += 1
-
-    # Formatting
-    count = 0
-    formatList = re.findall(r'[\\]+[\w]+\[.+?\]', jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for var in formatList:
-            jaString = jaString.replace(var, '{FCode_' + str(count) + '}')
-            count += 1
-
-    # Put all lists in list and return
-    allList = [nestedList, iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r'\[\s?.+?\s?\]', translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Nested
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace('{Nested_' + str(count) + '}', var)
-            count += 1
-
-    # Icons
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace('{Ascii_' + str(count) + '}', var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace('{Color_' + str(count) + '}', var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace('{Noun_' + str(count) + '}', var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace('{Var_' + str(count) + '}', var)
-            count += 1
-    
-    # Formatting
-    count = 0
-    if len(allList[5]) != 0:
-        for var in allList[5]:
-            translatedText = translatedText.replace('{FCode_' + str(count) + '}', var)
-            count += 1
-
-    return translatedText
-
 def batchList(input_list, batch_size):
     if not isinstance(batch_size, int) or batch_size <= 0:
         raise ValueError("batch_size must be a positive integer")
         
     return [input_list[i:i + batch_size] for i in range(0, len(input_list), batch_size)]
 
-def createContext(fullPromptFlag, subbedT):
+def createContext(fullPromptFlag, subbedT, batchFlag=False):
     characters = 'Game Characters:\n\
 林つかさ (Tsukasa Hayashi) - Female\n\
 山田美兎 (Miyato Yamada) - Female\n\
@@ -1889,27 +1905,20 @@ def createContext(fullPromptFlag, subbedT):
 アッチャラー ギッティ (Atchara Gitti) - Female\n\
 '
     
-    system = PROMPT if fullPromptFlag else \
-        f'Output ONLY the {LANGUAGE} translation in the following format: `Translation: <{LANGUAGE.upper()}_TRANSLATION>`'
+    # Batches without the full prompt (Prefetched database strings) still need the <LineN> format
+    if fullPromptFlag:
+        system = PROMPT
+    elif batchFlag:
+        system = f'Translate each line separately and output ONLY the {LANGUAGE} translations, keeping the XML tags of each line, in the following format: `<Line0>{LANGUAGE.upper()}_TRANSLATION</Line0>\n<Line1>{LANGUAGE.upper()}_TRANSLATION</Line1>`'
+    else:
+        system = f'Output ONLY the {LANGUAGE} translation in the following format: `Translation: <{LANGUAGE.upper()}_TRANSLATION>`'
     user = f'{subbedT}'
     return characters, system, user
 
 def translateText(characters, system, user, history):
-    # Prompt
-    msg = [{"role": "system", "content": system + characters}]
-
-    # Characters
-    msg.append({"role": "system", "content": characters})
-
-    # History
-    if isinstance(history, list):
-        msg.extend([{"role": "assistant", "content": h} for h in history])
-    else:
-        msg.append({"role": "assistant", "content": history})
-    
-    # Content to TL
-    msg.append({"role": "user", "content": f'{user}'})
-    response = openai.chat.completions.create(
+    # Prompt, characters and history (The unchanging part first)
+    msg = engine.prompt.build(system, characters, history, user)
+    response = engine.complete(
         temperature=0.1,
         frequency_penalty=0.1,
         model=MODEL,
@@ -1932,7 +1941,7 @@ def cleanTranslatedText(translatedText, varResponse):
     for target, replacement in placeholders.items():
         translatedText = translatedText.replace(target, replacement)
 
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
     if '\n' in translatedText:
         return [line for line in translatedText.split('\n') if line]
     else:
@@ -1948,22 +1957,15 @@ def extractTranslation(translatedTextList, is_list):
         return matchList[0][1] if matchList else translatedTextList
 
 def countTokens(characters, system, user, history):
-    inputTotalTokens = 0
-    outputTotalTokens = 0
-    enc = tiktoken.encoding_for_model(MODEL)
-    
+    if not isinstance(history, list):
+        history = [history]
+
     # Input
-    if isinstance(history, list):
-        for line in history:
-            inputTotalTokens += len(enc.encode(line))
-    else:
-        inputTotalTokens += len(enc.encode(history))
-    inputTotalTokens += len(enc.encode(system))
-    inputTotalTokens += len(enc.encode(characters))
-    inputTotalTokens += len(enc.encode(user))
+    counts = engine.tokens.countBatch(history + [system, characters, user])
+    inputTotalTokens = sum(counts)
 
     # Output
-    outputTotalTokens += round(len(enc.encode(user))/1.5)
+    outputTotalTokens = round(counts[-1]/1.5)
 
     return [inputTotalTokens, outputTotalTokens]
 
@@ -1974,10 +1976,39 @@ def combineList(tlist, text):
 
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(text, history, fullPromptFlag):
+    return translateGPTOnce(text, history, fullPromptFlag)
+
+# translateGPT without the retry. Lines sent again by recover come back through here, so a request
+# that keeps failing is only retried by the outermost call rather than at every level of the split.
+def translateGPTOnce(text, history, fullPromptFlag):
     totalTokens = [0, 0]
+    translated = False
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memoryHistory = history     # history changes as batches come back
+
+    # Collected or already translated by prefetchStrings
+    if isinstance(text, str) and isinstance(history, str):
+        collect = getattr(LOCAL, 'collect', None)
+        if collect is not None:
+            if re.search(r'[一-龠ぁ-ゔァ-ヴーａ-ｚＡ-Ｚ０-９]+', text):
+                collect.setdefault((history, fullPromptFlag), {})[text] = None
+            return [text, totalTokens]
+        if (history, fullPromptFlag, text) in PREFETCH:
+            return [PREFETCH[(history, fullPromptFlag, text)], totalTokens]
+    elif getattr(LOCAL, 'collect', None) is not None:
+        return [text, totalTokens]
+
+    # Translation Memory
     if isinstance(text, list):
-        tList = batchList(text, BATCHSIZE)
+        memoryList = tlcache.getBatch(__name__, text, memoryHistory, memoryPrompt)
+        sourceList = [text[i] for i in range(len(text)) if memoryList[i] is None]
+        if len(sourceList) == 0:
+            return [memoryList, totalTokens]
+        tList = batchList(sourceList, BATCHSIZE)
     else:
+        memory = tlcache.getTranslation(__name__, text, memoryHistory, memoryPrompt)
+        if memory is not None:
+            return [memory, totalTokens]
         tList = [text]
 
     for index, tItem in enumerate(tList):
@@ -1985,10 +2016,10 @@ def translateGPT(text, history, fullPromptFlag):
         if isinstance(tItem, list):
             payload = '\n'.join([f'<Line{i}>`{item}`</Line{i}>' for i, item in enumerate(tItem)])
             payload = payload.replace('``', '`Placeholder Text`')
-            varResponse = subVars(payload)
+            varResponse = codec.subVars(payload, 'mvmz')
             subbedT = varResponse[0]
         else:
-            varResponse = subVars(tItem)
+            varResponse = codec.subVars(tItem, 'mvmz')
             subbedT = varResponse[0]
 
         # Things to Check before starting translation
@@ -1996,11 +2027,12 @@ def translateGPT(text, history, fullPromptFlag):
             continue
 
         # Create Message
-        characters, system, user = createContext(fullPromptFlag, subbedT)
+        characters, system, user = createContext(fullPromptFlag, subbedT, isinstance(tItem, list))
 
         # Calculate Estimate
         if ESTIMATE:
             estimate = countTokens(characters, system, user, history)
+            engine.estimate.record(len(tItem) if isinstance(tItem, list) else 1, estimate)
             totalTokens[0] += estimate[0]
             totalTokens[1] += estimate[1]
             continue
@@ -2010,19 +2042,41 @@ def translateGPT(text, history, fullPromptFlag):
         translatedText = response.choices[0].message.content
         totalTokens[0] += response.usage.prompt_tokens
         totalTokens[1] += response.usage.completion_tokens
+        translated = True
 
         # Formatting
         translatedTextList = cleanTranslatedText(translatedText, varResponse)
         if isinstance(tItem, list):
             extractedTranslations = extractTranslation(translatedTextList, True)
+
+            # Mismatch, keep the lines that came back under their own <LineN> and send the rest again
+            if len(extractedTranslations) != len(tItem) and len(tItem) > 1:
+                lines = engine.batch.indexLines(translatedTextList, len(tItem))
+                response = engine.batch.recover(tItem, lines, lambda sourceList: translateGPTOnce(sourceList, history, fullPromptFlag))
+                totalTokens[0] += response[1][0]
+                totalTokens[1] += response[1][1]
+                extractedTranslations = response[0]
+
+            # A single line that didn't come back is left as a gap too
+            elif len(extractedTranslations) != len(tItem):
+                extractedTranslations = [None] * len(tItem)
             tList[index] = extractedTranslations
             if len(tItem) != len(translatedTextList):
                 mismatch = True     # Just here so breakpoint can be set
-            history = extractedTranslations[-10:]  # Update history if we have a list
+            history = [line for line in extractedTranslations if line is not None][-10:]  # Update history if we have a list
         else:
             # Ensure we're passing a single string to extractTranslation
             extractedTranslations = extractTranslation('\n'.join(translatedTextList), False)
             tList[index] = extractedTranslations
 
     finalList = combineList(tList, text)
+
+    # Save to Translation Memory
+    if isinstance(text, list):
+        if translated:
+            finalList = tlcache.fillBatch(__name__, memoryList, text, finalList, memoryHistory, memoryPrompt)
+        else:
+            finalList = [memoryList[i] if memoryList[i] is not None else text[i] for i in range(len(text))]
+    elif translated:
+        tlcache.setTranslation(__name__, text, memoryHistory, memoryPrompt, finalList)
     return [finalList, totalTokens]
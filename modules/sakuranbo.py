@@ -6,19 +6,14 @@ import time
 import traceback
 from pathlib import Path
 
-import openai
-import tiktoken
 from colorama import Fore
 from dotenv import load_dotenv
 from retry import retry
 from tqdm import tqdm
+from modules import codec, engine, journal, manifest, tlcache
 
 # Open AI
 load_dotenv()
-if os.getenv("api").replace(" ", "") != "":
-    openai.api_base = os.getenv("api")
-openai.organization = os.getenv("org")
-openai.api_key = os.getenv("key")
 
 # Globals
 MODEL = os.getenv("model")
@@ -73,7 +68,7 @@ def handleSakuranbo(filename, estimate):
 
     else:
         try:
-            with open("translated/" + filename, "w", encoding="utf-16") as outFile:
+            with journal.openAtomic("translated/" + filename, "w", encoding="utf-16") as outFile:
                 start = time.time()
                 translatedData = openFiles(filename)
                 outFile.writelines(translatedData[0])
@@ -88,6 +83,10 @@ def handleSakuranbo(filename, estimate):
             traceback.print_exc()
             return "Fail"
 
+    # Skip this file next run unless its source changes
+    if not estimate and translatedData[2] is None:
+        manifest.record(filename)
+
     return getResultString(["", totalTokens, None], end - start, "TOTAL")
 
 
@@ -138,13 +137,6 @@ def openFiles(filename):
     with open("files/" + filename, "r", encoding="utf-16") as readFile:
         translatedData = parseTyrano(readFile, filename)
 
-        # Delete lines marked for deletion
-        finalData = []
-        for line in translatedData[0]:
-            if line != "\\d\n":
-                finalData.append(line)
-        translatedData[0] = finalData
-
     return translatedData
 
 
@@ -275,7 +267,7 @@ def translateTyrano(data, pbar):
                 matchList = re.findall(r"^([^\n;@*\{\[].+[^;'{}\[]$)", data[i + 1])
                 while len(matchList) > 0:
                     delFlag = True
-                    data[i] = "\d\n"  # \d Marks line for deletion
+                    data[i] = ""  # Empty lines are dropped on write
                     i += 1
                     matchList = re.findall(r"^([^\n;@*\{\[].+[^;'{}\[]$)", data[i])
                     if len(matchList) > 0:
@@ -321,12 +313,11 @@ def translateTyrano(data, pbar):
                 translatedText = textwrap.fill(translatedText, width=WIDTH)
                 translatedText = translatedText.replace("\n", "_")
 
-            # Set
+            # Set (A group's translation goes on its last line so nothing has to be inserted)
             if delFlag is True:
-                data.insert(i, translatedText.strip() + '\n')
+                i -= 1
                 delFlag = False
-            else:
-                data[i] = translatedText.strip() + '\n'
+            data[i] = translatedText.strip() + '\n'
 
             # Keep textHistory list at length maxHistory
             if len(textHistory) > maxHistory:
@@ -350,7 +341,7 @@ def translateTyrano(data, pbar):
                 matchList = re.findall(r"^([^\n;@*\{\[].+[^;'{}\[]$)", data[i + 1])
                 while len(matchList) > 0:
                     delFlag = True
-                    data[i] = "\d\n"  # \d Marks line for deletion
+                    data[i] = ""  # Empty lines are dropped on write
                     i += 1
                     matchList = re.findall(r"^([^\n;@*\{\[].+[^;'{}\[]$)", data[i])
                     if len(matchList) > 0:
@@ -397,12 +388,11 @@ def translateTyrano(data, pbar):
                 translatedText = translatedText.replace("\n", "_")
                 translatedText = originalLine.replace(originalText, translatedText)
 
-            # Set
+            # Set (A group's translation goes on its last line so nothing has to be inserted)
             if delFlag is True:
-                data.insert(i, translatedText.strip() + '\n')
+                i -= 1
                 delFlag = False
-            else:
-                data[i] = translatedText.strip() + '\n'
+            data[i] = translatedText.strip() + '\n'
 
             # Keep textHistory list at length maxHistory
             if len(textHistory) > maxHistory:
@@ -418,131 +408,16 @@ def translateTyrano(data, pbar):
 
     return tokens
 
-def subVars(jaString):
-    jaString = jaString.replace("\u3000", " ")
-
-    # Nested
-    count = 0
-    nestedList = re.findall(r"[\\]+[\w]+\[[\\]+[\w]+\[[0-9]+\]\]", jaString)
-    nestedList = set(nestedList)
-    if len(nestedList) != 0:
-        for icon in nestedList:
-            jaString = jaString.replace(icon, "{Nested_" + str(count) + "}")
-            count += 1
-
-    # Icons
-    count = 0
-    iconList = re.findall(r"[\\]+[iIkKwWaA]+\[[0-9]+\]", jaString)
-    iconList = set(iconList)
-    if len(iconList) != 0:
-        for icon in iconList:
-            jaString = jaString.replace(icon, "{Ascii_" + str(count) + "}")
-            count += 1
-
-    # Colors
-    count = 0
-    colorList = re.findall(r"[\\]+[cC]\[[0-9]+\]", jaString)
-    colorList = set(colorList)
-    if len(colorList) != 0:
-        for color in colorList:
-            jaString = jaString.replace(color, "{Color_" + str(count) + "}")
-            count += 1
-
-    # Names
-    count = 0
-    nameList = re.findall(r"[\\]+[nN]\[.+?\]+", jaString)
-    nameList = set(nameList)
-    if len(nameList) != 0:
-        for name in nameList:
-            jaString = jaString.replace(name, "{N_" + str(count) + "}")
-            count += 1
-
-    # Variables
-    count = 0
-    varList = re.findall(r"[\\]+[vV]\[[0-9]+\]", jaString)
-    varList = set(varList)
-    if len(varList) != 0:
-        for var in varList:
-            jaString = jaString.replace(var, "{Var_" + str(count) + "}")
-            count += 1
-
-    # Formatting
-    count = 0
-    if "笑えるよね." in jaString:
-        print("t")
-    formatList = re.findall(r"[\\]+[\w]+\[.+?\]", jaString)
-    formatList = set(formatList)
-    if len(formatList) != 0:
-        for var in formatList:
-            jaString = jaString.replace(var, "{FCode_" + str(count) + "}")
-            count += 1
-
-    # Put all lists in list and return
-    allList = [nestedList, iconList, colorList, nameList, varList, formatList]
-    return [jaString, allList]
-
-
-def resubVars(translatedText, allList):
-    # Fix Spacing and ChatGPT Nonsense
-    matchList = re.findall(r"\[\s?.+?\s?\]", translatedText)
-    if len(matchList) > 0:
-        for match in matchList:
-            text = match.strip()
-            translatedText = translatedText.replace(match, text)
-
-    # Nested
-    count = 0
-    if len(allList[0]) != 0:
-        for var in allList[0]:
-            translatedText = translatedText.replace("{Nested_" + str(count) + "}", var)
-            count += 1
-
-    # Icons
-    count = 0
-    if len(allList[1]) != 0:
-        for var in allList[1]:
-            translatedText = translatedText.replace("{Ascii_" + str(count) + "}", var)
-            count += 1
-
-    # Colors
-    count = 0
-    if len(allList[2]) != 0:
-        for var in allList[2]:
-            translatedText = translatedText.replace("{Color_" + str(count) + "}", var)
-            count += 1
-
-    # Names
-    count = 0
-    if len(allList[3]) != 0:
-        for var in allList[3]:
-            translatedText = translatedText.replace("{N_" + str(count) + "}", var)
-            count += 1
-
-    # Vars
-    count = 0
-    if len(allList[4]) != 0:
-        for var in allList[4]:
-            translatedText = translatedText.replace("{Var_" + str(count) + "}", var)
-            count += 1
-
-    # Formatting
-    count = 0
-    if len(allList[5]) != 0:
-        for var in allList[5]:
-            translatedText = translatedText.replace("{FCode_" + str(count) + "}", var)
-            count += 1
-
-    # Remove Color Variables Spaces
-    # if '\\c' in translatedText:
-    #     translatedText = re.sub(r'\s*(\\+c\[[1-9]+\])\s*', r' \1', translatedText)
-    #     translatedText = re.sub(r'\s*(\\+c\[0+\])', r'\1', translatedText)
-    return translatedText
-
-
 @retry(exceptions=Exception, tries=5, delay=5)
 def translateGPT(t, history, fullPromptFlag):
+    # Translation Memory
+    memoryPrompt = tlcache.makePrompt(PROMPT, history, fullPromptFlag)
+    memory = tlcache.getTranslation(__name__, t, history, memoryPrompt)
+    if memory is not None:
+        return [memory, [0, 0]]
+
     # Sub Vars
-    varResponse = subVars(t)
+    varResponse = codec.subVars(t, 'tyrano')
     subbedT = varResponse[0]
 
     # If there isn't any Japanese in the text just skip
@@ -551,7 +426,6 @@ def translateGPT(t, history, fullPromptFlag):
 
     # If ESTIMATE is True just count this as an execution and return.
     if ESTIMATE:
-        enc = tiktoken.encoding_for_model(MODEL)
         historyRaw = ""
         if isinstance(history, list):
             for line in history:
@@ -559,11 +433,9 @@ def translateGPT(t, history, fullPromptFlag):
         else:
             historyRaw = history
 
-        inputTotalTokens = len(enc.encode(historyRaw)) + len(enc.encode(PROMPT))
-        outputTotalTokens = (
-            len(enc.encode(t)) * 2
-        )  # Estimating 2x the size of the original text
-        totalTokens = [inputTotalTokens, outputTotalTokens]
+        counts = engine.tokens.countBatch([historyRaw, PROMPT, t])
+        totalTokens = [counts[0] + counts[1], counts[2] * 2]   # Estimating 2x the size of the original text
+        engine.estimate.record(1, totalTokens)
         return (t, totalTokens)
 
     # Characters
@@ -586,23 +458,14 @@ def translateGPT(t, history, fullPromptFlag):
         user = "Line to Translate = " + subbedT
 
     # Create Message List
-    msg = []
-    msg.append({"role": "system", "content": system})
-    msg.append({"role": "user", "content": context})
-    if isinstance(history, list):
-        for line in history:
-            msg.append({"role": "user", "content": line})
-    else:
-        msg.append({"role": "user", "content": history})
-    msg.append({"role": "user", "content": user})
+    msg = engine.prompt.build(system, context, history, user, 'user')
 
-    response = openai.ChatCompletion.create(
+    response = engine.complete(
         temperature=0,
         frequency_penalty=0.2,
         presence_penalty=0.2,
         model=MODEL,
         messages=msg,
-        request_timeout=TIMEOUT,
     )
 
     # Save Translated Text
@@ -610,7 +473,7 @@ def translateGPT(t, history, fullPromptFlag):
     totalTokens = [response.usage.prompt_tokens, response.usage.completion_tokens]
 
     # Resub Vars
-    translatedText = resubVars(translatedText, varResponse[1])
+    translatedText = codec.resubVars(translatedText, varResponse[1])
 
     # Remove Placeholder Text
     translatedText = translatedText.replace(LANGUAGE + " Translation: ", "")
@@ -638,4 +501,5 @@ def translateGPT(t, history, fullPromptFlag):
     ):
         raise Exception
     else:
+        tlcache.setTranslation(__name__, t, history, memoryPrompt, translatedText)
         return [translatedText, totalTokens]
@@ -0,0 +1,66 @@
+# Libraries
+import heapq, re, threading
+from modules import filekinds
+
+# Order files are started in. Files used to go to the file threads in os.listdir order, so a big
+# CommonEvents or map could start last and keep the run going long after the other threads were done.
+# Each file now gets a cost from a quick scan (Japanese characters in the file, times the weight of
+# its kind in filekinds.FILEKINDS) and files are started largest first, which keeps the longest file
+# from being the one that starts last.
+#
+# How long each file took is recorded, so the end of the run can compare the makespan (time from
+# the first file starting to the last one finishing) to the one predicted from the costs, and show
+# what other fileThreads values would have predicted.
+
+#Globals
+LOCK = threading.Lock()
+JAPANESE = re.compile(r'[一-龠ぁ-ゔァ-ヴーａ-ｚＡ-Ｚ０-９]')
+DURATIONS = {}  # File -> Seconds
+
+# encoding is the one the engine module reads its files with (main.MODULES)
+def getCost(filename, encoding):
+    count = 0
+    try:
+        with open('files/' + filename, 'r', encoding=encoding, errors='ignore') as f:
+            for line in f:
+                count += sum(1 for _ in JAPANESE.finditer(line))
+    except OSError:
+        return 0
+    return count * filekinds.getWeight(filekinds.getKind(filename))
+
+# Largest first (Longest processing time first). Returns [filenames, costs]
+def order(filenames, encoding='utf-8'):
+    costs = {filename: getCost(filename, encoding) for filename in filenames}
+    return [sorted(filenames, key=lambda filename: costs[filename], reverse=True), costs]
+
+def record(filename, seconds):
+    with LOCK:
+        DURATIONS[filename] = seconds
+
+# Makespan of giving each file, in order, to the first free thread
+def simulate(times, threads):
+    loads = [0] * max(threads, 1)
+    for time in times:
+        heapq.heappush(loads, heapq.heappop(loads) + time)
+    return max(loads)
+
+# The predicted makespan uses the seconds per unit of cost of this run, so the difference to the
+# actual one is down to how well the costs ranked the files (and any time files spent waiting on
+# each other for the API). Skipped files aren't counted.
+def report(filenames, costs, threads, actual):
+    with LOCK:
+        durations = {filename: DURATIONS[filename] for filename in filenames if filename in DURATIONS}
+    totalCost = sum([costs[filename] for filename in durations])
+    if len(durations) == 0 or totalCost == 0:
+        return None
+
+    rate = sum(durations.values()) / totalCost
+    times = [costs[filename] * rate for filename in filenames if filename in durations]
+    predicted = simulate(times, threads)
+    reportString = f'[Makespan: {actual:.1f}s][Predicted: {predicted:.1f}s with {threads} file threads]'
+    reportString += '[Longest File: ' + max(durations, key=durations.get) + f' {max(durations.values()):.1f}s]'
+
+    # What other fileThreads would have done
+    options = sorted(set([max(threads // 2, 1), threads, threads * 2, len(times)]))
+    reportString += '[' + ', '.join([f'{option}: {simulate(times, option):.1f}s' for option in options]) + ']'
+    return reportString
@@ -0,0 +1,116 @@
+# Libraries
+import hashlib, os, sqlite3, threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Translation memory shared by every engine module. Each translateGPT checks it before building
+# messages so a string that was already paid for (in another map, another file or a previous run)
+# is never sent again. Lookups go through a bounded in-RAM LRU first and fall back to SQLite on disk.
+#
+# Entries are keyed by (module, model, language, prompt hash, history hash, source text). The source is
+# the text as given to translateGPT rather than the subVars output. Placeholders only keep the kind and
+# order of the codes, so two lines that differ in a code (\C[2] and \C[3]) would share a key while the
+# stored translation, which has the codes put back, only fits one of them. History is only part of the
+# key when CACHEHISTORY is on, except for calls without the full prompt, where the history is the
+# instruction saying what the text is (an item name, a nickname...) and goes in as the prompt.
+
+#Globals
+load_dotenv()
+MODEL = os.getenv('model')
+LANGUAGE = str(os.getenv('language')).capitalize()
+CACHE = str(os.getenv('cache', 'True')).lower() not in ['false', '0', 'no', '']
+CACHEFILE = os.getenv('cacheFile', 'cache/tlcache.db')
+CACHEHISTORY = False    # Include the history in the key (Fewer hits, but a hit will always match its context)
+MAXMEMORY = 20000   # Max entries held in RAM
+LOCK = threading.Lock()
+MEMORY = OrderedDict()
+CONNECTION = None
+HITS = [0, 0]   # [Hits, Misses]
+
+def getConnection():
+    global CONNECTION
+    if CONNECTION is None:
+        folder = os.path.dirname(CACHEFILE)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+        CONNECTION = sqlite3.connect(CACHEFILE, check_same_thread=False, isolation_level=None)
+        CONNECTION.execute('PRAGMA journal_mode=WAL')
+        CONNECTION.execute('PRAGMA synchronous=NORMAL')
+        CONNECTION.execute('CREATE TABLE IF NOT EXISTS memory (key TEXT PRIMARY KEY, translation TEXT NOT NULL)')
+    return CONNECTION
+
+def hashText(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def makeKey(namespace, source, history, prompt):
+    if CACHEHISTORY:
+        if isinstance(history, list):
+            historyHash = hashText('\n'.join(history))
+        else:
+            historyHash = hashText(str(history))
+    else:
+        historyHash = ''
+    return hashText('\x00'.join([namespace, str(MODEL), LANGUAGE, hashText(prompt), historyHash, source]))
+
+# Prompt part of the key
+def makePrompt(prompt, history, fullPromptFlag):
+    if fullPromptFlag:
+        return prompt
+    if isinstance(history, list):
+        return '\n'.join(history)
+    return str(history)
+
+def remember(key, translation):
+    MEMORY[key] = translation
+    MEMORY.move_to_end(key)
+    if len(MEMORY) > MAXMEMORY:
+        MEMORY.popitem(last=False)
+
+# Returns the translation or None
+def getTranslation(namespace, source, history, prompt):
+    if not CACHE or not isinstance(source, str) or source == '':
+        return None
+    key = makeKey(namespace, source, history, prompt)
+
+    with LOCK:
+        # RAM
+        if key in MEMORY:
+            MEMORY.move_to_end(key)
+            HITS[0] += 1
+            return MEMORY[key]
+
+        # Disk
+        row = getConnection().execute('SELECT translation FROM memory WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            HITS[1] += 1
+            return None
+        remember(key, row[0])
+        HITS[0] += 1
+        return row[0]
+
+def setTranslation(namespace, source, history, prompt, translation):
+    if not CACHE or not isinstance(source, str) or not isinstance(translation, str) or source == '':
+        return
+    key = makeKey(namespace, source, history, prompt)
+
+    with LOCK:
+        remember(key, translation)
+        getConnection().execute('INSERT OR REPLACE INTO memory (key, translation) VALUES (?, ?)', (key, translation))
+
+# Looks up every item of a batch. Returns the list of translations with None for the misses.
+def getBatch(namespace, sourceList, history, prompt):
+    return [getTranslation(namespace, source, history, prompt) for source in sourceList]
+
+# Fills the misses of getBatch with the new translations, keeping the original order. translatedList
+# has one entry per miss, None for lines that didn't come back, which stay None for the caller. If the
+# lengths don't line up nothing can be placed and every miss stays None.
+def fillBatch(namespace, memoryList, sourceList, translatedList, history, prompt):
+    missing = [i for i in range(len(memoryList)) if memoryList[i] is None]
+    finalList = list(memoryList)
+    if len(missing) != len(translatedList):
+        return finalList
+
+    for i, translation in zip(missing, translatedList):
+        finalList[i] = translation
+        setTranslation(namespace, sourceList[i], history, prompt, translation)
+    return finalList